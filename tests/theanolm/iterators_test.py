@@ -320,6 +320,45 @@ class TestIterators(unittest.TestCase):
         word_counts = self._compute_word_counts(iterator)
         self._assert_shortlist_counts(word_counts)
 
+    def test_sorting_window(self):
+        iterator = ScoringBatchIterator([self.sentences1_file,
+                                         self.sentences2_file],
+                                        self.vocabulary,
+                                        batch_size=2,
+                                        sorting_window=5)
+        all_sentences = []
+        all_indices = []
+        for word_ids, words, mask in iterator:
+            all_sentences.extend(' '.join(sequence) for sequence in words)
+            all_indices.extend(iterator.sequence_indices)
+        # Sentences are returned in the order of their length.
+        self.assertEqual(all_sentences[:4],
+                         ['<s> yhdeksän </s>',
+                          '<s> kymmenen </s>',
+                          '<s> viisi </s>',
+                          '<s> neljä </s>'])
+        self.assertSequenceEqual(sorted(all_indices), range(10))
+        # The original order is restored using the sequence indices.
+        ordered_sentences = [sentence for _, sentence
+                             in sorted(zip(all_indices, all_sentences))]
+        self.assertEqual(' '.join(ordered_sentences),
+                         '<s> yksi kaksi </s> '
+                         '<s> kolme neljä viisi </s> '
+                         '<s> kuusi seitsemän kahdeksan </s> '
+                         '<s> yhdeksän </s> '
+                         '<s> kymmenen </s> '
+                         '<s> kymmenen yhdeksän </s> '
+                         '<s> kahdeksan seitsemän kuusi </s> '
+                         '<s> viisi </s> '
+                         '<s> neljä </s> '
+                         '<s> kolme kaksi yksi </s>')
+
+        # The number of mini-batches doesn't change, and the iterator can be
+        # used again.
+        self.assertEqual(len(iterator), 5)
+        self.assertEqual(sum(1 for _ in iterator), 5)
+        self.assertEqual(iterator.sequence_indices, [6, 9])
+
     def _compute_word_counts(self, iterator):
         """Compute words counts using ``iterator``.
         """
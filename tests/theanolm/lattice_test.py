@@ -6,11 +6,95 @@ import os
 import math
 from io import StringIO
 
+import numpy
+from numpy.testing import assert_almost_equal
+
+from theanolm.backend import InputError, logprob_type
 from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.columnarlattice import ColumnarLattice
 from theanolm.scoring.slflattice import SLFLattice
 from theanolm.scoring.slflattice import _split_slf_field, _split_slf_line
+from theanolm.scoring.slflattice import _split_slf_line_fast
 from theanolm.scoring.kaldilattice import KaldiLattice, read_kaldi_vocabulary
 
+def _baseline_write_slf(lattice, output_file):
+    """Writes a lattice in SLF format one node and link object at a time, as
+    the lattices were written before the columnar writer.
+    """
+
+    output_file.write("# Header (generated by TheanoLM)\n")
+    output_file.write("VERSION=1.1\n")
+    output_file.write('UTTERANCE="{}"\n'.format(lattice.utterance_id))
+    fields = []
+    if lattice.lm_scale is not None:
+        fields.append("lmscale={}".format(lattice.lm_scale))
+    if lattice.wi_penalty is not None:
+        fields.append("wdpenalty={}".format(lattice.wi_penalty))
+    if fields:
+        output_file.write("\t".join(fields) + "\n")
+    output_file.write("start={}\n".format(lattice.initial_node.id))
+    output_file.write("N={}\tL={}\n"
+                      .format(len(lattice.nodes), len(lattice.links)))
+
+    output_file.write("# Nodes\n")
+    for node in lattice.nodes:
+        fields = ["I={}".format(node.id)]
+        if node.time is not None:
+            fields.append("t={}".format(node.time))
+        output_file.write("\t".join(fields) + "\n")
+
+    output_file.write("# Links\n")
+    for link_id, link in enumerate(lattice.links):
+        fields = ["J={}".format(link_id),
+                  "S={}".format(link.start_node.id),
+                  "E={}".format(link.end_node.id)]
+        if link.word is None:
+            fields.append("W=!NULL")
+        else:
+            fields.append("W={}".format(link.word))
+        if link.ac_logprob is not None:
+            fields.append("a={}".format(link.ac_logprob + 0.0))
+        if link.lm_logprob is not None:
+            fields.append("l={}".format(link.lm_logprob + 0.0))
+        output_file.write("\t".join(fields) + "\n")
+
+def _baseline_write_kaldi(lattice, output_file, word_to_id):
+    """Writes a lattice in Kaldi CompactLattice format one link object at a
+    time, as the lattices were written before the columnar writer.
+    """
+
+    def write_normal_link(link):
+        word = link.word
+        if word is None:
+            word = "<eps>"
+        elif word == "</s>":
+            word = "!SENT_END"
+        output_file.write("{} {} {} {},{},{}\n".format(
+            link.start_node.id,
+            link.end_node.id,
+            word_to_id[word],
+            -link.lm_logprob + 0.0,
+            -link.ac_logprob + 0.0,
+            link.transitions))
+
+    def write_final_link(link):
+        output_file.write("{} {},{},{}\n".format(
+            link.start_node.id,
+            -link.lm_logprob + 0.0,
+            -link.ac_logprob + 0.0,
+            link.transitions))
+
+    word_to_id['!SENT_END'] = 0
+
+    output_file.write("{}\n".format(lattice.utterance_id))
+    for node in lattice.nodes:
+        for link in node.out_links:
+            if link.end_node.final:
+                write_final_link(link)
+            else:
+                write_normal_link(link)
+    output_file.write("\n")
+
 class TestLattice(unittest.TestCase):
     def setUp(self):
         script_path = os.path.dirname(os.path.realpath(__file__))
@@ -31,6 +115,27 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(fields[2], 'WORD="QUOTE')
         self.assertEqual(fields[3], "WORD='CAUSE")
 
+    def test_split_slf_comment(self):
+        # A field that starts with # begins a comment, but # inside a field is
+        # part of the value. The result doesn't depend on whether the line
+        # contains quotes.
+        expected = ['J=1', 'S=0', 'E=1', 'W=a#b', 'a=-1']
+        for line in ['J=1 S=0 E=1 W=a#b a=-1 # comment',
+                     'J=1 S=0 E=1 W="a#b" a=-1 # comment',
+                     'J=1 S=0 E=1 W=a#b a=-1 # "comment"']:
+            self.assertEqual(_split_slf_line(line), expected)
+            self.assertEqual(_split_slf_line_fast(line), expected)
+        self.assertEqual(_split_slf_line('J=1 W="x # y" #a=-1'),
+                         ['J=1', 'W=x # y'])
+        self.assertEqual(_split_slf_line_fast('# "comment"'), [])
+
+        lattice = SLFLattice(['N=2 L=1',
+                              'I=0',
+                              'I=1',
+                              'J=0 S=0 E=1 W=a#b a=-1.0 # comment'])
+        self.assertEqual(lattice.link_words, ['a#b'])
+        assert_almost_equal(lattice.link_ac_logprobs, [-1.0])
+
     def test_split_slf_field(self):
         lattice = SLFLattice(None)
         name, value = _split_slf_field("name=va 'lue")
@@ -59,50 +164,51 @@ class TestLattice(unittest.TestCase):
 
     def test_read_slf_node(self):
         lattice = SLFLattice(None)
-        lattice.nodes = [Lattice.Node(id) for id in range(5)]
-        lattice._read_slf_node(0, [])
-        lattice._read_slf_node(1, ['t=1.0'])
-        lattice._read_slf_node(2, ['time=2.1'])
-        lattice._read_slf_node(3, ['t=3.0', 'WORD=wo rd'])
-        lattice._read_slf_node(4, ['time=4.1', 'W=word'])
-
-        self.assertEqual(lattice.nodes[1].time, 1.0)
-        self.assertEqual(lattice.nodes[2].time, 2.1)
-        self.assertEqual(lattice.nodes[3].time, 3.0)
-        self.assertEqual(lattice.nodes[3].word, 'wo rd')
-        self.assertEqual(lattice.nodes[4].time, 4.1)
-        self.assertEqual(lattice.nodes[4].word, 'word')
+        lattice._num_nodes = 5
+        lattice._num_links = 4
+        lattice._read_slf_body(['I=0',
+                                'I=1 t=1.0',
+                                'I=2 time=2.1',
+                                'I=3 t=3.0 WORD="wo rd"',
+                                'I=4 time=4.1 W=word',
+                                'J=0 S=0 E=1',
+                                'J=1 S=1 E=2',
+                                'J=2 S=2 E=3',
+                                'J=3 S=3 E=4'])
+
+        self.assertTrue(math.isnan(lattice.node_times[0]))
+        self.assertEqual(lattice.node_times[1], 1.0)
+        self.assertEqual(lattice.node_times[2], 2.1)
+        self.assertEqual(lattice.node_times[3], 3.0)
+        self.assertEqual(lattice.node_times[4], 4.1)
+        # The node words are moved to the links leading to the nodes.
+        self.assertEqual(lattice.link_words, [None, None, 'wo rd', 'word'])
 
     def test_read_slf_link(self):
         lattice = SLFLattice(None)
-        lattice.nodes = [Lattice.Node(id) for id in range(4)]
-        lattice.links = []
-        lattice._read_slf_node(0, ['t=0.0'])
-        lattice._read_slf_node(1, ['t=1.0'])
-        lattice._read_slf_node(2, ['t=2.0'])
-        lattice._read_slf_node(3, ['t=3.0'])
-        lattice._read_slf_link(0, ['START=0', 'END=1'])
-        lattice._read_slf_link(1, ['S=1', 'E=2', 'WORD=wo rd', 'acoustic=-0.1', 'language=-0.2'])
-        lattice._read_slf_link(2, ['S=2', 'E=3', 'W=word', 'a=-0.3', 'l=-0.4'])
-        lattice._read_slf_link(3, ['S=1', 'E=3', 'a=-0.5', 'l=-0.6'])
-
-        self.assertTrue(lattice.links[0].start_node is lattice.nodes[0])
-        self.assertTrue(lattice.links[0].end_node is lattice.nodes[1])
-        self.assertTrue(lattice.links[1].start_node is lattice.nodes[1])
-        self.assertTrue(lattice.links[1].end_node is lattice.nodes[2])
-        self.assertEqual(lattice.links[1].word, 'wo rd')
-        self.assertEqual(lattice.links[1].ac_logprob, -0.1)
-        self.assertEqual(lattice.links[1].lm_logprob, -0.2)
-        self.assertTrue(lattice.links[2].start_node is lattice.nodes[2])
-        self.assertTrue(lattice.links[2].end_node is lattice.nodes[3])
-        self.assertEqual(lattice.links[2].word, 'word')
-        self.assertEqual(lattice.links[2].ac_logprob, -0.3)
-        self.assertEqual(lattice.links[2].lm_logprob, -0.4)
-        self.assertTrue(lattice.links[3].start_node is lattice.nodes[1])
-        self.assertTrue(lattice.links[3].end_node is lattice.nodes[3])
-        self.assertEqual(lattice.links[3].ac_logprob, -0.5)
-        self.assertEqual(lattice.links[3].lm_logprob, -0.6)
+        lattice._num_nodes = 4
+        lattice._num_links = 4
+        lattice._read_slf_body(['I=0 t=0.0',
+                                'I=1 t=1.0',
+                                'I=2 t=2.0',
+                                'I=3 t=3.0',
+                                'J=0 START=0 END=1',
+                                'J=1 S=1 E=2 WORD="wo rd" acoustic=-0.1 '
+                                'language=-0.2',
+                                'J=2 S=2 E=3 W=word a=-0.3 l=-0.4',
+                                'J=3 S=1 E=3 a=-0.5 l=-0.6'])
+
+        self.assertEqual(lattice.link_start_ids.tolist(), [0, 1, 2, 1])
+        self.assertEqual(lattice.link_end_ids.tolist(), [1, 2, 3, 3])
+        self.assertEqual(lattice.link_words, [None, 'wo rd', 'word', None])
+        self.assertTrue(math.isnan(lattice.link_ac_logprobs[0]))
+        self.assertTrue(math.isnan(lattice.link_lm_logprobs[0]))
+        assert_almost_equal(lattice.link_ac_logprobs[1:], [-0.1, -0.3, -0.5])
+        assert_almost_equal(lattice.link_lm_logprobs[1:], [-0.2, -0.4, -0.6])
+        self.assertEqual(lattice._initial_node_id, 0)
+        self.assertEqual(lattice._final_node_ids, [3])
 
+        lattice._create_objects()
         self.assertEqual(len(lattice.nodes[0].in_links), 0)
         self.assertEqual(len(lattice.nodes[0].out_links), 1)
         self.assertEqual(len(lattice.nodes[1].in_links), 1)
@@ -123,27 +229,25 @@ class TestLattice(unittest.TestCase):
 
     def test_move_words_to_links(self):
         lattice = SLFLattice(None)
-        lattice.nodes = [Lattice.Node(id) for id in range(5)]
-        lattice.nodes[0].word = 'A'
-        lattice.nodes[1].word = 'B'
-        lattice.nodes[2].word = 'C'
-        lattice.nodes[3].word = 'D'
-        lattice.nodes[4].word = 'E'
-        lattice.initial_node = lattice.nodes[0]
-        lattice.final_node = lattice.nodes[4]
-        lattice._add_link(lattice.nodes[0], lattice.nodes[1])
-        lattice._add_link(lattice.nodes[0], lattice.nodes[2])
-        lattice._add_link(lattice.nodes[1], lattice.nodes[3])
-        lattice._add_link(lattice.nodes[2], lattice.nodes[3])
-        lattice._add_link(lattice.nodes[3], lattice.nodes[4])
-        lattice._move_words_to_links()
-        self.assertEqual(lattice.links[0].word, 'B')
-        self.assertEqual(lattice.links[1].word, 'C')
-        self.assertEqual(lattice.links[2].word, 'D')
-        self.assertEqual(lattice.links[3].word, 'D')
-        self.assertEqual(lattice.links[4].word, 'E')
-        for node in lattice.nodes:
-            self.assertFalse(hasattr(node, 'word'))
+        lattice._num_nodes = 5
+        lattice._num_links = 5
+        lattice._read_slf_body(['I=0 W=A',
+                                'I=1 W=B',
+                                'I=2 W=C',
+                                'I=3 W=D',
+                                'I=4 W=E',
+                                'J=0 S=0 E=1',
+                                'J=1 S=0 E=2',
+                                'J=2 S=1 E=3',
+                                'J=3 S=2 E=3',
+                                'J=4 S=3 E=4'])
+        self.assertEqual(lattice.link_words, ['B', 'C', 'D', 'D', 'E'])
+
+        lattice = SLFLattice(None)
+        lattice._num_nodes = 2
+        lattice._num_links = 1
+        with self.assertRaises(InputError):
+            lattice._read_slf_body(['I=0', 'I=1 W=B', 'J=0 S=0 E=1 W=B'])
 
     def test_sorted_nodes(self):
         lattice = Lattice()
@@ -185,6 +289,13 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(sorted_nodes[7].id, 7)
         self.assertEqual(sorted_nodes[8].id, 8)
 
+        sorted_nodes, positions, times = lattice.sorted_nodes(True)
+        for position, node in enumerate(sorted_nodes):
+            self.assertEqual(positions[node.id], position)
+        self.assertEqual(list(times[:7]), [0.0, 1.0, 2.0, 3.0, 4.0, 4.0, 5.0])
+        self.assertTrue(math.isnan(times[7]))
+        self.assertEqual(times[8], -1.0)
+
         with open(self.slf_path, 'r') as lattice_file:
             lattice = SLFLattice(lattice_file)
 
@@ -210,6 +321,262 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(word_to_id['a'], 2)
         self.assertEqual(word_to_id['to'], 13)
 
+    def test_read_slf_arrays(self):
+        lines = ['UTTERANCE="utterance 1"',
+                 'base=10.0',
+                 'N=4 L=4',
+                 'I=0 t=0.0',
+                 'I=1 t=1.0 W=!NULL',
+                 'I=2 t=2.0 W="wo rd"',
+                 'I=3 W=word  # comment',
+                 'J=0 S=0 E=1 a=-1.0 l=-2.0',
+                 'J=1 S=1 E=2 a=-3.0',
+                 'J=2 S=1 E=3',
+                 'J=3 S=2 E=3 l=-4.0']
+        lattice = SLFLattice(lines, objects=False)
+        self.assertEqual(lattice.utterance_id, 'utterance 1')
+        self.assertEqual(len(lattice.nodes), 0)
+        self.assertEqual(list(lattice.node_times[:3]), [0.0, 1.0, 2.0])
+        self.assertTrue(math.isnan(lattice.node_times[3]))
+        self.assertEqual(list(lattice.link_start_ids), [0, 1, 1, 2])
+        self.assertEqual(list(lattice.link_end_ids), [1, 2, 3, 3])
+        self.assertEqual(lattice.link_words, [None, 'wo rd', 'word', 'word'])
+        self.assertAlmostEqual(lattice.link_ac_logprobs[1],
+                               -3.0 * math.log(10.0), places=4)
+        self.assertTrue(math.isnan(lattice.link_ac_logprobs[3]))
+        self.assertAlmostEqual(lattice.link_lm_logprobs[3],
+                               -4.0 * math.log(10.0), places=4)
+
+        lattice = SLFLattice(lines)
+        self.assertEqual(len(lattice.nodes), 4)
+        self.assertEqual(len(lattice.links), 4)
+        self.assertIs(lattice.initial_node, lattice.nodes[0])
+        self.assertTrue(lattice.nodes[3].final)
+        self.assertIsNone(lattice.nodes[3].time)
+        self.assertEqual(lattice.links[1].word, 'wo rd')
+        self.assertIsNone(lattice.links[1].lm_logprob)
+        self.assertIsNone(lattice.links[2].ac_logprob)
+
+    def test_columnar_lattice(self):
+        with open(self.slf_path, 'r') as slf_file:
+            lattice = SLFLattice(slf_file)
+        columnar = lattice.to_columnar()
+        self.assertIs(columnar.to_columnar(), columnar)
+        self.assertEqual(columnar.num_nodes, 24)
+        self.assertEqual(columnar.num_links, 39)
+        self.assertEqual(columnar.utterance_id, 'utterance 123')
+        self.assertEqual(columnar.initial_node_id, lattice.initial_node.id)
+
+        # Arrays created from the objects are identical to the arrays that
+        # were parsed from the file.
+        converted = ColumnarLattice.from_lattice(lattice)
+        self.assertEqual(list(converted.link_start_ids),
+                         list(columnar.link_start_ids))
+        self.assertEqual(list(converted.link_end_ids),
+                         list(columnar.link_end_ids))
+        self.assertEqual(converted.link_words(), columnar.link_words())
+        self.assertEqual(list(converted.node_final), list(columnar.node_final))
+
+        for node in lattice.nodes:
+            out_link_ids = columnar.out_link_ids[
+                columnar.out_offsets[node.id]:columnar.out_offsets[node.id + 1]]
+            self.assertEqual([lattice.links[link_id] for link_id in out_link_ids],
+                             node.out_links)
+            in_link_ids = columnar.in_link_ids[
+                columnar.in_offsets[node.id]:columnar.in_offsets[node.id + 1]]
+            self.assertEqual([lattice.links[link_id] for link_id in in_link_ids],
+                             node.in_links)
+
+        sorted_ids, positions, times = columnar.sorted_node_ids(True)
+        sorted_nodes, expected_positions, expected_times = \
+            lattice.sorted_nodes(True)
+        self.assertEqual(sorted_ids, [node.id for node in sorted_nodes])
+        self.assertEqual(list(positions), list(expected_positions))
+        self.assertEqual(list(times), list(expected_times))
+
+        # The object view is created on demand and writes the same lattice.
+        self.assertIsNone(columnar._nodes)
+        self._assert_lattice_is_correct(columnar)
+        expected = StringIO()
+        lattice.write_slf(expected)
+        result = StringIO()
+        columnar.write_slf(result)
+        self.assertEqual(result.getvalue(), expected.getvalue())
+
+        with open(self.wordmap_path, 'r') as wordmap_file:
+            word_to_id = read_kaldi_vocabulary(wordmap_file)
+        id_to_word = [None] * len(word_to_id)
+        for word, id in word_to_id.items():
+            id_to_word[id] = word
+        with open(self.lat_path, 'r') as lat_file:
+            lattice = KaldiLattice(lat_file.readlines(), id_to_word)
+        columnar = lattice.to_columnar()
+        self.assertEqual(columnar.link_transitions,
+                         [link.transitions for link in lattice.links])
+        expected = StringIO()
+        lattice.write_kaldi(expected, word_to_id)
+        result = StringIO()
+        columnar.write_kaldi(result, word_to_id)
+        self.assertEqual(result.getvalue(), expected.getvalue())
+
+    def test_write_columnar(self):
+        nan = float('nan')
+        lattice = ColumnarLattice([0.0, nan, 2.5, 3.0],
+                                  [0, 0, 1, 2, 1],
+                                  [1, 2, 2, 3, 3],
+                                  ['a', None, 'b', '</s>', 'c'],
+                                  [-1.5, nan, -0.0, 0.0, -2.0],
+                                  [-0.5, -1.0, -2.0, 0.0, -3.0],
+                                  0, [3],
+                                  ['1_2', '', '3', '', '4'])
+        lattice.utterance_id = 'utt'
+        lattice.lm_scale = 10.0
+        output = StringIO()
+        lattice.write_slf(output)
+        self.assertEqual(output.getvalue(),
+                         '# Header (generated by TheanoLM)\n'
+                         'VERSION=1.1\n'
+                         'UTTERANCE="utt"\n'
+                         'lmscale=10.0\n'
+                         'start=0\n'
+                         'N=4\tL=5\n'
+                         '# Nodes\n'
+                         'I=0\tt=0.0\n'
+                         'I=1\n'
+                         'I=2\tt=2.5\n'
+                         'I=3\tt=3.0\n'
+                         '# Links\n'
+                         'J=0\tS=0\tE=1\tW=a\ta=-1.5\tl=-0.5\n'
+                         'J=1\tS=0\tE=2\tW=!NULL\tl=-1.0\n'
+                         'J=2\tS=1\tE=2\tW=b\ta=0.0\tl=-2.0\n'
+                         'J=3\tS=2\tE=3\tW=</s>\ta=0.0\tl=0.0\n'
+                         'J=4\tS=1\tE=3\tW=c\ta=-2.0\tl=-3.0\n')
+
+        lattice.link_ac_logprobs[1] = 0.0
+        word_to_id = {'<eps>': 0, 'a': 1, 'b': 2, 'c': 3}
+        output = StringIO()
+        lattice.write_kaldi(output, word_to_id)
+        self.assertEqual(output.getvalue(),
+                         'utt\n'
+                         '0 1 1 0.5,1.5,1_2\n'
+                         '0 2 0 1.0,0.0,\n'
+                         '1 2 2 2.0,0.0,3\n'
+                         '1 3.0,2.0,4\n'
+                         '2 0.0,0.0,\n'
+                         '\n')
+
+    def test_pruned(self):
+        lattice = ColumnarLattice([0.0, 1.0, 2.0],
+                                  [0, 0, 0, 1],
+                                  [1, 1, 2, 2],
+                                  ['a', 'b', 'c', 'd'],
+                                  [math.log(0.7), math.log(0.2), math.log(0.1),
+                                   0.0],
+                                  [0.0, 0.0, 0.0, 0.0],
+                                  0, [2])
+        pruned = lattice.pruned(1.0, 0.0, threshold=0.15)
+        self.assertEqual(pruned.link_words(), ['a', 'b', 'd'])
+        pruned = lattice.pruned(1.0, 0.0, threshold=0.5)
+        self.assertEqual(pruned.link_words(), ['a', 'd'])
+        pruned = lattice.pruned(1.0, 0.0, beam=1.5)
+        self.assertEqual(pruned.link_words(), ['a', 'b', 'd'])
+        pruned = lattice.pruned(1.0, 0.0, beam=0.0)
+        self.assertEqual(pruned.link_words(), ['a', 'd'])
+        self.assertEqual(pruned.num_nodes, 3)
+        # The direct link is kept, when the other links are removed.
+        pruned = lattice.pruned(1.0, -10.0, beam=1.5)
+        self.assertEqual(pruned.link_words(), ['c'])
+        self.assertEqual(pruned.num_nodes, 2)
+        self.assertEqual(list(pruned.node_final), [False, True])
+        # No link has posterior probability higher than 0.95.
+        pruned = lattice.pruned(1.0, 0.0, threshold=0.95)
+        self.assertEqual(pruned.num_links, 4)
+
+        with open(self.slf_path, 'r') as slf_file:
+            lattice = SLFLattice(slf_file)
+        pruned = lattice.pruned(lattice.lm_scale, lattice.wi_penalty,
+                                beam=1e9)
+        self.assertEqual(pruned.num_links, 39)
+        pruned = lattice.pruned(lattice.lm_scale, lattice.wi_penalty,
+                                beam=0.0)
+        self.assertEqual(pruned.link_words(),
+                         [None, 'it', "didn't", 'elaborate', None])
+
+    def test_without_null_links(self):
+        nan = float('nan')
+        # 0 -<eps>-> 1 -a-> 3 -<eps>-> 4 (final)
+        # 0 -<eps>-> 2 -a-> 3
+        # 0 -b-> 4
+        lattice = ColumnarLattice([0.0, 0.0, 0.0, 1.0, 2.0],
+                                  [0, 0, 1, 2, 3, 0],
+                                  [1, 2, 3, 3, 4, 4],
+                                  [None, None, 'a', 'a', None, 'b'],
+                                  [-1.0, -2.0, -3.0, -3.0, 0.0, -4.0],
+                                  [-0.5, nan, -1.0, -1.0, nan, -2.0],
+                                  0, [4],
+                                  ['1', '2', '3', '4', '', '5'])
+        result = lattice.without_null_links(1.0)
+        self.assertEqual(result.num_nodes, 3)
+        self.assertEqual(result.link_words(), ['a', 'b'])
+        assert_almost_equal(result.link_ac_logprobs, [-4.0, -4.0])
+        assert_almost_equal(result.link_lm_logprobs, [-1.5, -2.0])
+        self.assertEqual(result.link_transitions, ['1_3', '5'])
+        self.assertEqual(list(result.node_final), [False, True, True])
+
+        # A null link with nonzero log probability to a final node is kept.
+        lattice.link_ac_logprobs[4] = -1.0
+        result = lattice.without_null_links(1.0)
+        self.assertEqual(result.num_nodes, 3)
+        self.assertEqual(result.link_words(), ['a', 'b', None])
+        self.assertEqual(list(result.node_final), [False, False, True])
+
+        with open(self.slf_path, 'r') as slf_file:
+            lattice = SLFLattice(slf_file)
+        result = lattice.to_columnar().without_null_links(lattice.lm_scale)
+        self.assertEqual(result.num_nodes, 20)
+        self.assertEqual(result.num_links, 34)
+        self.assertEqual(sorted(result.sorted_node_ids()),
+                         list(range(result.num_nodes)))
+
+    def test_write_columnar_as_baseline(self):
+        nan = float('nan')
+        # The scores are stored as logprob_type. The values can't be
+        # represented exactly in float32, which would show up as extra digits
+        # if they were formatted as Python floats.
+        lattice = ColumnarLattice([0.0, 0.1, nan, 2.3, 3.0],
+                                  [0, 0, 1, 2, 1, 3],
+                                  [1, 2, 2, 3, 3, 4],
+                                  ['a', None, 'b', 'c', 'a', '</s>'],
+                                  [-0.1, nan, -0.0, -1.2345678, -2.7, 0.0],
+                                  [-0.3, -1.1, -2.0, nan, -3.3333, -0.0],
+                                  0, [4],
+                                  ['1_2', '', '3', '4_5_6', '7', ''])
+        lattice.utterance_id = 'utt'
+        lattice.lm_scale = logprob_type(10.0)
+        lattice.wi_penalty = logprob_type(-0.7)
+        expected = StringIO()
+        _baseline_write_slf(lattice, expected)
+        result = StringIO()
+        lattice.write_slf(result)
+        self.assertEqual(result.getvalue(), expected.getvalue())
+
+        lattice.link_ac_logprobs[1] = logprob_type(-0.6)
+        lattice.link_lm_logprobs[3] = logprob_type(-4.1)
+        word_to_id = {'<eps>': 0, 'a': 1, 'b': 2, 'c': 3}
+        expected = StringIO()
+        _baseline_write_kaldi(lattice, expected, word_to_id)
+        result = StringIO()
+        lattice.write_kaldi(result, word_to_id)
+        self.assertEqual(result.getvalue(), expected.getvalue())
+
+        # float32 values are formatted like float32 scalars, regardless of
+        # logprob_type.
+        values = numpy.array([-0.1, nan, 1.2345678], dtype='float32')
+        lines = ColumnarLattice._format_lines([("l={}", values)])
+        self.assertEqual(lines, ["l={}".format(values[0]),
+                                 "",
+                                 "l={}".format(values[2])])
+
     def test_slf_to_kaldi(self):
         with open(self.wordmap_path, 'r') as wordmap_file:
             word_to_id = read_kaldi_vocabulary(wordmap_file)
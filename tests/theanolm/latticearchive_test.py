@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+from io import StringIO
+
+import numpy
+from numpy.testing import assert_equal
+
+from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.kaldilattice import KaldiLattice, read_kaldi_vocabulary
+from theanolm.scoring.latticearchive import LatticeArchive
+from theanolm.scoring.latticebatch import LatticeBatch
+
+class TestLatticeArchive(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        self.slf_path = os.path.join(script_path, 'lattice.slf')
+        self.lat_path = os.path.join(script_path, 'lattice.lat')
+        wordmap_path = os.path.join(script_path, 'words.txt')
+        with open(wordmap_path, 'r') as wordmap_file:
+            self.word_to_id = read_kaldi_vocabulary(wordmap_file)
+        self.id_to_word = [None] * len(self.word_to_id)
+        for word, id in self.word_to_id.items():
+            self.id_to_word[id] = word
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.archive_path = os.path.join(self.temp_dir.name, 'lattices.h5')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_write_read(self):
+        with open(self.slf_path, 'r') as slf_file:
+            slf_lattice = SLFLattice(slf_file)
+        slf_lattice.utterance_id = 'slf'
+        slf_lattice.lm_scale = 2.0
+        with open(self.lat_path, 'r') as lat_file:
+            kaldi_lattice = KaldiLattice(lat_file.readlines(), self.id_to_word)
+        kaldi_lattice.utterance_id = 'kaldi'
+        LatticeArchive.write(self.archive_path, [slf_lattice, kaldi_lattice])
+
+        archive = LatticeArchive(self.archive_path)
+        self.assertEqual(len(archive), 2)
+        self.assertEqual(archive.utterance_ids, ['slf', 'kaldi'])
+        self.assertEqual(archive.index('kaldi'), 1)
+        self.assertEqual(len(archive.lattice_sizes()), 2)
+
+        lattice = archive['slf']
+        self.assertEqual(lattice.utterance_id, 'slf')
+        self.assertEqual(lattice.lm_scale, 2.0)
+        self.assertAlmostEqual(lattice.wi_penalty, slf_lattice.wi_penalty)
+        expected = slf_lattice.to_columnar()
+        assert_equal(lattice.node_times, expected.node_times)
+        assert_equal(lattice.link_start_ids, expected.link_start_ids)
+        assert_equal(lattice.link_lm_logprobs, expected.link_lm_logprobs)
+        self.assertEqual(lattice.link_words(), expected.link_words())
+        self.assertEqual(lattice.sorted_node_ids(),
+                         expected.sorted_node_ids())
+        expected_output = StringIO()
+        slf_lattice.write_slf(expected_output)
+        output = StringIO()
+        lattice.write_slf(output)
+        self.assertEqual(output.getvalue(), expected_output.getvalue())
+
+        lattice = archive[1]
+        self.assertEqual(lattice.utterance_id, 'kaldi')
+        expected_output = StringIO()
+        kaldi_lattice.write_kaldi(expected_output, self.word_to_id)
+        output = StringIO()
+        lattice.write_kaldi(output, self.word_to_id)
+        self.assertEqual(output.getvalue(), expected_output.getvalue())
+
+        with self.assertRaises(KeyError):
+            archive['missing']
+
+    def test_split_jobs(self):
+        lattices = []
+        for index in range(7):
+            with open(self.slf_path, 'r') as slf_file:
+                lattice = SLFLattice(slf_file)
+            lattice.utterance_id = str(index)
+            lattices.append(lattice)
+        LatticeArchive.write(self.archive_path, lattices)
+
+        utterance_ids = []
+        for job_id in range(3):
+            batch = LatticeBatch([self.archive_path], None, 'archive',
+                                 num_jobs=3, job_id=job_id)
+            job_utterance_ids = [lattice.utterance_id for lattice in batch]
+            self.assertTrue(2 <= len(job_utterance_ids) <= 3)
+            utterance_ids.extend(job_utterance_ids)
+        self.assertEqual(utterance_ids, [str(index) for index in range(7)])
+
+if __name__ == '__main__':
+    unittest.main()
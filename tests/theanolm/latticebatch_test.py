@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+import gzip
+import bz2
+from io import StringIO
+
+from theanolm.backend import InputError
+from theanolm.scoring.latticebatch import LatticeBatch, _read_kaldi_utterances
+
+class TestLatticeBatch(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        self.slf_path = os.path.join(script_path, 'lattice.slf')
+        self.lat_path = os.path.join(script_path, 'lattice.lat')
+        self.wordmap_path = os.path.join(script_path, 'words.txt')
+
+    def tearDown(self):
+        pass
+
+    def test_read_kaldi_utterances(self):
+        text = "utt1\n0 1 2 0.5,1.0,\n 1 0.0,0.0, \n\n \nutt2\n0 1\n\nutt3\n"
+        for chunk_size in [1, 3, 7, 1000]:
+            utterances = list(_read_kaldi_utterances(StringIO(text),
+                                                     chunk_size))
+            self.assertEqual(utterances,
+                             [['utt1', '0 1 2 0.5,1.0,', '1 0.0,0.0,'],
+                              ['utt2', '0 1'],
+                              ['utt3']])
+
+    def test_prefetch(self):
+        with open(self.lat_path, 'r') as lat_file:
+            lattice_text = lat_file.read().strip() + "\n\n"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archive_path = os.path.join(temp_dir, 'lattices.txt')
+            with open(archive_path, 'w') as archive_file:
+                for index in range(5):
+                    archive_file.write(
+                        lattice_text.replace('utterance 123', str(index)))
+
+            for prefetch in [0, 2]:
+                with open(self.wordmap_path, 'r') as wordmap_file:
+                    batch = LatticeBatch([archive_path], None, 'kaldi',
+                                         wordmap_file, prefetch=prefetch)
+                lattices = list(batch)
+                self.assertEqual([lattice.utterance_id for lattice in lattices],
+                                 [str(index) for index in range(5)])
+                for lattice in lattices:
+                    self.assertEqual(lattice.num_nodes, 24)
+                    self.assertEqual(lattice.num_links, 39)
+
+            with open(archive_path, 'a') as archive_file:
+                archive_file.write("invalid\n0 1 2\n")
+            with open(self.wordmap_path, 'r') as wordmap_file:
+                batch = LatticeBatch([archive_path], None, 'kaldi',
+                                     wordmap_file, prefetch=2)
+            with self.assertRaises(InputError):
+                list(batch)
+
+    def test_scp(self):
+        with open(self.lat_path, 'r') as lat_file:
+            lattice_text = lat_file.read().strip() + "\n\n"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archive_path = os.path.join(temp_dir, 'lattices.ark')
+            scp_path = os.path.join(temp_dir, 'lattices.scp')
+            data = b''
+            scp_lines = []
+            for index in range(5):
+                utterance_id = 'utt' + str(index)
+                text = lattice_text.replace('utterance 123\n',
+                                            utterance_id + ' \n')
+                offset = len(data) + len(utterance_id) + 1
+                scp_lines.append('{} {}:{}\n'.format(utterance_id,
+                                                      archive_path, offset))
+                data += text.encode('utf-8')
+            with open(archive_path, 'wb') as archive_file:
+                archive_file.write(data)
+            with open(scp_path, 'w') as scp_file:
+                # Reverse the order to check that the offsets are used.
+                scp_file.writelines(reversed(scp_lines))
+
+            utterance_ids = []
+            for job_id in range(2):
+                with open(self.wordmap_path, 'r') as wordmap_file:
+                    batch = LatticeBatch(['scp:' + scp_path], None, 'kaldi',
+                                         wordmap_file, num_jobs=2,
+                                         job_id=job_id)
+                for lattice in batch:
+                    self.assertEqual(lattice.num_nodes, 24)
+                    self.assertEqual(lattice.num_links, 39)
+                    utterance_ids.append(lattice.utterance_id)
+            self.assertEqual(utterance_ids,
+                             ['utt' + str(index) for index in range(4, -1, -1)])
+
+            for extension, open_func in [('.gz', gzip.open),
+                                         ('.bz2', bz2.open)]:
+                compressed_path = archive_path + extension
+                with open_func(compressed_path, 'wb') as compressed_file:
+                    compressed_file.write(data)
+                with open(self.wordmap_path, 'r') as wordmap_file:
+                    batch = LatticeBatch([compressed_path], None, 'kaldi',
+                                         wordmap_file)
+                self.assertEqual([lattice.utterance_id for lattice in batch],
+                                 ['utt' + str(index) for index in range(5)])
+
+                # Script files cannot refer to compressed archives.
+                with open(scp_path, 'w') as scp_file:
+                    scp_file.write('utt0 {}:5\n'.format(compressed_path))
+                with open(self.wordmap_path, 'r') as wordmap_file:
+                    with self.assertRaises(InputError):
+                        LatticeBatch(['scp:' + scp_path], None, 'kaldi',
+                                     wordmap_file)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@
 import unittest
 import math
 import os
+from types import SimpleNamespace
 
 import numpy
 from numpy.testing import assert_equal, assert_almost_equal
@@ -12,9 +13,8 @@ from theano import tensor
 
 from theanolm import Vocabulary
 from theanolm.network import RecurrentState
-from theanolm.scoring import LatticeDecoder
+from theanolm.scoring import LatticeDecoder, RescoredLattice
 from theanolm.scoring.slflattice import SLFLattice
-from theanolm.scoring.lattice import Lattice
 
 class DummyNetwork(object):
     """A dummy network for testing the lattice decoder that always outputs
@@ -43,14 +43,25 @@ class DummyNetwork(object):
                                 ndim=2)
         return result
 
+    def output_probs(self):
+        num_time_steps = self.input_word_ids.shape[0]
+        num_sequences = self.input_word_ids.shape[1]
+        vocabulary_size = self.projection_vector.shape[0]
+        result = self.projection_vector[self.input_word_ids.flatten()]
+        result = result.dimshuffle(0, 'x') + \
+                 self.projection_vector.dimshuffle('x', 0)
+        result = result.reshape([num_time_steps,
+                                 num_sequences,
+                                 vocabulary_size],
+                                ndim=3)
+        return result
+
 class DummyLatticeDecoder(LatticeDecoder):
     def __init__(self):
-        self._sorted_nodes = [Lattice.Node(id) for id in range(5)]
-        self._sorted_nodes[0].time = 0.0
-        self._sorted_nodes[1].time = 1.0
-        self._sorted_nodes[2].time = 1.0
-        self._sorted_nodes[3].time = None
-        self._sorted_nodes[4].time = 3.0
+        self._sorted_nodes = list(range(5))
+        times = numpy.array([0.0, 1.0, 1.0, numpy.nan, 3.0])
+        self._best_logprobs = \
+            LatticeDecoder.BestLogprobIndex(numpy.arange(5), times)
         self._tokens = [[LatticeDecoder.Token()],
                         [LatticeDecoder.Token()],
                         [LatticeDecoder.Token(), LatticeDecoder.Token(), LatticeDecoder.Token()],
@@ -58,20 +69,20 @@ class DummyLatticeDecoder(LatticeDecoder):
                         []]
         self._tokens[0][0].total_logprob = -10.0
         self._tokens[0][0].recombination_hash = 1
-        self._sorted_nodes[0].best_logprob = -10.0
+        self._best_logprobs.update(0, -10.0)
         self._tokens[1][0].total_logprob = -20.0
         self._tokens[1][0].recombination_hash = 1
-        self._sorted_nodes[1].best_logprob = -20.0
+        self._best_logprobs.update(1, -20.0)
         self._tokens[2][0].total_logprob = -30.0
         self._tokens[2][0].recombination_hash = 1
         self._tokens[2][1].total_logprob = -50.0
         self._tokens[2][1].recombination_hash = 2
         self._tokens[2][2].total_logprob = -70.0
         self._tokens[2][2].recombination_hash = 3
-        self._sorted_nodes[2].best_logprob = -30.0
+        self._best_logprobs.update(2, -30.0)
         self._tokens[3][0].total_logprob = -100.0
         self._tokens[3][0].recombination_hash = 1
-        self._sorted_nodes[3].best_logprob = -100.0
+        self._best_logprobs.update(3, -100.0)
         self._prune_extra_limit = None
         self._abs_min_beam = 0
         self._abs_min_max_tokens = 0
@@ -140,6 +151,29 @@ class TestLatticeDecoder(unittest.TestCase):
         token2.history = token2.history + (4,)
         self.assertSequenceEqual(token1.history, (1, 2, 3))
         self.assertSequenceEqual(token2.history, (1, 2, 3, 4))
+        # The histories share the common prefix.
+        self.assertIs(token2.history.parent, token1.history)
+
+    def test_history(self):
+        history1 = LatticeDecoder.History.from_sequence((1, 2, 3))
+        history2 = LatticeDecoder.History(4, history1)
+        history3 = LatticeDecoder.History.from_sequence((1, 2, 3, 4))
+        self.assertEqual(len(history2), 4)
+        self.assertEqual(history2[0], 1)
+        self.assertEqual(history2[-1], 4)
+        self.assertEqual(history2[-2], 3)
+        self.assertEqual(history2[-2:], (3, 4))
+        self.assertEqual(history2[:-1], (1, 2, 3))
+        self.assertEqual(history2.suffix(10), (1, 2, 3, 4))
+        self.assertEqual(list(history2), [1, 2, 3, 4])
+        self.assertEqual(history2, history3)
+        self.assertEqual(hash(history2), hash(history3))
+        self.assertNotEqual(history1, history3)
+        self.assertSequenceEqual(history2, (1, 2, 3, 4))
+        # A history is not equal to a tuple, since the hashes differ.
+        self.assertNotEqual(history2, (1, 2, 3, 4))
+        with self.assertRaises(IndexError):
+            history2[4]
 
     def test_recompute_hash(self):
         token1 = LatticeDecoder.Token(history=(1, 12, 203, 3004, 23455))
@@ -198,7 +232,7 @@ class TestLatticeDecoder(unittest.TestCase):
         # ln(exp(-1000) * (0.75 * exp(-1002) + 0.25 * exp(-1001)))
         assert_almost_equal(token.total_logprob, -2001.64263, decimal=4)
 
-    def test_append_word(self):
+    def test_append_words_shortlist(self):
         decoding_options = {
             'nnlm_weight': 1.0,
             'lm_scale': 1.0,
@@ -212,33 +246,35 @@ class TestLatticeDecoder(unittest.TestCase):
             'recombination_order': None,
         }
 
+        decoder = LatticeDecoder(self.network, decoding_options)
+        state_pool = decoder._state_pool
         initial_state = RecurrentState(self.network.recurrent_state_size)
+        initial_state = state_pool.add(initial_state)[0]
         token1 = LatticeDecoder.Token(history=(self.sos_id,), state=initial_state)
         token2 = LatticeDecoder.Token(history=(self.sos_id, self.yksi_id), state=initial_state)
-        decoder = LatticeDecoder(self.network, decoding_options)
 
         self.assertSequenceEqual(token1.history, (self.sos_id,))
         self.assertSequenceEqual(token2.history, (self.sos_id, self.yksi_id))
-        assert_equal(token1.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
-        assert_equal(token2.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(state_pool.get([token1.state]).get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(state_pool.get([token2.state]).get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
         self.assertEqual(token1.nn_lm_logprob, 0.0)
         self.assertEqual(token2.nn_lm_logprob, 0.0)
 
-        decoder._append_word([token1, token2], self.kaksi_id)
+        decoder._append_words([token1, token2], [self.kaksi_id, self.kaksi_id], [None, None])
         self.assertSequenceEqual(token1.history, (self.sos_id, self.kaksi_id))
         self.assertSequenceEqual(token2.history, (self.sos_id, self.yksi_id, self.kaksi_id))
-        assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
-        assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(state_pool.get([token1.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(state_pool.get([token2.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
         token1_nn_lm_logprob = math.log(self.sos_prob + self.kaksi_prob)
         token2_nn_lm_logprob = math.log(self.yksi_prob + self.kaksi_prob)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
-        decoder._append_word([token1, token2], self.eos_id)
+        decoder._append_words([token1, token2], [self.eos_id, self.eos_id], [None, None])
         self.assertSequenceEqual(token1.history, (self.sos_id, self.kaksi_id, self.eos_id))
         self.assertSequenceEqual(token2.history, (self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id))
-        assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
-        assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
+        assert_equal(state_pool.get([token1.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
+        assert_equal(state_pool.get([token2.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
         token1_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
         token2_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
@@ -252,7 +288,8 @@ class TestLatticeDecoder(unittest.TestCase):
 
         decoding_options['use_shortlist'] = True
         decoder = LatticeDecoder(self.network, decoding_options)
-        decoder._append_word([token1, token2], self.oos1_id)
+        decoder._state_pool = state_pool
+        decoder._append_words([token1, token2], [self.oos1_id, self.oos1_id], [None, None])
         self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id, self.eos_id, self.oos1_id])
         self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id, self.oos1_id])
         token1_nn_lm_logprob += math.log((self.eos_prob + self.unk_prob) / 3)
@@ -260,7 +297,7 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
-        decoder._append_word([token1, token2], self.oos2_id)
+        decoder._append_words([token1, token2], [self.oos2_id, self.oos2_id], [None, None])
         self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id, self.eos_id, self.oos1_id, self.oos2_id])
         self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id, self.oos1_id, self.oos2_id])
         token1_nn_lm_logprob += math.log((self.unk_prob + self.unk_prob) / 3 * 2)
@@ -268,6 +305,80 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
+    def test_append_words(self):
+        decoding_options = {
+            'nnlm_weight': 1.0,
+            'lm_scale': 1.0,
+            'wi_penalty': 0.0,
+            'unk_penalty': 0.0,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': False,
+            'max_tokens_per_node': 10,
+            'beam': None,
+            'recombination_order': None,
+        }
+        decoder = LatticeDecoder(self.network, decoding_options)
+
+        initial_state = RecurrentState(self.network.recurrent_state_size)
+        initial_state = decoder._state_pool.add(initial_state)[0]
+        token = LatticeDecoder.Token(history=(self.sos_id,), state=initial_state)
+        tokens = [LatticeDecoder.Token.copy(token) for _ in range(3)]
+        decoder._append_words(tokens,
+                              [self.yksi_id, self.kaksi_id, self.eos_id],
+                              [None, None, None])
+        self.assertSequenceEqual(tokens[0].history, (self.sos_id, self.yksi_id))
+        self.assertSequenceEqual(tokens[1].history, (self.sos_id, self.kaksi_id))
+        self.assertSequenceEqual(tokens[2].history, (self.sos_id, self.eos_id))
+        # The state is advanced only once for tokens copied from the same token.
+        self.assertEqual(tokens[0].state, tokens[1].state)
+        self.assertEqual(tokens[0].state, tokens[2].state)
+        self.assertEqual(len(decoder._state_pool), 2)
+        assert_equal(decoder._state_pool.get([tokens[0].state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        self.assertAlmostEqual(tokens[0].nn_lm_logprob,
+                               math.log(self.sos_prob + self.yksi_prob))
+        self.assertAlmostEqual(tokens[1].nn_lm_logprob,
+                               math.log(self.sos_prob + self.kaksi_prob))
+        self.assertAlmostEqual(tokens[2].nn_lm_logprob,
+                               math.log(self.sos_prob + self.eos_prob))
+
+    def test_best_logprob_index(self):
+        decoder = DummyLatticeDecoder()
+        nodes = decoder._sorted_nodes
+        index = decoder._best_logprobs
+        self.assertEqual(index.best_logprob(nodes[0]), -10.0)
+        self.assertEqual(index.best_logprob(nodes[1]), -20.0)
+        self.assertEqual(index.best_logprob(nodes[2]), -20.0)
+        self.assertEqual(index.best_logprob(nodes[3]), -100.0)
+        self.assertEqual(index.best_logprob(nodes[4]), -numpy.inf)
+        index.update(nodes[4], -50.0)
+        self.assertEqual(index.best_logprob(nodes[3]), -50.0)
+        self.assertEqual(index.best_logprob(nodes[4]), -50.0)
+        index.update(nodes[4], -60.0)
+        self.assertEqual(index.best_logprob(nodes[4]), -50.0)
+        index.update(nodes[2], -15.0)
+        self.assertEqual(index.best_logprob(nodes[1]), -15.0)
+        self.assertEqual(index.best_logprob(nodes[0]), -10.0)
+
+    def test_recombination_indices(self):
+        logprobs = numpy.array([-5.0, -1.0, -3.0, -1.0, -2.0])
+        hashes = numpy.array([7, 8, 7, 9, 8])
+        kept, dropped, dropped_to_kept = \
+            LatticeDecoder._recombination_indices(logprobs, hashes)
+        assert_equal(kept, [1, 3, 2])
+        assert_equal(dropped, [4, 0])
+        assert_equal(dropped_to_kept, [1, 2])
+
+        decoder = DummyLatticeDecoder()
+        tokens = decoder._tokens[2]
+        tokens[1].recombination_hash = 1
+        recomb_tokens = []
+        new_tokens = decoder._sorted_recombined_tokens(tokens, recomb_tokens)
+        self.assertEqual(new_tokens, [tokens[0], tokens[2]])
+        self.assertEqual(len(recomb_tokens), 1)
+        self.assertIs(recomb_tokens[0][0], tokens[1])
+        self.assertIs(recomb_tokens[0][1], tokens[0].history)
+
     def test_prune(self):
         # token recombination
         decoder = DummyLatticeDecoder()
@@ -334,6 +445,68 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
+    def _window_search(self, node_windows, node_logprobs):
+        tokens = []
+        for logprobs in node_logprobs:
+            node_tokens = []
+            for logprob in logprobs:
+                token = LatticeDecoder.Token()
+                token.total_logprob = logprob
+                node_tokens.append(token)
+            tokens.append(node_tokens)
+        return SimpleNamespace(node_windows=node_windows,
+                               window_logprobs=dict(),
+                               tokens=tokens)
+
+    def test_prune_window(self):
+        decoder = DummyLatticeDecoder()
+        decoder._max_tokens_per_window = 3
+        search = self._window_search([0, 0, 1, None],
+                                     [[-1.0, -2.0],
+                                      [-1.5, -3.0, -4.0, -5.0],
+                                      [-1.0, -2.0, -3.0, -4.0],
+                                      [-1.0, -2.0, -3.0, -4.0, -5.0]])
+        expected_tokens = [list(node_tokens) for node_tokens in search.tokens]
+        stats = [dict() for _ in range(4)]
+        for node_id in [0, 1, 2, 3]:
+            decoder._prune_window(node_id, search, stats[node_id])
+        self.assertEqual(search.tokens[0], expected_tokens[0])
+        self.assertEqual(search.tokens[1], expected_tokens[1][:1])
+        self.assertEqual(search.tokens[2], expected_tokens[2][:3])
+        self.assertEqual(search.tokens[3], expected_tokens[3])
+        self.assertEqual([x.get('after-window') for x in stats],
+                         [2, 1, 3, None])
+        self.assertEqual(sorted(search.window_logprobs[0]), [-2.0, -1.5, -1.0])
+        self.assertEqual(sorted(search.window_logprobs[1]), [-3.0, -2.0, -1.0])
+
+    def test_prune_window_better_later_node(self):
+        decoder = DummyLatticeDecoder()
+        decoder._max_tokens_per_window = 3
+        # The tokens of the later nodes are better than those of the first
+        # node, which uses up the count of the window.
+        search = self._window_search([0, 0, 0],
+                                     [[-10.0, -11.0, -12.0, -13.0],
+                                      [-1.0, -2.0, -3.0],
+                                      [-2.5, -20.0]])
+        expected_tokens = [list(node_tokens) for node_tokens in search.tokens]
+        stats = [dict() for _ in range(3)]
+        for node_id in [0, 1, 2]:
+            decoder._prune_window(node_id, search, stats[node_id])
+        self.assertEqual(search.tokens[0], expected_tokens[0][:3])
+        self.assertEqual(search.tokens[1], expected_tokens[1])
+        self.assertEqual(search.tokens[2], expected_tokens[2][:1])
+        self.assertEqual(sorted(search.window_logprobs[0]), [-2.5, -2.0, -1.0])
+
+        # Tokens that arrive at a node in the window are dropped if they are
+        # below the threshold, except for the best one.
+        search.tokens[2] = []
+        new_tokens = self._window_search([0], [[-30.0, -2.4, -40.0]]).tokens[0]
+        self.assertEqual(decoder._window_filter(2, new_tokens, search),
+                         [new_tokens[1]])
+        new_tokens = self._window_search([0], [[-30.0, -40.0]]).tokens[0]
+        self.assertEqual(decoder._window_filter(2, new_tokens, search),
+                         [new_tokens[0]])
+
     def test_decode(self):
         vocabulary = Vocabulary.from_word_counts({
             'to': 1,
@@ -409,5 +582,378 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token.lat_lm_logprob / log_scale, -178.00, places=2)
         self.assertAlmostEqual(token.nn_lm_logprob, math.log(0.1) * 5)
 
+    def test_lattice_pruning(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'to': 1,
+            'and': 1,
+            'it': 1,
+            'but': 1,
+            'a.': 1,
+            'in': 1,
+            'a': 1,
+            'at': 1,
+            'the': 1,
+            "didn't": 1,
+            'elaborate': 1})
+        projection_vector = tensor.ones(
+            shape=(vocabulary.num_shortlist_words(),),
+            dtype=theano.config.floatX)
+        projection_vector *= 0.05
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        decoding_options = {
+            'nnlm_weight': 0.0,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': True,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': 20,
+            'lattice_beam': 1000.0
+        }
+        decoder = LatticeDecoder(network, decoding_options)
+        tokens = decoder.decode(self.lattice)[0]
+        # The lattice beam is large enough to keep the paths of the two best
+        # tokens found without pruning.
+        paths = [' '.join(token.history_words(vocabulary)) for token in tokens]
+        self.assertLess(len(paths), 12)
+        self.assertEqual(paths[:2], ["<s> it didn't elaborate </s>",
+                                     "<s> but it didn't elaborate </s>"])
+
+        decoding_options['lattice_beam'] = None
+        decoding_options['lattice_posterior_threshold'] = 0.5
+        decoder = LatticeDecoder(network, decoding_options)
+        tokens = decoder.decode(self.lattice)[0]
+        paths = [' '.join(token.history_words(vocabulary)) for token in tokens]
+        self.assertEqual(paths, ["<s> it didn't elaborate </s>"])
+
+        decoding_options['lattice_posterior_threshold'] = None
+        decoding_options['max_tokens_per_window'] = 1
+        decoding_options['time_window'] = 10.0
+        decoder = LatticeDecoder(network, decoding_options)
+        tokens = decoder.decode(self.lattice)[0]
+        self.assertEqual(len(tokens), 1)
+
+    def test_remove_null_links(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'to': 1,
+            'and': 1,
+            'it': 1,
+            'but': 1,
+            'a.': 1,
+            'in': 1,
+            'a': 1,
+            'at': 1,
+            'the': 1,
+            "didn't": 1,
+            'elaborate': 1})
+        projection_vector = tensor.arange(vocabulary.num_shortlist_words(),
+                                          dtype=theano.config.floatX)
+        projection_vector = (projection_vector + 1) * 0.01
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        decoding_options = {
+            'nnlm_weight': 0.5,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': False,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': None
+        }
+        decoder = LatticeDecoder(network, decoding_options)
+        expected_tokens = decoder.decode(self.lattice)[0]
+        decoding_options['remove_null_links'] = True
+        decoder = LatticeDecoder(network, decoding_options)
+        tokens = decoder.decode(self.lattice)[0]
+
+        # The same paths are found with the same probabilities.
+        self.assertEqual(len(tokens), len(expected_tokens))
+        for token, expected_token in zip(tokens, expected_tokens):
+            self.assertSequenceEqual(token.history, expected_token.history)
+            self.assertAlmostEqual(token.total_logprob,
+                                   expected_token.total_logprob,
+                                   places=4)
+
+    def test_link_batching(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'to': 1,
+            'and': 1,
+            'it': 1,
+            'but': 1,
+            'a.': 1,
+            'in': 1,
+            'a': 1,
+            'at': 1,
+            'the': 1,
+            "didn't": 1,
+            'elaborate': 1})
+        projection_vector = tensor.arange(vocabulary.num_shortlist_words(),
+                                          dtype=theano.config.floatX)
+        projection_vector = (projection_vector + 1) * 0.01
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        decoding_options = {
+            'nnlm_weight': 0.5,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': True,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': 20
+        }
+
+        results = []
+        for link_batching in ('none', 'node', 'frontier'):
+            decoding_options['link_batching'] = link_batching
+            decoder = LatticeDecoder(network, decoding_options)
+            tokens = decoder.decode(self.lattice)[0]
+            results.append([(' '.join(token.history_words(vocabulary)),
+                             token.nn_lm_logprob,
+                             token.total_logprob)
+                            for token in tokens])
+        for result in results[1:]:
+            self.assertEqual(len(result), len(results[0]))
+            for (path1, nn_lm1, total1), (path2, nn_lm2, total2) \
+                in zip(result, results[0]):
+                self.assertEqual(path1, path2)
+                self.assertAlmostEqual(nn_lm1, nn_lm2, places=4)
+                self.assertAlmostEqual(total1, total2, places=2)
+
+    def test_nnlm_cache(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'to': 1,
+            'and': 1,
+            'it': 1,
+            'but': 1,
+            'a.': 1,
+            'in': 1,
+            'a': 1,
+            'at': 1,
+            'the': 1,
+            "didn't": 1,
+            'elaborate': 1})
+        projection_vector = tensor.arange(vocabulary.num_shortlist_words(),
+                                          dtype=theano.config.floatX)
+        projection_vector = (projection_vector + 1) * 0.01
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        decoding_options = {
+            'nnlm_weight': 0.5,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': True,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': None
+        }
+        decoder = LatticeDecoder(network, decoding_options)
+        expected_tokens = decoder.decode(self.lattice)[0]
+
+        decoding_options['nnlm_cache_size'] = 1.0
+        decoder = LatticeDecoder(network, decoding_options)
+        tokens = decoder.decode(self.lattice)[0]
+        self.assertGreater(decoder._cache.num_misses, 0)
+        num_misses = decoder._cache.num_misses
+        # Decoding the same lattice again can be done using the cache.
+        tokens = decoder.decode(self.lattice)[0]
+        self.assertEqual(decoder._cache.num_misses, num_misses)
+        self.assertEqual(len(tokens), len(expected_tokens))
+        for token, expected_token in zip(tokens, expected_tokens):
+            self.assertSequenceEqual(token.history, expected_token.history)
+            self.assertAlmostEqual(token.nn_lm_logprob,
+                                   expected_token.nn_lm_logprob,
+                                   places=4)
+
+    def test_decode_batch(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'to': 1,
+            'AND': 1,
+            'it': 1,
+            'BUT': 1,
+            'A.': 1,
+            'in': 1,
+            'at': 1,
+            'IN': 1,
+            'can': 1,
+            'it\'s': 1,
+            'and': 1,
+            'done': 1,
+            'A': 1,
+            'at': 1,
+            'also': 1,
+            'a': 1,
+            'didn\'t': 1,
+            'elaborate': 1})
+        projection_vector = tensor.arange(vocabulary.num_shortlist_words(),
+                                          dtype=theano.config.floatX)
+        projection_vector = (projection_vector + 1) * 0.01
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        decoding_options = {
+            'nnlm_weight': 0.5,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': True,
+            'max_tokens_per_node': 5,
+            'beam': 100.0,
+            'recombination_order': 2
+        }
+        decoder = LatticeDecoder(network, decoding_options)
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        lattice_path = os.path.join(script_path, 'lattice.slf')
+        with open(lattice_path) as lattice_file:
+            lattice2 = SLFLattice(lattice_file)
+        lattice2.lm_scale = 2.0
+        expected_tokens1 = decoder.decode(self.lattice)[0]
+        expected_tokens2 = decoder.decode(lattice2)[0]
+
+        results = decoder.decode_batch([self.lattice, lattice2])
+        self.assertEqual(len(results), 2)
+        for (tokens, _), expected_tokens in zip(results, [expected_tokens1,
+                                                          expected_tokens2]):
+            self.assertEqual(len(tokens), len(expected_tokens))
+            for token, expected_token in zip(tokens, expected_tokens):
+                self.assertSequenceEqual(token.history, expected_token.history)
+                self.assertAlmostEqual(token.total_logprob,
+                                       expected_token.total_logprob,
+                                       places=4)
+
+        # Columnar lattices are decoded without creating the node objects.
+        lattice = self.lattice.to_columnar()
+        tokens = decoder.decode(lattice)[0]
+        self.assertIsNone(lattice._nodes)
+        self.assertEqual(len(tokens), len(expected_tokens1))
+        for token, expected_token in zip(tokens, expected_tokens1):
+            self.assertSequenceEqual(token.history, expected_token.history)
+            self.assertAlmostEqual(token.total_logprob,
+                                   expected_token.total_logprob,
+                                   places=4)
+
+    def test_rescored_lattice(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'to': 1,
+            'and': 1,
+            'it': 1,
+            'but': 1,
+            'a.': 1,
+            'in': 1,
+            'a': 1,
+            'at': 1,
+            'the': 1,
+            "didn't": 1,
+            'elaborate': 1})
+        projection_vector = tensor.ones(
+            shape=(vocabulary.num_shortlist_words(),),
+            dtype=theano.config.floatX)
+        projection_vector *= 0.05
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        decoding_options = {
+            'nnlm_weight': 0.5,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': True,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': 2
+        }
+        decoder = LatticeDecoder(network, decoding_options)
+        final_tokens, recomb_tokens = decoder.decode(self.lattice)
+        self.assertTrue(recomb_tokens)
+        lattice = RescoredLattice(self.lattice, final_tokens, recomb_tokens,
+                                  vocabulary)
+
+        # Every final token corresponds to a path that ends in the final node
+        # and has the total NNLM log probability of the token in the last link.
+        for token in final_tokens:
+            node = lattice.initial_node
+            for word in token.history_words(vocabulary)[1:]:
+                if word in node.word_to_link:
+                    node = node.word_to_link[word].end_node
+            final_links = [link for link in node.out_links
+                           if link.end_node.final]
+            self.assertEqual(len(final_links), 1)
+            self.assertAlmostEqual(final_links[0].lm_logprob,
+                                   token.nn_lm_logprob)
+
+        # The lattice is a tree, except for the links that were added for the
+        # recombined tokens.
+        num_in_links = [0] * len(lattice.nodes)
+        for link in lattice.links:
+            num_in_links[link.end_node.id] += 1
+        final_id = len(lattice.nodes) - 1
+        self.assertTrue(lattice.nodes[final_id].final)
+        self.assertEqual(num_in_links[lattice.initial_node.id], 0)
+        num_recomb_links = sum(count - 1 for count in num_in_links[:final_id]
+                               if count > 1)
+        self.assertGreater(num_recomb_links, 0)
+        self.assertLessEqual(num_recomb_links, len(recomb_tokens))
+
+    def test_rescored_lattice_shared_prefix(self):
+        original_lattice = SLFLattice(['N=5 L=5',
+                                       'I=0', 'I=1', 'I=2', 'I=3', 'I=4',
+                                       'J=0 S=0 E=1 W=yksi a=-1.0 l=-2.0',
+                                       'J=1 S=1 E=2 W=kaksi a=-3.0 l=-4.0',
+                                       'J=2 S=1 E=3 W=kolme a=-5.0 l=-6.0',
+                                       'J=3 S=2 E=4 W=</s> a=0.0 l=0.0',
+                                       'J=4 S=3 E=4 W=</s> a=0.0 l=0.0'])
+        kolme_id = self.vocabulary.word_to_id['kolme']
+
+        # The first two tokens share the history object of the common prefix.
+        # The third token has the same words as the first one, but a separate
+        # history object.
+        prefix = LatticeDecoder.History.from_sequence(
+            (self.sos_id, self.yksi_id))
+        token1 = LatticeDecoder.Token(
+            history=prefix + (self.kaksi_id, self.eos_id),
+            nn_lm_logprob=-10.0)
+        token2 = LatticeDecoder.Token(
+            history=prefix + (kolme_id, self.eos_id),
+            nn_lm_logprob=-11.0)
+        token3 = LatticeDecoder.Token(
+            history=(self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id),
+            nn_lm_logprob=-12.0)
+        lattice = RescoredLattice(original_lattice, [token1, token2, token3],
+                                  [], self.vocabulary)
+
+        self.assertEqual(len(lattice.nodes), 7)
+        self.assertIs(lattice.initial_node, lattice.nodes[0])
+        self.assertEqual([node.id for node in lattice.nodes], list(range(7)))
+        self.assertEqual([node.final for node in lattice.nodes],
+                         [False] * 6 + [True])
+        expected_links = [(0, 1, 'yksi', -1.0, -2.0),
+                          (1, 2, 'kaksi', -3.0, -4.0),
+                          (2, 3, '</s>', 0.0, 0.0),
+                          (3, 6, None, 0.0, -10.0),
+                          (1, 4, 'kolme', -5.0, -6.0),
+                          (4, 5, '</s>', 0.0, 0.0),
+                          (5, 6, None, 0.0, -11.0)]
+        self.assertEqual(len(lattice.links), len(expected_links))
+        for link, expected_link in zip(lattice.links, expected_links):
+            self.assertEqual(link.start_node.id, expected_link[0])
+            self.assertEqual(link.end_node.id, expected_link[1])
+            self.assertEqual(link.word, expected_link[2])
+            self.assertAlmostEqual(link.ac_logprob, expected_link[3])
+            self.assertAlmostEqual(link.lm_logprob, expected_link[4])
+
 if __name__ == '__main__':
     unittest.main()
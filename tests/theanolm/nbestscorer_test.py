@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import math
+import os
+from io import StringIO
+
+import numpy
+from numpy.testing import assert_almost_equal
+import theano
+from theano import tensor
+
+import h5py
+
+from theanolm import Vocabulary, Network, Architecture
+from theanolm.scoring import NBestScorer, TextScorer
+
+class DummyNetwork(object):
+    """A dummy network for testing the n-best scorer that always outputs
+    projection of input word + projection of output word.
+    """
+
+    def __init__(self, vocabulary, projection_vector):
+        self.vocabulary = vocabulary
+        self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
+        self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.oos_logprobs = None
+        self.recurrent_state_input = [tensor.tensor3('recurrent_state_1', dtype=theano.config.floatX)]
+        self.recurrent_state_output = [self.recurrent_state_input[0] + 1]
+        self.recurrent_state_size = [3]
+        self.projection_vector = projection_vector
+
+    def output_probs(self):
+        num_time_steps = self.input_word_ids.shape[0]
+        num_sequences = self.input_word_ids.shape[1]
+        vocabulary_size = self.projection_vector.shape[0]
+        result = self.projection_vector[self.input_word_ids.flatten()]
+        result = result.dimshuffle(0, 'x') + \
+                 self.projection_vector.dimshuffle('x', 0)
+        result = result.reshape([num_time_steps,
+                                 num_sequences,
+                                 vocabulary_size],
+                                ndim=3)
+        return result
+
+class TestNBestScorer(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+
+        self.sos_id = self.vocabulary.word_to_id['<s>']
+        self.yksi_id = self.vocabulary.word_to_id['yksi']
+        self.kaksi_id = self.vocabulary.word_to_id['kaksi']
+        self.eos_id = self.vocabulary.word_to_id['</s>']
+        self.unk_id = self.vocabulary.word_to_id['<unk>']
+
+        projection_vector = tensor.zeros(
+            shape=(self.vocabulary.num_shortlist_words(),),
+            dtype=theano.config.floatX)
+        self.probs = {self.sos_id: 0.1,
+                      self.yksi_id: 0.2,
+                      self.kaksi_id: 0.3,
+                      self.eos_id: 0.4,
+                      self.unk_id: 0.3}
+        for word_id, prob in self.probs.items():
+            projection_vector = tensor.set_subtensor(
+                projection_vector[word_id], prob)
+        self.network = DummyNetwork(self.vocabulary, projection_vector)
+
+    def tearDown(self):
+        pass
+
+    def _logprob(self, words):
+        word_ids = self.vocabulary.words_to_ids(words)
+        return sum(math.log(self.probs[int(x)] + self.probs[int(y)])
+                   for x, y in zip(word_ids[:-1], word_ids[1:]))
+
+    def test_score_nbest(self):
+        scorer = NBestScorer(self.network)
+        hypotheses = [['<s>', 'yksi', 'kaksi', '</s>'],
+                      ['<s>', 'yksi', '</s>'],
+                      ['<s>', 'yksi', 'kaksi', '</s>'],
+                      ['<s>', 'kaksi', 'yksi', 'kaksi', '</s>'],
+                      ['<s>', '</s>']]
+        logprobs = scorer.score_nbest(hypotheses)
+        self.assertEqual(len(logprobs), len(hypotheses))
+        for words, logprob in zip(hypotheses, logprobs):
+            assert_almost_equal(logprob, self._logprob(words), decimal=5)
+        self.assertEqual(scorer.num_words, 18)
+        self.assertEqual(scorer.num_predictions, 13)
+        # The hypotheses that start with <s> yksi share the first prediction,
+        # and the duplicate hypothesis shares every prediction.
+        self.assertEqual(scorer.num_computed, 9)
+
+        # The result is the same when the step function is called with one
+        # sequence at a time.
+        scorer = NBestScorer(self.network, max_batch_size=1)
+        assert_almost_equal(scorer.score_nbest(hypotheses), logprobs,
+                            decimal=5)
+
+    def test_exclude_unk(self):
+        hypotheses = [['<s>', 'yksi', 'foo', '</s>']]
+        scorer = NBestScorer(self.network, exclude_unk=False)
+        logprobs = scorer.score_nbest(hypotheses)
+        assert_almost_equal(logprobs[0], self._logprob(hypotheses[0]),
+                            decimal=5)
+        self.assertEqual(scorer.num_unks, 1)
+
+        scorer = NBestScorer(self.network, exclude_unk=True)
+        logprobs = scorer.score_nbest(hypotheses)
+        assert_almost_equal(logprobs[0],
+                            math.log(self.probs[self.sos_id] +
+                                     self.probs[self.yksi_id]) +
+                            math.log(self.probs[self.unk_id] +
+                                     self.probs[self.eos_id]),
+                            decimal=5)
+
+    def test_lstm_network(self):
+        description = StringIO(
+            "input type=class name=class_input\n"
+            "layer type=projection name=projection_layer input=class_input "
+            "size=5\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=4\n"
+            "layer type=softmax name=output_layer input=hidden_layer\n")
+        architecture = Architecture.from_description(description)
+
+        # The same parameters are used in mini-batch mode by the text scorer
+        # and in single time step mode by the n-best scorer.
+        minibatch_network = Network(architecture, self.vocabulary)
+        state = h5py.File('in-memory.h5', driver='core', backing_store=False)
+        minibatch_network.get_state(state)
+        network = Network(architecture, self.vocabulary,
+                          mode=Network.Mode(minibatch=False))
+        network.set_state(state)
+        state.close()
+
+        hypotheses = [['<s>', 'yksi', 'kaksi', '</s>'],
+                      ['<s>', 'yksi', '</s>'],
+                      ['<s>', 'yksi', 'kaksi', 'kolme', '</s>'],
+                      ['<s>', 'kaksi', '</s>']]
+        nbest_scorer = NBestScorer(network)
+        logprobs = nbest_scorer.score_nbest(hypotheses)
+        text_scorer = TextScorer(minibatch_network)
+        for words, logprob in zip(hypotheses, logprobs):
+            word_ids = self.vocabulary.words_to_ids(words)
+            class_ids, membership_probs = \
+                self.vocabulary.get_class_memberships(word_ids)
+            expected = text_scorer.score_sequence(word_ids, class_ids,
+                                                  membership_probs)
+            assert_almost_equal(logprob, expected, decimal=4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ import theano.tensor as tensor
 
 from theanolm.backend import conv1d, conv2d
 from theanolm.backend import l1_norm, sum_of_squares
+from theanolm.backend import top_k
 
 class Test(unittest.TestCase):
     def setUp(self):
@@ -98,5 +99,23 @@ class Test(unittest.TestCase):
 
         self.assertEqual(y, numpy.square(numpy.arange(13)).sum())
 
+    def test_top_k(self):
+        x_tensor = tensor.tensor3("x")
+        k_tensor = tensor.scalar("k", dtype='int64')
+        values_tensor, indices_tensor = top_k(x_tensor, k_tensor)
+        f = theano.function([x_tensor, k_tensor],
+                            [values_tensor, indices_tensor])
+
+        numpy.random.seed(1)
+        x = numpy.random.permutation(4 * 3 * 50).reshape([4, 3, 50])
+        x = x.astype(theano.config.floatX)
+        values, indices = f(x, 5)
+        self.assertEqual(values.shape, (4, 3, 5))
+        self.assertEqual(indices.shape, (4, 3, 5))
+        numpy.testing.assert_equal(indices,
+                                   numpy.argsort(x, axis=2)[:, :, -5:])
+        numpy.testing.assert_equal(values,
+                                   numpy.sort(x, axis=2)[:, :, -5:])
+
 if __name__ == "__main__":
     unittest.main()
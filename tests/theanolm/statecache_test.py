@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy
+from numpy.testing import assert_equal
+
+from theanolm.network import RecurrentState
+from theanolm.scoring.statecache import StateCache
+
+class TestStateCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_add(self):
+        cache = StateCache(1000000)
+        layer_state = numpy.arange(10, dtype='float32').reshape((1, 2, 5))
+        state = RecurrentState([5], 1, [layer_state[:, 1:2]])
+        cache.add((1, 2), state, [3, 4], [-1.0, -2.0])
+        self.assertEqual(len(cache), 1)
+        entry = cache.get((1, 2))
+        assert_equal(entry.state.get(0), layer_state[:, 1:2])
+        # The state is copied.
+        layer_state[:] = 0
+        self.assertEqual(entry.state.get(0)[0, 0, 0], 5)
+        self.assertEqual(entry.logprobs, {3: -1.0, 4: -2.0})
+
+        cache.add((1, 2), state, [5], [-3.0])
+        self.assertEqual(len(cache), 1)
+        entry = cache.get((1, 2))
+        self.assertEqual(entry.logprobs, {3: -1.0, 4: -2.0, 5: -3.0})
+        self.assertIsNone(cache.get((2,)))
+
+    def test_size_limit(self):
+        state = RecurrentState([5])
+        entry_size = StateCache.ENTRY_SIZE + StateCache.WORD_SIZE + \
+                     state.get(0).nbytes + StateCache.LOGPROB_SIZE
+        cache = StateCache(entry_size * 2)
+        cache.add((1,), state, [1], [-1.0])
+        cache.add((2,), state, [1], [-1.0])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, entry_size * 2)
+        # Using the first entry makes the second one least recently used.
+        cache.get((1,))
+        cache.add((3,), state, [1], [-1.0])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get((1,)))
+        self.assertIsNone(cache.get((2,)))
+        self.assertIsNotNone(cache.get((3,)))
+
+if __name__ == '__main__':
+    unittest.main()
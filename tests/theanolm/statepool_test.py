@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy
+from numpy.testing import assert_equal
+
+from theanolm.network import RecurrentState
+from theanolm.scoring.statepool import StatePool
+
+class TestStatePool(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_add_get(self):
+        pool = StatePool([2, 3], capacity=2)
+        state = RecurrentState([2, 3], 3,
+                               [numpy.arange(6).reshape((1, 3, 2)),
+                                numpy.arange(9).reshape((1, 3, 3))])
+        rows = pool.add(state)
+        assert_equal(rows, [0, 1, 2])
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(pool.capacity, 4)
+        rows = pool.add(state)
+        assert_equal(rows, [3, 4, 5])
+        self.assertEqual(pool.capacity, 8)
+
+        state = pool.get([4, 0, 4])
+        self.assertEqual(state.num_sequences, 3)
+        assert_equal(state.get(0), [[[2, 3], [0, 1], [2, 3]]])
+        assert_equal(state.get(1), [[[3, 4, 5], [0, 1, 2], [3, 4, 5]]])
+
+    def test_compact(self):
+        pool = StatePool([2], capacity=8)
+        state = RecurrentState([2], 7, [numpy.arange(14).reshape((1, 7, 2))])
+        pool.add(state)
+        self.assertTrue(pool.is_full())
+        mapping = pool.compact([4, 1, 4])
+        assert_equal(mapping, [-1, 0, -1, -1, 1, -1, -1])
+        self.assertEqual(len(pool), 2)
+        self.assertFalse(pool.is_full())
+        assert_equal(pool.get([0, 1]).get(0), [[[2, 3], [8, 9]]])
+
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,6 +31,12 @@ class DummyNetwork(object):
     def target_probs(self):
         return self.target_class_ids.astype('float32') / 100.0
 
+    def output_probs(self):
+        num_classes = self.vocabulary.num_classes()
+        class_probs = tensor.arange(num_classes).astype('float32') / 100.0
+        return tensor.ones_like(self.input_word_ids).astype('float32') \
+                     .dimshuffle(0, 1, 'x') * class_probs
+
 class TestTextScorer(unittest.TestCase):
     def setUp(self):
         script_path = os.path.dirname(os.path.realpath(__file__))
@@ -145,5 +151,54 @@ class TestTextScorer(unittest.TestCase):
         correct = numpy.log(correct).sum()
         self.assertAlmostEqual(logprob, correct, places=5)
 
+    def test_score_sequences(self):
+        # The sequences of a mini-batch are scored like individual sequences.
+        scorer = TextScorer(self.dummy_network, use_shortlist=True)
+        word_ids = numpy.arange(15).reshape((3, 5)).T
+        class_ids, _ = self.vocabulary.get_class_memberships(word_ids)
+        membership_probs = numpy.ones_like(word_ids).astype('float32')
+        mask = numpy.ones_like(word_ids)
+        mask[3:, 0] = 0
+        logprobs = scorer.score_sequences(word_ids, class_ids,
+                                          membership_probs, mask)
+        self.assertEqual(len(logprobs), 3)
+        for seq_index in range(3):
+            length = numpy.count_nonzero(mask[:, seq_index])
+            seq_word_ids = word_ids[:length, seq_index]
+            correct = scorer.score_sequence(seq_word_ids,
+                                            class_ids[:length, seq_index],
+                                            membership_probs[:length, seq_index])
+            self.assertAlmostEqual(logprobs[seq_index], correct, places=5)
+        self.assertEqual(scorer.num_words, 13)
+        self.assertEqual(scorer.num_unks, 1)
+
+    def test_score_top_k(self):
+        # The top-k log probabilities are read from the same distribution that
+        # score_batch_output() returns.
+        scorer = TextScorer(self.dummy_network, use_shortlist=True)
+        word_ids = numpy.arange(15).reshape((3, 5)).T
+        class_ids, _ = self.vocabulary.get_class_memberships(word_ids)
+        all_word_ids = numpy.arange(self.vocabulary.num_words())
+        all_class_ids, all_membership_probs = \
+            self.vocabulary.get_class_memberships(all_word_ids)
+        mask = numpy.ones_like(word_ids)
+        vectors = scorer.score_batch_output(word_ids, class_ids, all_class_ids,
+                                            all_membership_probs, mask)
+        logprobs, topk, topk_logprobs = \
+            scorer.score_top_k(word_ids, class_ids, all_class_ids,
+                               all_membership_probs, 3, mask)
+        for seq_index in range(3):
+            for index, vector in enumerate(vectors[seq_index]):
+                if vector is None:
+                    self.assertIsNone(logprobs[seq_index][index])
+                    continue
+                target_id = word_ids[index + 1, seq_index]
+                self.assertAlmostEqual(logprobs[seq_index][index],
+                                       vector[target_id], places=5)
+                assert_almost_equal(topk_logprobs[seq_index][index],
+                                    vector[topk[seq_index][index]])
+                assert_almost_equal(sorted(vector)[-3:],
+                                    topk_logprobs[seq_index][index])
+
 if __name__ == '__main__':
     unittest.main()
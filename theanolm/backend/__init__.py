@@ -16,3 +16,4 @@ from theanolm.backend.probfunctions import interpolate_loglinear
 from theanolm.backend.probfunctions import logprob_type
 from theanolm.backend.operations import conv1d, conv2d
 from theanolm.backend.operations import l1_norm, sum_of_squares
+from theanolm.backend.operations import top_k
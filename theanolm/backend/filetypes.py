@@ -8,15 +8,16 @@ import io
 import sys
 import argparse
 import gzip
+import bz2
 
 class TextFileType(object):
     """An object that can be passed as the "type" argument to
     ArgumentParser.add_argument() in order to convert a path argument to a
     file object.
 
-    If the path ends in ".gz", the file will be opened using gzip.open().
-    UTF-8 encoding will be assumed. The special path "-" means standard
-    input or output.
+    If the path ends in ".gz" or ".bz2", the file will be opened using
+    gzip.open() or bz2.open(). UTF-8 encoding will be assumed. The special
+    path "-" means standard input or output.
 
     Keyword Arguments:
       - mode -- A string indicating how the file is to be opened. Accepts the
@@ -43,6 +44,8 @@ class TextFileType(object):
         try:
             if string.endswith('.gz'):
                 return gzip.open(string, self._mode + 't', encoding='utf-8')
+            if string.endswith('.bz2'):
+                return bz2.open(string, self._mode + 't', encoding='utf-8')
             return open(string, self._mode + 't', encoding='utf-8')
         except IOError as e:
             message = "Cannot open '%s': %s" % (string, e)
@@ -59,9 +62,9 @@ class BinaryFileType(object):
     ArgumentParser.add_argument() in order to convert a path argument to a
     file object.
 
-    If the path ends in ".gz", the file will be opened using gzip.open().
-    UTF-8 encoding will be assumed. The special path "-" means standard
-    input or output.
+    If the path ends in ".gz" or ".bz2", the file will be opened using
+    gzip.open() or bz2.open(). UTF-8 encoding will be assumed. The special
+    path "-" means standard input or output.
 
     Keyword Arguments:
       - mode -- A string indicating how the file is to be opened. Accepts the
@@ -88,6 +91,8 @@ class BinaryFileType(object):
         try:
             if string.endswith('.gz'):
                 return gzip.open(string, self._mode + 'b')
+            if string.endswith('.bz2'):
+                return bz2.open(string, self._mode + 'b')
             return open(string, self._mode + 'b',)
         except IOError as e:
             message = "Cannot open '%s': %s" % (string, e)
@@ -7,6 +7,7 @@ The functions are designed to be compatible with the Keras interface.
 
 import theano.tensor as tensor
 from theano.gof import MissingInputError
+from theano.tensor.sort import argtopk
 
 def conv2d(input_matrix, filters, strides=(1, 1), padding='valid'):
     """Performs 2-dimensional convolution given 4-dimensional input and filter
@@ -159,3 +160,44 @@ def sum_of_squares(tensors):
 
     squares = [tensor.sqr(x) for x in tensors]
     return sum(tensor.sum(x) for x in squares)
+
+def top_k(input_tensor, k):
+    """Selects the ``k`` largest elements along the last axis.
+
+    The elements are found using partial selection, which takes linear time in
+    the size of the last axis, instead of sorting the whole axis. Only the
+    selected elements are sorted. They are returned in ascending order, the
+    same order as ``argsort(input_tensor)[..., -k:]`` would give.
+
+    :type input_tensor: symbolic tensor
+    :param input_tensor: a tensor with at least one dimension
+
+    :type k: int or symbolic integer scalar
+    :param k: number of elements to select
+
+    :rtype: tuple of two symbolic tensors
+    :returns: the values and the indices of the ``k`` largest elements; same
+              shape as ``input_tensor``, except that the last dimension is
+              ``k``
+    """
+
+    indices = argtopk(input_tensor, k, axis=-1, sorted=False)
+
+    # Gather the selected values from the flattened input.
+    num_rows = input_tensor.size // input_tensor.shape[-1]
+    indices = indices.reshape([num_rows, k])
+    row_offsets = tensor.arange(num_rows).dimshuffle(0, 'x')
+    flat_indices = row_offsets * input_tensor.shape[-1] + indices
+    values = input_tensor.flatten()[flat_indices.flatten()]
+    values = values.reshape([num_rows, k])
+
+    # Sort the selected elements within each row.
+    order = tensor.argsort(values, axis=1)
+    flat_order = (row_offsets * k + order).flatten()
+    output_shape = tensor.concatenate([input_tensor.shape[:-1],
+                                       tensor.cast([k], 'int64')])
+    values = values.flatten()[flat_order].reshape(output_shape,
+                                                  ndim=input_tensor.ndim)
+    indices = indices.flatten()[flat_order].reshape(output_shape,
+                                                    ndim=input_tensor.ndim)
+    return values, indices
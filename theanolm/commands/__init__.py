@@ -5,4 +5,5 @@ import theanolm.commands.train
 import theanolm.commands.score
 import theanolm.commands.decode
 import theanolm.commands.sample
+import theanolm.commands.archive
 import theanolm.commands.version
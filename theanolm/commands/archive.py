@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the "theanolm archive" command.
+"""
+
+import sys
+import logging
+
+from theanolm.backend import TextFileType
+from theanolm.scoring import LatticeBatch
+from theanolm.scoring.latticearchive import LatticeArchive
+
+def add_arguments(parser):
+    """Specifies the command line arguments supported by the "theanolm
+    archive" command.
+
+    :type parser: argparse.ArgumentParser
+    :param parser: a command line argument parser
+    """
+
+    argument_group = parser.add_argument_group("files")
+    argument_group.add_argument(
+        'archive_path', metavar='ARCHIVE-FILE', type=str,
+        help='path where to write the binary lattice archive')
+    argument_group.add_argument(
+        '--lattices', metavar='FILE', type=str, nargs='*', default=[],
+        help='word lattices to be archived (default stdin, assumed to be '
+             'compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-list', metavar='FILE', type=TextFileType('r'),
+        help='text file containing a list of word lattices to be archived '
+             '(one path per line, the list and the lattice files are assumed '
+             'to be compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-format', metavar='FORMAT', type=str, default='slf',
+        choices=['slf', 'kaldi'],
+        help='format of the lattice files, either "slf" (HTK format, default) '
+             'or "kaldi" (a Kaldi lattice archive containing text '
+             'CompactLattices')
+    argument_group.add_argument(
+        '--kaldi-vocabulary', metavar='FILE', type=TextFileType('r'),
+        default=None,
+        help='mapping of words to word IDs in Kaldi lattices (usually '
+             'named words.txt)')
+
+    argument_group = parser.add_argument_group("logging and debugging")
+    argument_group.add_argument(
+        '--log-file', metavar='FILE', type=str, default='-',
+        help='path where to write log file (default is standard output)')
+    argument_group.add_argument(
+        '--log-level', metavar='LEVEL', type=str, default='info',
+        help='minimum level of events to log, one of "debug", "info", "warn" '
+             '(default "info")')
+
+def archive(args):
+    """A function that performs the "theanolm archive" command.
+
+    :type args: argparse.Namespace
+    :param args: a collection of command line arguments
+    """
+
+    log_file = args.log_file
+    log_level = getattr(logging, args.log_level.upper(), None)
+    if not isinstance(log_level, int):
+        print("Invalid logging level requested:", args.log_level,
+              file=sys.stderr)
+        sys.exit(1)
+    log_format = '%(asctime)s %(funcName)s: %(message)s'
+    if args.log_file == '-':
+        logging.basicConfig(stream=sys.stdout, format=log_format, level=log_level)
+    else:
+        logging.basicConfig(filename=log_file, format=log_format, level=log_level)
+
+    if (args.lattice_format == 'kaldi') and (args.kaldi_vocabulary is None):
+        print("Kaldi lattice vocabulary is not given.", file=sys.stderr)
+        sys.exit(1)
+
+    batch = LatticeBatch(args.lattices, args.lattice_list, args.lattice_format,
+                         args.kaldi_vocabulary)
+    logging.info("Writing lattice archive `%s´.", args.archive_path)
+    LatticeArchive.write(args.archive_path, batch)
@@ -4,9 +4,11 @@
 """
 
 import gc
+import io
 import sys
 import os
 import logging
+import multiprocessing
 
 import numpy
 import theano
@@ -16,6 +18,10 @@ from theanolm.backend import TextFileType
 from theanolm.backend import get_default_device, log_free_mem
 from theanolm.scoring import LatticeBatch, LatticeDecoder, RescoredLattice
 
+# The decoder and other read-only objects that the worker processes inherit
+# from the parent process when the process pool is forked.
+_worker_context = None
+
 def add_arguments(parser):
     """Specifies the command line arguments supported by the "theanolm decode"
     command.
@@ -31,7 +37,9 @@ def add_arguments(parser):
     argument_group.add_argument(
         '--lattices', metavar='FILE', type=str, nargs='*', default=[],
         help='word lattices to be decoded (default stdin, assumed to be '
-             'compressed if the name ends in ".gz")')
+             'compressed if the name ends in ".gz" or ".bz2"); Kaldi lattices '
+             'can also be given as "scp:FILE" to read the lattices listed in a '
+             'script file, or "ark:FILE"')
     argument_group.add_argument(
         '--lattice-list', metavar='FILE', type=TextFileType('r'),
         help='text file containing a list of word lattices to be decoded (one '
@@ -39,10 +47,12 @@ def add_arguments(parser):
              'compressed if the name ends in ".gz")')
     argument_group.add_argument(
         '--lattice-format', metavar='FORMAT', type=str, default='slf',
-        choices=['slf', 'kaldi'],
-        help='format of the lattice files, either "slf" (HTK format, default) '
-             'or "kaldi" (a Kaldi lattice archive containing text '
-             'CompactLattices')
+        choices=['slf', 'kaldi', 'archive'],
+        help='format of the lattice files, either "slf" (HTK format, default), '
+             '"kaldi" (a Kaldi lattice archive containing text '
+             'CompactLattices, or a script file that lists their locations), '
+             'or "archive" (a binary lattice archive created using "theanolm '
+             'archive")')
     argument_group.add_argument(
         '--kaldi-vocabulary', metavar='FILE', type=TextFileType('r'),
         default=None,
@@ -52,11 +62,12 @@ def add_arguments(parser):
         '--output-file', metavar='FILE', type=TextFileType('w'), default='-',
         help='where to write the best paths through the lattices or the '
              'rescored lattice (default stdout, will be compressed if the name '
-             'ends in ".gz")')
+             'ends in ".gz" or ".bz2")')
     argument_group.add_argument(
         '--num-jobs', metavar='J', type=int, default=1,
         help='divide the set of lattice files into J distinct batches, and '
-             'process only batch I')
+             'process only batch I (binary lattice archives are divided into '
+             'batches of equal size in bytes)')
     argument_group.add_argument(
         '--job', metavar='I', type=int, default=0,
         help='the index of the batch that this job should process, between 0 '
@@ -124,6 +135,28 @@ def add_arguments(parser):
         help="prune tokens whose log probability is at least B smaller than "
              "the log probability of the best token at any given time (default "
              "is no beam pruning)")
+    argument_group.add_argument(
+        '--max-tokens-per-window', metavar='T', type=int, default=None,
+        help="propagate a token only if it's among the T best tokens seen so "
+             "far within the same time window, keeping at least the best "
+             "token of each node; nodes without time stamps are not limited "
+             "(default is no limit)")
+    argument_group.add_argument(
+        '--time-window', metavar='SECONDS', type=float, default=0.01,
+        help="length of the time windows used by --max-tokens-per-window "
+             "(default is 0.01)")
+    argument_group.add_argument(
+        '--lattice-beam', metavar='B', type=float, default=None,
+        help="before decoding, remove lattice links whose best path, according "
+             "to the acoustic and LM scores in the lattice, has at least B "
+             "smaller log probability than the best path (default is no "
+             "lattice pruning)")
+    argument_group.add_argument(
+        '--lattice-posterior-threshold', metavar='P', type=float,
+        default=None,
+        help="before decoding, remove lattice links whose posterior "
+             "probability, according to the acoustic and LM scores in the "
+             "lattice, is lower than P (default is no lattice pruning)")
     argument_group.add_argument(
         '--recombination-order', metavar='O', type=int, default=None,
         help="keep only the best token, when at least O previous words are "
@@ -143,6 +176,42 @@ def add_arguments(parser):
         help="if prune-extra-limit is used, do not tighten the beam further "
              "than this (default is 150)")
 
+    argument_group = parser.add_argument_group("performance")
+    argument_group.add_argument(
+        '--link-batching', metavar='MODE', type=str, default='node',
+        choices=['none', 'node', 'frontier'],
+        help='how many lattice links are evaluated with one call to the neural '
+             'network, one of "none" (each link separately), "node" (default, '
+             'all outgoing links of a node), "frontier" (all outgoing links of '
+             'consecutive nodes that are not linked to each other)')
+    argument_group.add_argument(
+        '--remove-null-links', action="store_true",
+        help='remove null links (epsilon arcs) from the lattices before '
+             'decoding, adding their scores to the following links, and merge '
+             'parallel links with the same word, so that the same word '
+             'sequence is expanded fewer times')
+    argument_group.add_argument(
+        '--nnlm-cache-size', metavar='MB', type=float, default=None,
+        help='cache the recurrent states and NNLM probabilities computed after '
+             'each word history (limited to the recombination order), using '
+             'at most MB megabytes of memory (default is no caching)')
+    argument_group.add_argument(
+        '--workers', metavar='N', type=int, default=1,
+        help='decode N lattices in parallel using a pool of worker processes '
+             'that share the model and the compiled decoder; requires that the '
+             'operating system supports forking and that the model is '
+             'evaluated on CPU (default 1)')
+    argument_group.add_argument(
+        '--prefetch-lattices', metavar='N', type=int, default=0,
+        help='parse up to N lattices ahead in a background thread, so that '
+             'reading the lattices overlaps with decoding (default 0, meaning '
+             'that the lattices are parsed when needed)')
+    argument_group.add_argument(
+        '--lockstep-lattices', metavar='K', type=int, default=1,
+        help='decode K lattices at a time in lockstep, evaluating the links of '
+             'all K lattices with one call to the neural network, which keeps '
+             'the mini-batches large when the lattices are small (default 1)')
+
     argument_group = parser.add_argument_group("configuration")
     argument_group.add_argument(
         '--default-device', metavar='DEVICE', type=str, default=None,
@@ -194,6 +263,38 @@ def decode(args):
             print("Kaldi lattice vocabulary is not given.", file=sys.stderr)
             sys.exit(1)
 
+    if args.workers < 1:
+        print("Invalid number of workers specified:", args.workers,
+              file=sys.stderr)
+        sys.exit(1)
+    if args.prefetch_lattices < 0:
+        print("Invalid number of prefetched lattices specified:",
+              args.prefetch_lattices, file=sys.stderr)
+        sys.exit(1)
+    if args.lockstep_lattices < 1:
+        print("Invalid number of lockstep lattices specified:",
+              args.lockstep_lattices, file=sys.stderr)
+        sys.exit(1)
+
+    if (args.max_tokens_per_window is not None) and \
+       (args.max_tokens_per_window < 1):
+        print("Invalid maximum number of tokens per window specified:",
+              args.max_tokens_per_window, file=sys.stderr)
+        sys.exit(1)
+    if args.time_window <= 0:
+        print("Invalid time window specified:", args.time_window,
+              file=sys.stderr)
+        sys.exit(1)
+    if (args.lattice_beam is not None) and (args.lattice_beam < 0):
+        print("Invalid lattice beam specified:", args.lattice_beam,
+              file=sys.stderr)
+        sys.exit(1)
+    if (args.lattice_posterior_threshold is not None) and \
+       not (0 < args.lattice_posterior_threshold <= 1):
+        print("Invalid lattice posterior threshold specified:",
+              args.lattice_posterior_threshold, file=sys.stderr)
+        sys.exit(1)
+
     default_device = get_default_device(args.default_device)
     network = Network.from_file(args.model_path,
                                 mode=Network.Mode(minibatch=False),
@@ -219,9 +320,16 @@ def decode(args):
         'max_tokens_per_node': args.max_tokens_per_node,
         'beam': args.beam,
         'recombination_order': args.recombination_order,
+        'max_tokens_per_window': args.max_tokens_per_window,
+        'time_window': args.time_window,
+        'lattice_beam': args.lattice_beam,
+        'lattice_posterior_threshold': args.lattice_posterior_threshold,
+        'remove_null_links': args.remove_null_links,
         'prune_relative': args.prune_relative,
         'abs_min_max_tokens': args.abs_min_max_tokens,
-        'abs_min_beam': args.abs_min_beam
+        'abs_min_beam': args.abs_min_beam,
+        'link_batching': args.link_batching,
+        'nnlm_cache_size': args.nnlm_cache_size
     }
     logging.debug("DECODING OPTIONS")
     for option_name, option_value in decoding_options.items():
@@ -231,39 +339,132 @@ def decode(args):
     decoder = LatticeDecoder(network, decoding_options)
 
     batch = LatticeBatch(args.lattices, args.lattice_list, args.lattice_format,
-                         args.kaldi_vocabulary, args.num_jobs, args.job)
-    for lattice_number, lattice in enumerate(batch):
+                         args.kaldi_vocabulary, args.num_jobs, args.job,
+                         args.prefetch_lattices)
+    if args.workers == 1:
+        for group in _groups(enumerate(batch), args.lockstep_lattices):
+            _decode_lattices(decoder, group, batch, network.vocabulary, args,
+                             log_scale, args.output_file)
+        return
+
+    # The worker processes are forked after the decoder has been created, so
+    # that they share the model parameters and the compiled function with the
+    # parent process. The parent process reads the lattice sources and writes
+    # the results in the input order.
+    global _worker_context
+    _worker_context = (decoder, batch, network.vocabulary, args, log_scale)
+    logging.info("Starting %d worker processes.", args.workers)
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.workers) as pool:
+        tasks = _groups(enumerate(batch.sources()), args.lockstep_lattices)
+        for output in pool.imap(_decode_in_worker, tasks):
+            args.output_file.write(output)
+    _worker_context = None
+
+def _groups(iterable, size):
+    """A generator for iterating through groups of consecutive elements.
+
+    :type iterable: iterable
+    :param iterable: the elements
+
+    :type size: int
+    :param size: maximum number of elements in a group
+
+    :rtype: generator for lists
+    :returns: generates lists of at most ``size`` consecutive elements
+    """
+
+    group = []
+    for element in iterable:
+        group.append(element)
+        if len(group) >= size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+def _decode_in_worker(task):
+    """Parses and decodes a group of lattices in a worker process.
+
+    :type task: list of tuples
+    :param task: index of each lattice within the job, and the source from
+                 which the lattice will be read using
+                 ``LatticeBatch.read_lattice()``
+
+    :rtype: str
+    :returns: the decoder output for the lattices
+    """
+
+    decoder, batch, vocabulary, args, log_scale = _worker_context
+    lattices = [(lattice_number, batch.read_lattice(source))
+                for lattice_number, source in task]
+    output_file = io.StringIO()
+    _decode_lattices(decoder, lattices, batch, vocabulary, args, log_scale,
+                     output_file)
+    return output_file.getvalue()
+
+def _decode_lattices(decoder, lattices, batch, vocabulary, args, log_scale,
+                     output_file):
+    """Decodes a group of lattices in lockstep and writes the best paths or the
+    rescored lattices.
+
+    :type decoder: LatticeDecoder
+    :param decoder: the decoder to use
+
+    :type lattices: list of tuples
+    :param lattices: index of each lattice within the job, and the word lattice
+                     to be decoded
+
+    :type batch: LatticeBatch
+    :param batch: the batch where the lattices were read from
+
+    :type vocabulary: Vocabulary
+    :param vocabulary: mapping from word IDs to words
+
+    :type args: argparse.Namespace
+    :param args: a collection of command line arguments
+
+    :type log_scale: float
+    :param log_scale: divide log probabilities by this number to convert the log
+                      base
+
+    :type output_file: file object
+    :param output_file: where to write the output
+    """
+
+    for lattice_number, lattice in lattices:
         if lattice.utterance_id is None:
             lattice.utterance_id = str(lattice_number)
         logging.info("Utterance `%s´ -- %d of job %d",
                      lattice.utterance_id,
                      lattice_number + 1,
                      args.job)
-        log_free_mem()
+    log_free_mem()
 
-        final_tokens, recomb_tokens = decoder.decode(lattice)
+    results = decoder.decode_batch([lattice for _, lattice in lattices])
+    for (_, lattice), (final_tokens, recomb_tokens) in zip(lattices, results):
         if (args.output == "slf") or (args.output == "kaldi"):
             rescored_lattice = RescoredLattice(lattice,
                                                final_tokens,
                                                recomb_tokens,
-                                               network.vocabulary)
+                                               vocabulary)
             rescored_lattice.lm_scale = args.lm_scale
             rescored_lattice.wi_penalty = args.wi_penalty
             if args.output == "slf":
-                rescored_lattice.write_slf(args.output_file)
+                rescored_lattice.write_slf(output_file)
             else:
                 assert args.output == "kaldi"
-                rescored_lattice.write_kaldi(args.output_file,
+                rescored_lattice.write_kaldi(output_file,
                                              batch.kaldi_word_to_id)
         else:
             for token in final_tokens[:min(args.n_best, len(final_tokens))]:
                 line = format_token(token,
                                     lattice.utterance_id,
-                                    network.vocabulary,
+                                    vocabulary,
                                     log_scale,
                                     args.output)
-                args.output_file.write(line + "\n")
-        gc.collect()
+                output_file.write(line + "\n")
+    gc.collect()
 
 def format_token(token, utterance_id, vocabulary, log_scale, output_format):
     """Formats an output line from a token and an utterance ID.
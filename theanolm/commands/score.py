@@ -5,14 +5,15 @@
 
 import sys
 import logging
+from io import StringIO
 
 import numpy
 import theano
 
 from theanolm import Network
 from theanolm.backend import TextFileType, get_default_device
-from theanolm.parsing import ScoringBatchIterator
-from theanolm.scoring import TextScorer
+from theanolm.parsing import ScoringBatchIterator, utterance_from_line
+from theanolm.scoring import TextScorer, NBestScorer
 
 def add_arguments(parser):
     """Specifies the command line arguments supported by the "theanolm score"
@@ -38,10 +39,10 @@ def add_arguments(parser):
     argument_group = parser.add_argument_group("scoring")
     argument_group.add_argument(
         '--output', metavar='DETAIL', type=str, default='perplexity',
-        choices=['perplexity', 'utterance-scores', 'word-scores', 'word-output-vectors', 'topk-scores'],
+        choices=['perplexity', 'utterance-scores', 'nbest-scores', 'word-scores', 'word-output-vectors', 'topk-scores'],
         help='what to output, one of "perplexity", "utterance-scores", '
-             '"word-scores" "word-output-vectors" "topk-vectors"'
-              '(default "perplexity")')
+             '"nbest-scores", "word-scores" "word-output-vectors" '
+             '"topk-vectors" (default "perplexity")')
     argument_group.add_argument(
         '--log-base', metavar='B', type=int, default=None,
         help='convert output log probabilities to base B (default is the '
@@ -75,6 +76,12 @@ def add_arguments(parser):
     argument_group.add_argument(
         '--batch-size', metavar='N', type=int, default=16,
         help='each mini-batch will contain N sentences (default 16)')
+    argument_group.add_argument(
+        '--sorting-window', metavar='N', type=int, default=1,
+        help='sort the sentences of N mini-batches at a time by length to '
+             'reduce padding; the output is written in the original order '
+             '(default 1, i.e. no sorting; used with "perplexity", '
+             '"word-scores", and "utterance-scores" output)')
 
     argument_group = parser.add_argument_group("logging and debugging")
     argument_group.add_argument(
@@ -120,22 +127,40 @@ def score(args):
     theano.config.profile_memory = args.profile
 
     default_device = get_default_device(args.default_device)
-    network = Network.from_file(args.model_path, exclude_unk=args.exclude_unk,
+    # The n-best list scorer advances the recurrent state one time step at a
+    # time, which requires a network that is not in mini-batch mode.
+    if args.output == 'nbest-scores':
+        mode = Network.Mode(minibatch=False)
+    else:
+        mode = None
+    network = Network.from_file(args.model_path, mode=mode,
+                                exclude_unk=args.exclude_unk,
                                 default_device=default_device)
 
     if args.vocabulary:
         network.vocabulary.to_file(args.vocabulary)
 
+    if args.output == 'nbest-scores':
+        logging.info("Building n-best list scorer.")
+        scorer = NBestScorer(network, args.shortlist, args.exclude_unk,
+                             args.batch_size, args.profile)
+        logging.info("Scoring n-best lists.")
+        _score_nbest_lists(args.input_file, scorer, args.output_file,
+                           args.log_base)
+        return
+
     logging.info("Building text scorer.")
     scorer = TextScorer(network, args.shortlist, args.exclude_unk, args.profile)
 
     logging.info("Scoring text.")
     if args.output == 'perplexity':
         _score_text(args.input_file, network.vocabulary, scorer,
-                    args.output_file, args.log_base, args.subwords, False)
+                    args.output_file, args.log_base, args.subwords, False,
+                    args.sorting_window)
     elif args.output == 'word-scores':
         _score_text(args.input_file, network.vocabulary, scorer,
-                    args.output_file, args.log_base, args.subwords, True)
+                    args.output_file, args.log_base, args.subwords, True,
+                    args.sorting_window)
     elif args.output == 'word-output-vectors':
         _output_vectors_text(args.input_file, network.vocabulary, scorer,
                     args.output_file, args.log_base)
@@ -144,13 +169,15 @@ def score(args):
                     args.output_file, args.log_base, args.k, args.batch_size)
     elif args.output == 'utterance-scores':
         _score_utterances(args.input_file, network.vocabulary, scorer,
-                          args.output_file, args.log_base)
+                          args.output_file, args.log_base, args.batch_size,
+                          args.sorting_window)
     else:
         print("Invalid output format requested:", args.output)
         sys.exit(1)
 
 def _score_text(input_file, vocabulary, scorer, output_file,
-                log_base=None, subword_marking=None, word_level=False):
+                log_base=None, subword_marking=None, word_level=False,
+                sorting_window=1):
     """Reads text from ``input_file``, computes perplexity using
     ``scorer``, and writes to ``output_file``.
 
@@ -180,6 +207,10 @@ def _score_text(input_file, vocabulary, scorer, output_file,
 
     :type word_level: bool
     :param word_level: if set to True, also writes word-level statistics
+
+    :type sorting_window: int
+    :param sorting_window: sort the sentences of this many mini-batches at a
+                           time by length
     """
 
     scoring_iter = \
@@ -187,7 +218,9 @@ def _score_text(input_file, vocabulary, scorer, output_file,
                              vocabulary,
                              batch_size=16,
                              max_sequence_length=None,
-                             map_oos_to_unk=False)
+                             map_oos_to_unk=False,
+                             sorting_window=sorting_window)
+    ordered_output = _OrderedOutput(output_file)
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
 
     total_logprob = 0.0
@@ -206,6 +239,7 @@ def _score_text(input_file, vocabulary, scorer, output_file,
             seq_mask = mask[:, seq_index]
             seq_word_ids = seq_word_ids[seq_mask == 1]
             seq_words = words[seq_index]
+            sentence_index = scoring_iter.sequence_indices[seq_index]
             merged_words, merged_logprobs = _merge_subwords(seq_words,
                                                             seq_logprobs,
                                                             subword_marking)
@@ -231,11 +265,14 @@ def _score_text(input_file, vocabulary, scorer, output_file,
             num_sentences += 1
 
             if word_level:
-                output_file.write("# Sentence {0}\n".format(num_sentences))
+                sentence_output = StringIO()
+                sentence_output.write("# Sentence {0}\n".format(
+                    sentence_index + 1))
                 _write_word_scores(vocabulary, merged_words, merged_logprobs,
-                                   output_file, log_scale)
-                output_file.write("Sentence perplexity: {0}\n\n".format(
+                                   sentence_output, log_scale)
+                sentence_output.write("Sentence perplexity: {0}\n\n".format(
                     numpy.exp(-seq_logprob / num_seq_probs)))
+                ordered_output.write(sentence_index, sentence_output.getvalue())
 
     output_file.write("Number of sentences: {0}\n".format(num_sentences))
     output_file.write("Number of words: {0}\n".format(num_words))
@@ -297,14 +334,12 @@ def _output_vectors_text(input_file, vocabulary, scorer, output_file,
     num_unks = 0
     num_zeroprobs = 0
     all_word_ids = numpy.arange(vocabulary.num_words())
-    all_class_ids, membership_probs = vocabulary.get_class_memberships(all_word_ids)
+    all_class_ids, all_membership_probs = \
+        vocabulary.get_class_memberships(all_word_ids)
     for word_ids, words, mask in scoring_iter:
         class_ids, _  = vocabulary.get_class_memberships(word_ids)
-        
-        
-        membership_probs_output_vec = numpy.tile(membership_probs,(word_ids.shape[0],word_ids.shape[1],1))
-        logprobs = scorer.score_batch_output(word_ids, class_ids, all_class_ids, membership_probs_output_vec,
-                                      mask)
+        logprobs = scorer.score_batch_output(word_ids, class_ids, all_class_ids,
+                                             all_membership_probs, mask)
         for seq_index, seq_logprobs in enumerate(logprobs):
             seq_word_ids = word_ids[:, seq_index]
             seq_mask = mask[:, seq_index]
@@ -399,25 +434,50 @@ def _topk_scores_text(input_file, vocabulary, scorer, output_file,
     num_unks = 0
     num_zeroprobs = 0
     all_word_ids = numpy.arange(vocabulary.num_words())
-    all_class_ids, membership_probs = vocabulary.get_class_memberships(all_word_ids)
+    all_class_ids, all_membership_probs = \
+        vocabulary.get_class_memberships(all_word_ids)
     for word_ids, words, mask in scoring_iter:
         class_ids, _  = vocabulary.get_class_memberships(word_ids)
-        
-        
-        membership_probs_output_vec = numpy.tile(membership_probs,(word_ids.shape[0],word_ids.shape[1],1))
-        logprobs, topk_idxes = scorer.score_top_k(word_ids, class_ids, all_class_ids, membership_probs_output_vec, k+1,
-                                      mask)
+        logprobs, topk_idxes, topk_logprobs = \
+            scorer.score_top_k(word_ids, class_ids, all_class_ids,
+                               all_membership_probs, k + 1, mask)
         for seq_index, seq_logprobs in enumerate(logprobs):
-            seq_word_ids = word_ids[:, seq_index]
-            seq_mask = mask[:, seq_index]
-            seq_word_ids = seq_word_ids[seq_mask == 1]
-            seq_words = words[seq_index]
-            #TODO: Rename the variables properly to remove the hack below
-            merged_words, merged_logprobs = seq_words, seq_logprobs
-            seq_topk_idxes = topk_idxes[seq_index]
+            _write_topk_scores(vocabulary, words[seq_index], seq_logprobs,
+                               topk_idxes[seq_index], topk_logprobs[seq_index],
+                               output_file, log_scale)
 
-            _write_topk_scores(vocabulary, merged_words, merged_logprobs,
-                               seq_topk_idxes, output_file, log_scale)
+class _OrderedOutput(object):
+    """Writes the output of each sentence in the original order of the
+    sentences, when the sentences are scored in a different order.
+    """
+
+    def __init__(self, output_file):
+        """Creates an empty buffer.
+
+        :type output_file: file object
+        :param output_file: a file where to write the output
+        """
+
+        self._output_file = output_file
+        self._pending = dict()
+        self._next_index = 0
+
+    def write(self, index, text):
+        """Writes the output of a sentence, and the buffered output of any
+        sentences that follow it, or buffers the output if some preceding
+        sentence has not been written yet.
+
+        :type index: int
+        :param index: position of the sentence in the input
+
+        :type text: str
+        :param text: output of the sentence
+        """
+
+        self._pending[index] = text
+        while self._next_index in self._pending:
+            self._output_file.write(self._pending.pop(self._next_index))
+            self._next_index += 1
 
 def _merge_subwords(subwords, subword_logprobs, marking):
     """Creates a word list from a subword list.
@@ -598,7 +658,8 @@ def _write_output_vectors(vocabulary, words, logprobs, output_file, log_scale):
                 output_file.write("{:+.6f} ".format(lp))
             output_file.write("{:+.6f}\n".format(logprob[-1]))
 
-def _write_topk_scores(vocabulary, words, logprobs, topk_idxes, output_file, log_scale):
+def _write_topk_scores(vocabulary, words, logprobs, topk_idxes, topk_logprobs,
+                       output_file, log_scale):
     """Writes word-level topk output vector scores to an output file.
 
     :type vocabulary: Vocabulary
@@ -612,6 +673,12 @@ def _write_topk_scores(vocabulary, words, logprobs, topk_idxes, output_file, log
     :type logprobs: list of floats
     :param logprobs: logprob of each word starting from the second word
 
+    :type topk_idxes: list of numpy.ndarrays
+    :param topk_idxes: IDs of the top-k words at each position
+
+    :type topk_logprobs: list of numpy.ndarrays
+    :param topk_logprobs: logprobs of the top-k words at each position
+
     :type output_file: file object
     :param output_file: a file where to write the output
 
@@ -623,7 +690,6 @@ def _write_topk_scores(vocabulary, words, logprobs, topk_idxes, output_file, log
         raise ValueError("Number of logprobs should be exactly one less than "
                          "the number of words.")
 
-    logprobs = [None if x is None else x / log_scale for x in logprobs]
     for index, topk in enumerate(topk_idxes):
         predicted = words[index + 1]
         logprob = logprobs[index]
@@ -631,20 +697,22 @@ def _write_topk_scores(vocabulary, words, logprobs, topk_idxes, output_file, log
             output_file.write("{0} no predictions \n".format(
                 predicted))
         else:
+            topk_logprob = topk_logprobs[index] / log_scale
             pred_word_id = vocabulary.words_to_ids([predicted])[0]
-            output_file.write("{} {:+.6f} ".format(predicted, logprob[pred_word_id]))
+            output_file.write("{} {:+.6f} ".format(predicted, logprob / log_scale))
             found = numpy.where(topk==pred_word_id) 
             if found[0].size > 0 :
                 topk = numpy.delete(topk,[found[0][0]])
+                topk_logprob = numpy.delete(topk_logprob,[found[0][0]])
             else:
                 topk = topk[:-1]
-            for idx in topk[:-1]:
-                output_file.write("{} {:+.6f} ".format(vocabulary.id_to_word[idx], logprob[idx]))
-            idx = topk[-1]
-            output_file.write("{} {:+.6f}\n".format(vocabulary.id_to_word[idx], logprob[idx]))
+                topk_logprob = topk_logprob[:-1]
+            for idx, lp in zip(topk[:-1], topk_logprob[:-1]):
+                output_file.write("{} {:+.6f} ".format(vocabulary.id_to_word[idx], lp))
+            output_file.write("{} {:+.6f}\n".format(vocabulary.id_to_word[topk[-1]], topk_logprob[-1]))
 
 def _score_utterances(input_file, vocabulary, scorer, output_file,
-                      log_base=None):
+                      log_base=None, batch_size=16, sorting_window=1):
     """Reads utterances from ``input_file``, computes LM scores using
     ``scorer``, and writes one score per line to ``output_file``.
 
@@ -668,6 +736,72 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
     :param output_file: a file where to write the output n-best list in SRILM
                         format
 
+    :type log_base: int
+    :param log_base: if set to other than None, convert log probabilities to
+                     this base
+
+    :type batch_size: int
+    :param batch_size: number of sentences to score with one call to the
+                       network
+
+    :type sorting_window: int
+    :param sorting_window: sort the sentences of this many mini-batches at a
+                           time by length
+    """
+
+    scoring_iter = \
+        ScoringBatchIterator(input_file,
+                             vocabulary,
+                             batch_size=batch_size,
+                             max_sequence_length=None,
+                             map_oos_to_unk=False,
+                             sorting_window=sorting_window)
+    ordered_output = _OrderedOutput(output_file)
+    log_scale = 1.0 if log_base is None else numpy.log(log_base)
+
+    num_sentences = 0
+    for word_ids, _, mask in scoring_iter:
+        class_ids, membership_probs = vocabulary.get_class_memberships(word_ids)
+        logprobs = scorer.score_sequences(word_ids, class_ids,
+                                          membership_probs, mask)
+        for sentence_index, lm_score in zip(scoring_iter.sequence_indices,
+                                            logprobs):
+            lm_score /= log_scale
+            ordered_output.write(sentence_index, str(lm_score) + '\n')
+        old_num_sentences = num_sentences
+        num_sentences += len(logprobs)
+        if num_sentences // 1000 > old_num_sentences // 1000:
+            logging.info("%d sentences scored.", num_sentences)
+
+    if scorer.num_words == 0:
+        logging.info("The input file contains no words.")
+    else:
+        logging.info("%d words processed, including start-of-sentence and "
+                     "end-of-sentence tags, and %d (%.1f %%) out-of-vocabulary "
+                     "words", scorer.num_words, scorer.num_unks,
+                     100.0 * scorer.num_unks / scorer.num_words)
+
+def _score_nbest_lists(input_file, scorer, output_file, log_base=None):
+    """Reads n-best lists from ``input_file``, computes LM scores using
+    ``scorer``, and writes one score per line to ``output_file``.
+
+    Each line starts with an utterance ID, followed by the words of one
+    hypothesis. Consecutive lines with the same utterance ID form an n-best
+    list, whose hypotheses are scored together, so that the common prefixes are
+    computed only once. Start-of-sentence and end-of-sentece tags (``<s>`` and
+    ``</s>``) will be inserted at the beginning and the end of each hypothesis,
+    if they're missing. A line that contains only the utterance ID is the empty
+    sentence ``<s> </s>``. Empty lines will be ignored.
+
+    :type input_file: file object
+    :param input_file: a file that contains the n-best lists
+
+    :type scorer: NBestScorer
+    :param scorer: an n-best list scorer for rescoring the hypotheses
+
+    :type output_file: file object
+    :param output_file: a file where to write the scores
+
     :type log_base: int
     :param log_base: if set to other than None, convert log probabilities to
                      this base
@@ -675,20 +809,36 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
 
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
 
-    for line_num, line in enumerate(input_file):
-        lm_score = scorer.score_line(line, vocabulary)
-        if lm_score is None:
+    def write_scores(hypotheses):
+        for lm_score in scorer.score_nbest(hypotheses):
+            output_file.write(str(lm_score / log_scale) + '\n')
+
+    num_utterances = 0
+    utterance_id = None
+    hypotheses = []
+    for line in input_file:
+        fields = line.split(maxsplit=1)
+        if not fields:
             continue
-        lm_score /= log_scale
-        output_file.write(str(lm_score) + '\n')
-        if (line_num + 1) % 1000 == 0:
-            logging.info("%d sentences scored.", line_num + 1)
+        if fields[0] != utterance_id:
+            write_scores(hypotheses)
+            utterance_id = fields[0]
+            hypotheses = []
+            num_utterances += 1
+            if num_utterances % 100 == 0:
+                logging.info("%d utterances scored.", num_utterances)
+        words = fields[1] if len(fields) > 1 else '<s> </s>'
+        hypotheses.append(utterance_from_line(words))
+    write_scores(hypotheses)
 
     if scorer.num_words == 0:
         logging.info("The input file contains no words.")
     else:
         logging.info("%d words processed, including start-of-sentence and "
-              "end-of-sentence tags, and %d (%.1f %%) out-of-vocabulary "
-              "words".format(scorer.num_words,
-                             scorer.num_unks,
-                             scorer.num_unks / scorer.num_words))
+                     "end-of-sentence tags, and %d (%.1f %%) out-of-vocabulary "
+                     "words", scorer.num_words, scorer.num_unks,
+                     100.0 * scorer.num_unks / scorer.num_words)
+        logging.info("%d of %d word probabilities (%.1f %%) computed after "
+                     "merging common prefixes.", scorer.num_computed,
+                     scorer.num_predictions,
+                     100.0 * scorer.num_computed / max(scorer.num_predictions, 1))
@@ -82,6 +82,10 @@ def add_arguments(parser):
     argument_group.add_argument(
         '--batch-size', metavar='N', type=int, default=16,
         help='each mini-batch will contain N sentences (default 16)')
+    argument_group.add_argument(
+        '--validation-sorting-window', metavar='N', type=int, default=1,
+        help='sort the validation sentences of N mini-batches at a time by '
+             'length to reduce padding (default 1, i.e. no sorting)')
     argument_group.add_argument(
         '--validation-frequency', metavar='N', type=int, default='5',
         help='cross-validate for reducing learning rate or early stopping N '
@@ -466,7 +470,8 @@ def train(args):
                                     vocabulary,
                                     batch_size=args.batch_size,
                                     max_sequence_length=args.sequence_length,
-                                    map_oos_to_unk=False)
+                                    map_oos_to_unk=False,
+                                    sorting_window=args.validation_sorting_window)
             trainer.set_validation(validation_iter, scorer)
         else:
             logging.info("Cross-validation will not be performed.")
@@ -17,7 +17,7 @@ from theanolm import Vocabulary
 from theanolm.backend import IncompatibleStateError, InputError
 from theanolm.backend import UniformDistribution, LogUniformDistribution
 from theanolm.backend import MultinomialDistribution
-from theanolm.backend import test_value
+from theanolm.backend import test_value, top_k
 from theanolm.network.architecture import Architecture
 from theanolm.network.networkinput import NetworkInput
 from theanolm.network.projectionlayer import ProjectionLayer
@@ -497,17 +497,22 @@ class Network(object):
             raise RuntimeError("The final layer is not an output layer.")
         return self.output_layer.target_probs
 
-    def argsort_output(self):
-        """Returns the indexes of sorted output probabilities for the whole vocabulary.
+    def top_k_output(self, k):
+        """Returns the ``k`` output classes with the highest probabilities.
 
-        :rtype: Variable
-        :returns: a symbolic 3-dimensional matrix that contains a probability
-                  for each time step, each sequence, and each output class
+        The classes are selected using partial selection, without sorting the
+        whole distribution.
+
+        :type k: int or symbolic integer scalar
+        :param k: number of output classes to select
+
+        :rtype: tuple of two Variables
+        :returns: symbolic 3-dimensional matrices that contain the probabilities
+                  and the IDs of the ``k`` most probable classes, in ascending
+                  order of probability, for each time step and each sequence
         """
 
-        if not hasattr(self.output_layer, 'argsort_output'):
-            raise RuntimeError("The final layer is not an output layer.")
-        return self.output_layer.argsort_output
+        return top_k(self.output_probs(), k)
 
     def unnormalized_logprobs(self):
         """Returns the unnormalized log probabilities for the predicted words.
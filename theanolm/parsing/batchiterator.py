@@ -5,6 +5,7 @@ that read mini-batches.
 """
 
 from abc import abstractmethod, ABCMeta
+from collections import deque
 
 import numpy
 
@@ -18,13 +19,21 @@ class BatchIterator(object, metaclass=ABCMeta):
                  vocabulary,
                  batch_size=1,
                  max_sequence_length=None,
-                 map_oos_to_unk=False):
+                 map_oos_to_unk=False,
+                 sorting_window=1):
         """Constructs an iterator for reading mini-batches.
 
         The iterator can produce word IDs just for the shortlist words by
         setting ``map_oos_to_unk=True``. This is used when reading training
         mini-batches.
 
+        If ``sorting_window`` is greater than one, the iterator reads the
+        sequences of that many mini-batches at a time and sorts them by length
+        before dividing them into mini-batches. This reduces the padding that
+        is needed, when the sequences are of different lengths. The position of
+        each sequence in the input is stored in ``self.sequence_indices``, so
+        that the original order can be restored.
+
         :type vocabulary: Vocabulary
         :param vocabulary: vocabulary that provides mapping between words and
                            word IDs
@@ -40,14 +49,24 @@ class BatchIterator(object, metaclass=ABCMeta):
         :type map_oos_to_unk: bool
         :param map_oos_to_unk: if set to ``True``, out-of-shortlist words will
                                be mapped to ``<unk>``
+
+        :type sorting_window: int
+        :param sorting_window: number of mini-batches whose sequences are
+                               sorted by length together
         """
 
         self._vocabulary = vocabulary
         self._batch_size = batch_size
         self._max_sequence_length = max_sequence_length
         self._map_oos_to_unk = map_oos_to_unk
+        self._sorting_window = sorting_window
         self._buffer = []
         self._end_of_file = False
+        self._sorted_batches = deque()
+        self._num_sequences_read = 0
+        # Index of each sequence of the previous mini-batch within the input
+        # sequences.
+        self.sequence_indices = []
 
     def __iter__(self):
         return self
@@ -69,10 +88,14 @@ class BatchIterator(object, metaclass=ABCMeta):
         :returns: word ID and mask matrix
         """
 
+        if self._sorting_window > 1:
+            return self._next_sorted()
+
         # If EOF was reached on the previous call, but a mini-batch was
         # returned, rewind the file pointer now and raise StopIteration.
         if self._end_of_file:
             self._end_of_file = False
+            self._num_sequences_read = 0
             self._reset()
             raise StopIteration
 
@@ -85,18 +108,79 @@ class BatchIterator(object, metaclass=ABCMeta):
                 continue
             sequences.append(sequence)
             if len(sequences) >= self._batch_size:
+                self._set_sequence_indices(len(sequences))
                 return self._prepare_batch(sequences)
 
         # When end of file is reached, if no lines were read, rewind to first
         # line and raise StopIteration. If lines were read, return them and
         # raise StopIteration the next time this method is called.
         if not sequences:
+            self._num_sequences_read = 0
             self._reset()
             raise StopIteration
         else:
             self._end_of_file = True
+            self._set_sequence_indices(len(sequences))
             return self._prepare_batch(sequences)
 
+    def _next_sorted(self):
+        """Returns the next mini-batch from a window of sequences that have been
+        sorted by length.
+
+        When all the mini-batches of the current window have been returned,
+        reads the sequences of the next ``self._sorting_window`` mini-batches,
+        sorts them by length, and divides them into mini-batches.
+
+        :rtype: tuple of ndarrays
+        :returns: word ID and mask matrix
+        """
+
+        if not self._sorted_batches:
+            if self._end_of_file:
+                self._end_of_file = False
+                self._num_sequences_read = 0
+                self._reset()
+                raise StopIteration
+
+            sequences = []
+            window_size = self._batch_size * self._sorting_window
+            while len(sequences) < window_size:
+                sequence = self._read_sequence()
+                if sequence is None:
+                    self._end_of_file = True
+                    break
+                if len(sequence) < 2:
+                    continue
+                sequences.append((self._num_sequences_read, sequence))
+                self._num_sequences_read += 1
+
+            if not sequences:
+                self._end_of_file = False
+                self._num_sequences_read = 0
+                self._reset()
+                raise StopIteration
+
+            sequences.sort(key=lambda x: len(x[1]))
+            for start in range(0, len(sequences), self._batch_size):
+                self._sorted_batches.append(
+                    sequences[start:start + self._batch_size])
+
+        batch = self._sorted_batches.popleft()
+        self.sequence_indices = [index for index, _ in batch]
+        return self._prepare_batch([sequence for _, sequence in batch])
+
+    def _set_sequence_indices(self, num_sequences):
+        """Sets ``self.sequence_indices`` when the sequences of a mini-batch are
+        in the input order.
+
+        :type num_sequences: int
+        :param num_sequences: number of sequences in the mini-batch
+        """
+
+        start = self._num_sequences_read
+        self._num_sequences_read += num_sequences
+        self.sequence_indices = list(range(start, self._num_sequences_read))
+
     def __len__(self):
         """Returns the number of mini-batches that the iterator creates at each
         epoch.
@@ -15,7 +15,8 @@ class LinearBatchIterator(BatchIterator):
                  vocabulary,
                  batch_size=1,
                  max_sequence_length=None,
-                 map_oos_to_unk=False):
+                 map_oos_to_unk=False,
+                 sorting_window=1):
         """Constructs an iterator for reading mini-batches from given files or
         memory map. This iterator reads the sentences in linear order.
 
@@ -40,6 +41,11 @@ class LinearBatchIterator(BatchIterator):
         :type map_oos_to_unk: bool
         :param map_oos_to_unk: if set to ``True``, out-of-shortlist words will
                                be mapped to ``<unk>``
+
+        :type sorting_window: int
+        :param sorting_window: if greater than one, sort the sequences of this
+                               many mini-batches at a time by length, to reduce
+                               padding
         """
 
         if isinstance(input_files, (list, tuple)):
@@ -52,7 +58,7 @@ class LinearBatchIterator(BatchIterator):
         self._reset()
 
         super().__init__(vocabulary, batch_size, max_sequence_length,
-                         map_oos_to_unk)
+                         map_oos_to_unk, sorting_window)
 
     def _reset(self, shuffle=True):
         """Resets the read pointer back to the beginning of the file.
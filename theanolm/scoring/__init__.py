@@ -4,6 +4,7 @@
 """
 
 from theanolm.scoring.textscorer import TextScorer
+from theanolm.scoring.nbestscorer import NBestScorer
 from theanolm.scoring.latticedecoder import LatticeDecoder
 from theanolm.scoring.latticebatch import LatticeBatch
 from theanolm.scoring.rescoredlattice import RescoredLattice
@@ -0,0 +1,867 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the ColumnarLattice class, a word lattice that is
+stored in arrays.
+"""
+
+import heapq
+import logging
+import math
+
+import numpy
+
+from theanolm.backend import InputError
+from theanolm.backend import logprob_type
+from theanolm.scoring.lattice import Lattice
+
+# The scores of link objects are written as "{}".format(score + 0.0). Depending
+# on the NumPy version, the sum is a float64 or has the same type as the score.
+_score_format_type = type(logprob_type(0.0) + 0.0)
+
+def _to_list(values):
+    """Converts an array into a list of values that are formatted in the same
+    way as the array elements.
+
+    Python floats are formatted in the same way as float64 scalars, so the
+    much faster ``tolist()`` can be used for float64 arrays. Other scalars,
+    e.g. float32, are formatted with fewer digits than Python floats.
+
+    :type values: numpy.ndarray
+    :param values: a vector
+
+    :rtype: list
+    :returns: the elements of ``values``
+    """
+
+    if values.dtype == numpy.float64:
+        return values.tolist()
+    return list(values)
+
+class ColumnarLattice(Lattice):
+    """Word Lattice Stored in Arrays
+
+    Stores the lattice in columns instead of node and link objects. Nodes and
+    links are identified by their index. The attributes of the links are stored
+    in parallel arrays:
+
+    - ``link_start_ids`` and ``link_end_ids``: the node IDs at both ends
+    - ``link_word_ids``: index to ``words``, or -1 for null links
+    - ``link_ac_logprobs`` and ``link_lm_logprobs``: acoustic and language
+      model log probabilities, NaN if not available
+    - ``link_transitions``: transitions for an FST lattice, or ``None``
+
+    ``node_times`` contains the time of each node (NaN if not available) and
+    ``node_final`` tells which nodes are final. The outgoing and incoming links
+    of each node are found from compressed sparse row (CSR) indices:
+    ``out_link_ids[out_offsets[i]:out_offsets[i + 1]]`` are the outgoing links
+    of node ``i`` in the order in which they were defined, and
+    ``in_link_ids`` and ``in_offsets`` similarly give the incoming links.
+
+    The lattice decoder reads the arrays directly. The ``nodes``, ``links``,
+    and ``initial_node`` attributes of the ``Lattice`` interface are created
+    from the arrays when they are accessed for the first time, so that a
+    columnar lattice can be used wherever an object lattice is needed, e.g.
+    for writing the lattice or constructing a rescored lattice.
+    """
+
+    def __init__(self, node_times, link_start_ids, link_end_ids, link_words,
+                 link_ac_logprobs, link_lm_logprobs, initial_node_id,
+                 final_node_ids, link_transitions=None, words=None):
+        """Constructs a lattice from arrays.
+
+        :type node_times: numpy.ndarray
+        :param node_times: time of each node, NaN if not available
+
+        :type link_start_ids: numpy.ndarray
+        :param link_start_ids: the start node ID of each link
+
+        :type link_end_ids: numpy.ndarray
+        :param link_end_ids: the end node ID of each link
+
+        :type link_words: list of strs or numpy.ndarray
+        :param link_words: the word label of each link, ``None`` for null
+                           links; or if ``words`` is given, the index of the
+                           word of each link in ``words``, -1 for null links
+
+        :type link_ac_logprobs: numpy.ndarray
+        :param link_ac_logprobs: acoustic log probability of each link, NaN if
+                                 not available
+
+        :type link_lm_logprobs: numpy.ndarray
+        :param link_lm_logprobs: language model log probability of each link,
+                                 NaN if not available
+
+        :type initial_node_id: int
+        :param initial_node_id: ID of the initial node
+
+        :type final_node_ids: list of ints
+        :param final_node_ids: IDs of the final nodes
+
+        :type link_transitions: list of strs
+        :param link_transitions: transitions for an FST lattice, or ``None``
+
+        :type words: list of strs
+        :param words: if given, ``link_words`` contains indices to this word
+                      table
+        """
+
+        super().__init__()
+        self._nodes = None
+        self._links = None
+        self._initial_node = None
+
+        self.node_times = numpy.asarray(node_times, dtype='float64')
+        num_nodes = self.node_times.size
+        self.node_final = numpy.zeros(num_nodes, dtype=bool)
+        self.node_final[numpy.asarray(final_node_ids, dtype='int64')] = True
+        self.initial_node_id = int(initial_node_id)
+
+        self.link_start_ids = numpy.asarray(link_start_ids, dtype='int64')
+        self.link_end_ids = numpy.asarray(link_end_ids, dtype='int64')
+        self.link_ac_logprobs = numpy.asarray(link_ac_logprobs,
+                                              dtype=logprob_type)
+        self.link_lm_logprobs = numpy.asarray(link_lm_logprobs,
+                                              dtype=logprob_type)
+        self.link_transitions = link_transitions
+
+        if words is not None:
+            self.words = words
+            self.link_word_ids = numpy.asarray(link_words, dtype='int64')
+        else:
+            # Each distinct word is stored only once.
+            word_ids = dict()
+            self.words = []
+            self.link_word_ids = numpy.full(len(link_words), -1, dtype='int64')
+            for link_id, word in enumerate(link_words):
+                if word is None:
+                    continue
+                word_id = word_ids.get(word)
+                if word_id is None:
+                    word_id = len(self.words)
+                    word_ids[word] = word_id
+                    self.words.append(word)
+                self.link_word_ids[link_id] = word_id
+
+        self.out_link_ids, self.out_offsets = \
+            self._csr_index(self.link_start_ids, num_nodes)
+        self.in_link_ids, self.in_offsets = \
+            self._csr_index(self.link_end_ids, num_nodes)
+
+    @classmethod
+    def from_lattice(cls, lattice):
+        """Creates the arrays from the node and link objects of a lattice.
+
+        :type lattice: Lattice
+        :param lattice: a lattice whose node IDs are the indices in the node
+                        list
+
+        :rtype: ColumnarLattice
+        :returns: a lattice with the same topology and scores
+        """
+
+        def to_nan(value):
+            return numpy.nan if value is None else value
+
+        links = lattice.links
+        result = cls(
+            [to_nan(node.time) for node in lattice.nodes],
+            [link.start_node.id for link in links],
+            [link.end_node.id for link in links],
+            [link.word for link in links],
+            [to_nan(link.ac_logprob) for link in links],
+            [to_nan(link.lm_logprob) for link in links],
+            lattice.initial_node.id,
+            [node.id for node in lattice.nodes if node.final],
+            [link.transitions for link in links])
+        result.utterance_id = lattice.utterance_id
+        result.lm_scale = lattice.lm_scale
+        result.wi_penalty = lattice.wi_penalty
+        return result
+
+    def to_columnar(self):
+        """Returns the lattice itself, since it's already stored in arrays.
+
+        :rtype: ColumnarLattice
+        :returns: this lattice
+        """
+
+        return self
+
+    @property
+    def num_nodes(self):
+        """Returns the number of nodes in the lattice.
+
+        :rtype: int
+        :returns: the number of nodes
+        """
+
+        return self.node_times.size
+
+    @property
+    def num_links(self):
+        """Returns the number of links in the lattice.
+
+        :rtype: int
+        :returns: the number of links
+        """
+
+        return self.link_start_ids.size
+
+    @property
+    def nodes(self):
+        """Returns the node objects, creating them on the first call.
+
+        :rtype: list of Lattice.Nodes
+        :returns: all nodes in the order of their IDs
+        """
+
+        if self._nodes is None:
+            self._create_objects()
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, value):
+        self._nodes = value
+
+    @property
+    def links(self):
+        """Returns the link objects, creating them on the first call.
+
+        :rtype: list of Lattice.Links
+        :returns: all links in the order of their IDs
+        """
+
+        if self._links is None:
+            self._create_objects()
+        return self._links
+
+    @links.setter
+    def links(self, value):
+        self._links = value
+
+    @property
+    def initial_node(self):
+        """Returns the initial node object, creating the objects on the first
+        call.
+
+        :rtype: Lattice.Node
+        :returns: the initial node
+        """
+
+        if self._initial_node is None:
+            self._create_objects()
+        return self._initial_node
+
+    @initial_node.setter
+    def initial_node(self, value):
+        self._initial_node = value
+
+    def pruned(self, lm_scale, wi_penalty, beam=None, threshold=None):
+        """Removes the links that are unlikely to be on the best path.
+
+        Runs the forward-backward algorithm using the acoustic and LM log
+        probabilities of the lattice. The score of a link is the acoustic log
+        probability plus the LM log probability scaled by ``lm_scale``, plus
+        ``wi_penalty`` if the link has a word label.
+
+        If ``beam`` is given, the forward and backward passes are also computed
+        using the best path instead of the sum over paths. Then the links whose
+        best path is at least ``beam`` worse than the best path through the
+        lattice are removed. The beam is in the same units as the total log
+        probabilities of the decoder tokens.
+
+        If ``threshold`` is given, the links whose posterior probability is
+        lower than ``threshold`` are removed. The scores are divided by the LM
+        scale when computing the posteriors, as usual, so that the LM
+        probabilities are not scaled and the acoustic probabilities are scaled
+        down.
+
+        Finally the links that are no longer on any path from the initial node
+        to a final node, and the nodes that have no links, are removed.
+
+        :type lm_scale: float
+        :param lm_scale: scale for the LM log probabilities of the lattice
+
+        :type wi_penalty: float
+        :param wi_penalty: penalty added to the log probability of each word
+
+        :type beam: float
+        :param beam: if not ``None``, removes links whose best path is at least
+                     this much worse than the best path through the lattice
+
+        :type threshold: float
+        :param threshold: if not ``None``, removes links whose posterior
+                          probability is lower than this
+
+        :rtype: ColumnarLattice
+        :returns: a pruned copy of the lattice, or the lattice itself if no
+                  path to a final node would remain
+        """
+
+        def log_add(x, y):
+            if x < y:
+                x, y = y, x
+            if y == -math.inf:
+                return x
+            return x + math.log1p(math.exp(y - x))
+
+        sorted_ids = self.sorted_node_ids()
+        positions = numpy.full(self.num_nodes, -1, dtype='int64')
+        positions[sorted_ids] = numpy.arange(len(sorted_ids))
+        start_ids = self.link_start_ids.tolist()
+        end_ids = self.link_end_ids.tolist()
+        scores = numpy.nan_to_num(self.link_ac_logprobs, nan=0.0) + \
+                 numpy.nan_to_num(self.link_lm_logprobs, nan=0.0) * lm_scale
+        scores[self.link_word_ids >= 0] += wi_penalty
+        best_scores = scores.astype('float64').tolist()
+        if lm_scale > 0:
+            scores = (scores / lm_scale).tolist()
+        else:
+            scores = best_scores
+
+        # Links in the topological order of their start and end nodes. Links
+        # from unreachable nodes are skipped.
+        start_positions = positions[self.link_start_ids]
+        forward_order = numpy.argsort(start_positions, kind='stable')
+        forward_order = forward_order[start_positions[forward_order] >= 0]
+        end_positions = positions[self.link_end_ids]
+        backward_order = numpy.argsort(-end_positions, kind='stable')
+        backward_order = backward_order[end_positions[backward_order] >= 0]
+        forward_order = forward_order.tolist()
+        backward_order = backward_order.tolist()
+
+        alpha = [-math.inf] * self.num_nodes
+        best_alpha = [-math.inf] * self.num_nodes
+        alpha[self.initial_node_id] = 0.0
+        best_alpha[self.initial_node_id] = 0.0
+        for link_id in forward_order:
+            start_id = start_ids[link_id]
+            end_id = end_ids[link_id]
+            alpha[end_id] = log_add(alpha[end_id],
+                                    alpha[start_id] + scores[link_id])
+            best_alpha[end_id] = max(best_alpha[end_id],
+                                     best_alpha[start_id] + best_scores[link_id])
+
+        node_final = self.node_final.tolist()
+        beta = [0.0 if final else -math.inf for final in node_final]
+        best_beta = list(beta)
+        for link_id in backward_order:
+            start_id = start_ids[link_id]
+            end_id = end_ids[link_id]
+            beta[start_id] = log_add(beta[start_id],
+                                     scores[link_id] + beta[end_id])
+            best_beta[start_id] = max(best_beta[start_id],
+                                      best_scores[link_id] + best_beta[end_id])
+
+        total = beta[self.initial_node_id]
+        if total == -math.inf:
+            logging.warning("Cannot prune lattice `%s´, because there are no "
+                            "paths to a final node.", self.utterance_id)
+            return self
+
+        alpha = numpy.array(alpha)
+        beta = numpy.array(beta)
+        keep = numpy.isfinite(alpha[self.link_start_ids]) & \
+               numpy.isfinite(beta[self.link_end_ids])
+        if threshold is not None:
+            scores = numpy.array(scores)
+            log_posteriors = alpha[self.link_start_ids] + scores + \
+                             beta[self.link_end_ids] - total
+            keep &= log_posteriors >= math.log(threshold)
+        if beam is not None:
+            best_alpha = numpy.array(best_alpha)
+            best_beta = numpy.array(best_beta)
+            best_scores = numpy.array(best_scores)
+            best_logprobs = best_alpha[self.link_start_ids] + best_scores + \
+                            best_beta[self.link_end_ids]
+            # Allow for rounding errors, so that the best path is always kept.
+            min_logprob = best_beta[self.initial_node_id] - beam
+            min_logprob -= 1e-6 * max(abs(min_logprob), 1.0)
+            keep &= best_logprobs >= min_logprob
+
+        # Removing links by posterior may leave links that don't lead from the
+        # initial node to a final node.
+        reachable = [False] * self.num_nodes
+        reachable[self.initial_node_id] = True
+        for link_id in forward_order:
+            if keep[link_id] and reachable[start_ids[link_id]]:
+                reachable[end_ids[link_id]] = True
+        completable = list(node_final)
+        for link_id in backward_order:
+            if keep[link_id] and completable[end_ids[link_id]]:
+                completable[start_ids[link_id]] = True
+        keep &= numpy.array(reachable)[self.link_start_ids]
+        keep &= numpy.array(completable)[self.link_end_ids]
+
+        if not keep.any():
+            logging.warning("Pruning would remove all paths from lattice `%s´. "
+                            "The lattice will not be pruned.",
+                            self.utterance_id)
+            return self
+
+        logging.debug("Pruned lattice `%s´ from %d to %d links.",
+                      self.utterance_id, self.num_links, keep.sum())
+        return self._link_subset(keep)
+
+    def without_null_links(self, lm_scale):
+        """Removes null links and merges parallel links with the same word.
+
+        A null link from node A to node B is replaced by copies of the
+        outgoing links of B that start from A. The log probabilities of the
+        null link are added to the copies, and the transitions are
+        concatenated. If B is a final node, A becomes a final node. A null link
+        to a final node is kept, however, if it has nonzero log probabilities,
+        because the lattice cannot store them in the node. The nodes are
+        processed in reverse topological order, so that sequences of null links
+        are removed as well.
+
+        Removing the null links may create several links with the same word
+        between the same nodes. Only the link with the highest score, the
+        acoustic log probability plus the LM log probability scaled by
+        ``lm_scale``, is kept. Finally the nodes that cannot be reached from
+        the initial node anymore are removed.
+
+        :type lm_scale: float
+        :param lm_scale: scale for the LM log probabilities, when selecting the
+                         best of parallel links
+
+        :rtype: ColumnarLattice
+        :returns: a copy of the lattice without null links
+        """
+
+        def add(x, y):
+            if x != x:
+                return y
+            if y != y:
+                return x
+            return x + y
+
+        def is_zero(x):
+            return (x != x) or (x == 0.0)
+
+        def score(link):
+            ac_logprob = 0.0 if link[2] != link[2] else link[2]
+            lm_logprob = 0.0 if link[3] != link[3] else link[3]
+            return ac_logprob + lm_scale * lm_logprob
+
+        if self.link_transitions is None:
+            transitions = [None] * self.num_links
+        else:
+            transitions = self.link_transitions
+        # Each link is a tuple of end node ID, word ID, acoustic and LM log
+        # probabilities, and transitions.
+        links = list(zip(self.link_end_ids.tolist(),
+                         self.link_word_ids.tolist(),
+                         self.link_ac_logprobs.tolist(),
+                         self.link_lm_logprobs.tolist(),
+                         transitions))
+        out_link_ids = self.out_link_ids.tolist()
+        out_offsets = self.out_offsets.tolist()
+        node_final = self.node_final.tolist()
+        new_final = list(node_final)
+        out_links = [None] * self.num_nodes
+
+        for node_id in reversed(self.sorted_node_ids()):
+            node_links = []
+            for link_id in out_link_ids[out_offsets[node_id]:
+                                        out_offsets[node_id + 1]]:
+                link = links[link_id]
+                end_id, word_id, ac_logprob, lm_logprob, link_transitions = link
+                if (word_id >= 0) or \
+                   (node_final[end_id] and
+                    not (is_zero(ac_logprob) and is_zero(lm_logprob))):
+                    node_links.append(link)
+                    continue
+                if node_final[end_id]:
+                    new_final[node_id] = True
+                for next_link in out_links[end_id]:
+                    if not link_transitions:
+                        next_transitions = next_link[4]
+                    elif not next_link[4]:
+                        next_transitions = link_transitions
+                    else:
+                        next_transitions = \
+                            link_transitions + "_" + next_link[4]
+                    node_links.append((next_link[0],
+                                       next_link[1],
+                                       add(ac_logprob, next_link[2]),
+                                       add(lm_logprob, next_link[3]),
+                                       next_transitions))
+
+            # Keep the best of the links that have the same end node and word.
+            best_links = dict()
+            for link in node_links:
+                key = (link[0], link[1])
+                best_link = best_links.get(key)
+                if (best_link is None) or (score(link) > score(best_link)):
+                    best_links[key] = link
+            out_links[node_id] = list(best_links.values())
+
+        # Find the nodes that are still reachable from the initial node.
+        new_ids = [-1] * self.num_nodes
+        node_ids = [self.initial_node_id]
+        new_ids[self.initial_node_id] = 0
+        for node_id in node_ids:
+            for link in out_links[node_id]:
+                end_id = link[0]
+                if new_ids[end_id] < 0:
+                    new_ids[end_id] = len(node_ids)
+                    node_ids.append(end_id)
+        new_links = [(new_ids[node_id],) + link
+                     for node_id in node_ids
+                     for link in out_links[node_id]]
+        if new_links:
+            start_ids, end_ids, word_ids, ac_logprobs, lm_logprobs, \
+                transitions = zip(*new_links)
+        else:
+            start_ids = end_ids = word_ids = ac_logprobs = lm_logprobs = \
+                transitions = ()
+        if self.link_transitions is None:
+            transitions = None
+        else:
+            transitions = list(transitions)
+
+        result = ColumnarLattice(
+            self.node_times[node_ids],
+            start_ids,
+            numpy.array(new_ids, dtype='int64')[list(end_ids)],
+            word_ids,
+            ac_logprobs,
+            lm_logprobs,
+            0,
+            [new_ids[node_id] for node_id in node_ids if new_final[node_id]],
+            transitions,
+            words=self.words)
+        result.utterance_id = self.utterance_id
+        result.lm_scale = self.lm_scale
+        result.wi_penalty = self.wi_penalty
+        logging.debug("Removed null links from lattice `%s´: %d nodes and %d "
+                      "links reduced to %d nodes and %d links.",
+                      self.utterance_id, self.num_nodes, self.num_links,
+                      result.num_nodes, result.num_links)
+        return result
+
+    def write_slf(self, output_file):
+        """Writes the lattice in SLF format.
+
+        Converts the arrays into lists, formats the lines of all the nodes and
+        links using a single format string, and writes the entire lattice to
+        the file with a single call.
+
+        :type output_file: file object
+        :param output_file: a file where to write the output
+        """
+
+        lines = ["# Header (generated by TheanoLM)",
+                 "VERSION=1.1",
+                 'UTTERANCE="{}"'.format(self.utterance_id)]
+        fields = []
+        if self.lm_scale is not None:
+            fields.append("lmscale={}".format(self.lm_scale))
+        if self.wi_penalty is not None:
+            fields.append("wdpenalty={}".format(self.wi_penalty))
+        if fields:
+            lines.append("\t".join(fields))
+        lines.append("start={}".format(self.initial_node_id))
+        lines.append("N={}\tL={}".format(self.num_nodes, self.num_links))
+
+        lines.append("# Nodes")
+        lines.extend(self._format_lines(
+            [("I={}", range(self.num_nodes)),
+             ("\tt={}", self.node_times)]))
+
+        lines.append("# Links")
+        word_fields = ["\tW=" + word for word in self.words] + ["\tW=!NULL"]
+        lines.extend(self._format_lines(
+            [("J={}", range(self.num_links)),
+             ("\tS={}", self.link_start_ids.tolist()),
+             ("\tE={}", self.link_end_ids.tolist()),
+             ("{}", [word_fields[word_id]
+                     for word_id in self.link_word_ids.tolist()]),
+             ("\ta={}", self._score_values(self.link_ac_logprobs)),
+             ("\tl={}", self._score_values(self.link_lm_logprobs))]))
+
+        lines.append("")
+        output_file.write("\n".join(lines))
+
+    def write_kaldi(self, output_file, word_to_id):
+        """Writes the lattice in Kaldi CompactLattice format.
+
+        Converts the arrays into lists, formats the lines of all the links
+        using a single format string, and writes the entire lattice to the file
+        with a single call. The links are written in the order of their start
+        nodes.
+
+        :type output_file: file object
+        :param output_file: a file where to write the output
+
+        :type word_to_id: Vocabulary
+        :param word_to_id: mapping of words to Kaldi IDs
+        """
+
+        word_to_id['!SENT_END'] = 0
+
+        link_ids = self.out_link_ids
+        end_ids = self.link_end_ids[link_ids]
+        is_final = self.node_final[end_ids]
+        link_word_ids = self.link_word_ids[link_ids]
+
+        # Map the words of the normal links to Kaldi IDs. Index -1 maps null
+        # links to <eps>.
+        kaldi_ids = numpy.zeros(len(self.words) + 1, dtype='int64')
+        for word_id in numpy.unique(link_word_ids[~is_final]).tolist():
+            word = "<eps>" if word_id < 0 else self.words[word_id]
+            if word == "</s>":
+                word = "!SENT_END"
+            kaldi_ids[word_id] = word_to_id[word]
+
+        if self.link_transitions is None:
+            transitions = [""] * len(link_ids)
+        else:
+            transitions = [self.link_transitions[link_id]
+                           for link_id in link_ids.tolist()]
+        start_ids = self.link_start_ids[link_ids].tolist()
+        lm_weights = _to_list(
+            self._score_values(-self.link_lm_logprobs[link_ids]))
+        ac_weights = _to_list(
+            self._score_values(-self.link_ac_logprobs[link_ids]))
+        lines = list(map("{} {} {} {},{},{}".format,
+                         start_ids,
+                         end_ids.tolist(),
+                         kaldi_ids[link_word_ids].tolist(),
+                         lm_weights,
+                         ac_weights,
+                         transitions))
+        # Links to a final node are written as final weights of the start node.
+        for index in numpy.flatnonzero(is_final).tolist():
+            lines[index] = "{} {},{},{}".format(start_ids[index],
+                                                lm_weights[index],
+                                                ac_weights[index],
+                                                transitions[index])
+
+        lines.insert(0, "{}".format(self.utterance_id))
+        lines.extend(["", ""])
+        output_file.write("\n".join(lines))
+
+    def link_words(self):
+        """Returns the word label of each link.
+
+        :rtype: list of strs
+        :returns: the word of each link, or ``None`` for null links
+        """
+
+        words = self.words
+        return [None if word_id < 0 else words[word_id]
+                for word_id in self.link_word_ids.tolist()]
+
+    def sorted_node_ids(self, return_index=False):
+        """Sorts nodes topologically, then by time.
+
+        Returns the node IDs in the same order as ``Lattice.sorted_nodes()``
+        returns the node objects, but operates on the arrays.
+
+        :type return_index: bool
+        :param return_index: if set to ``True``, returns also the position of
+                             each node and the time of the node at each
+                             position
+
+        :rtype: list of ints, or a tuple of a list and two numpy.ndarrays
+        :returns: the node IDs in sorted order; if ``return_index`` is
+                  ``True``, also a vector that maps node IDs to positions in
+                  the sorted list (-1 for unreachable nodes), and a vector that
+                  contains the time of the node at each position (NaN for
+                  nodes without time stamp)
+        """
+
+        times = self.node_times.tolist()
+        out_offsets = self.out_offsets.tolist()
+        out_end_ids = self.link_end_ids[self.out_link_ids].tolist()
+
+        def heap_key(node_id, counter):
+            time = times[node_id]
+            if time != time:
+                return (1, 0.0, -counter, node_id)
+            return (0, time, -counter, node_id)
+
+        result = []
+        counter = 0
+        node_queue = [heap_key(self.initial_node_id, counter)]
+        in_degrees = numpy.diff(self.in_offsets).tolist()
+        while node_queue:
+            node_id = heapq.heappop(node_queue)[3]
+            result.append(node_id)
+            for next_id in out_end_ids[out_offsets[node_id]:
+                                       out_offsets[node_id + 1]]:
+                in_degrees[next_id] -= 1
+                if in_degrees[next_id] == 0:
+                    counter += 1
+                    heapq.heappush(node_queue, heap_key(next_id, counter))
+                elif in_degrees[next_id] < 0:
+                    raise InputError("Word lattice contains a cycle.")
+
+        if len(result) < self.num_nodes:
+            logging.warning("Word lattice contains unreachable nodes.")
+
+        if not return_index:
+            return result
+
+        positions = numpy.full(self.num_nodes, -1, dtype='int64')
+        positions[result] = numpy.arange(len(result))
+        return result, positions, self.node_times[result]
+
+    def _create_objects(self):
+        """Creates the node and link objects from the arrays.
+        """
+
+        nodes = [self.Node(node_id) for node_id in range(self.num_nodes)]
+        for node, time, final in zip(nodes,
+                                     self.node_times.tolist(),
+                                     self.node_final.tolist()):
+            if time == time:
+                node.time = time
+            node.final = final
+
+        def to_optional(value):
+            return None if numpy.isnan(value) else value
+
+        links = []
+        transitions = self.link_transitions
+        if transitions is None:
+            transitions = [""] * self.num_links
+        for start_id, end_id, word, ac_logprob, lm_logprob, link_transitions \
+            in zip(self.link_start_ids.tolist(),
+                   self.link_end_ids.tolist(),
+                   self.link_words(),
+                   self.link_ac_logprobs,
+                   self.link_lm_logprobs,
+                   transitions):
+            start_node = nodes[start_id]
+            end_node = nodes[end_id]
+            link = self.Link(start_node, end_node, word,
+                             to_optional(ac_logprob), to_optional(lm_logprob),
+                             link_transitions)
+            links.append(link)
+            start_node.out_links.append(link)
+            end_node.in_links.append(link)
+
+        self._nodes = nodes
+        self._links = links
+        self._initial_node = nodes[self.initial_node_id]
+
+    def _link_subset(self, keep):
+        """Creates a lattice that contains a subset of the links.
+
+        The nodes that are not connected to any of the selected links are
+        removed, except the initial node. The remaining nodes are renumbered.
+
+        :type keep: numpy.ndarray
+        :param keep: a boolean vector that tells which links to keep
+
+        :rtype: ColumnarLattice
+        :returns: a lattice that contains only the selected links
+        """
+
+        link_ids = numpy.flatnonzero(keep)
+        start_ids = self.link_start_ids[link_ids]
+        end_ids = self.link_end_ids[link_ids]
+        keep_nodes = numpy.zeros(self.num_nodes, dtype=bool)
+        keep_nodes[start_ids] = True
+        keep_nodes[end_ids] = True
+        keep_nodes[self.initial_node_id] = True
+        new_ids = numpy.cumsum(keep_nodes) - 1
+
+        if self.link_transitions is None:
+            transitions = None
+        else:
+            transitions = [self.link_transitions[link_id]
+                           for link_id in link_ids.tolist()]
+        result = ColumnarLattice(
+            self.node_times[keep_nodes],
+            new_ids[start_ids],
+            new_ids[end_ids],
+            self.link_word_ids[link_ids],
+            self.link_ac_logprobs[link_ids],
+            self.link_lm_logprobs[link_ids],
+            new_ids[self.initial_node_id],
+            new_ids[numpy.flatnonzero(self.node_final & keep_nodes)],
+            transitions,
+            words=self.words)
+        result.utterance_id = self.utterance_id
+        result.lm_scale = self.lm_scale
+        result.wi_penalty = self.wi_penalty
+        return result
+
+    @staticmethod
+    def _format_lines(fields):
+        """Formats one line for each element from columns of field values.
+
+        The lines are formatted using a single format string for all the
+        fields, when possible. A field whose values are in a floating point
+        array is optional; NaN values are omitted from the output.
+
+        :type fields: list of tuples
+        :param fields: a format string for one value and a sequence of values
+                       for each field
+
+        :rtype: list of strs
+        :returns: the formatted lines
+        """
+
+        template = ""
+        columns = []
+        for field_template, values in fields:
+            if isinstance(values, numpy.ndarray) and values.dtype.kind == 'f':
+                missing = numpy.isnan(values)
+                if missing.all():
+                    continue
+                if missing.any():
+                    template += "{}"
+                    columns.append([
+                        "" if is_missing else field_template.format(value)
+                        for value, is_missing in zip(_to_list(values),
+                                                     missing.tolist())])
+                    continue
+                values = _to_list(values)
+            template += field_template
+            columns.append(values)
+        return list(map(template.format, *columns))
+
+    @staticmethod
+    def _score_values(values):
+        """Converts scores to the type that is used when formatting the scores
+        of link objects.
+
+        Adding zero also converts negative zeros to positive zeros.
+
+        :type values: numpy.ndarray
+        :param values: a vector of scores
+
+        :rtype: numpy.ndarray
+        :returns: the scores plus zero, converted to the type of the sum of a
+                  score and a Python float
+        """
+
+        return (values + 0.0).astype(_score_format_type, copy=False)
+
+    @staticmethod
+    def _csr_index(node_ids, num_nodes):
+        """Groups links by one of their end nodes.
+
+        :type node_ids: numpy.ndarray
+        :param node_ids: the start or end node ID of each link
+
+        :type num_nodes: int
+        :param num_nodes: number of nodes in the lattice
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: the link IDs sorted by node ID, retaining the order of links
+                  within a node, and the offset where the links of each node
+                  begin in the sorted array (one more element than there are
+                  nodes)
+        """
+
+        link_ids = numpy.argsort(node_ids, kind='stable')
+        offsets = numpy.zeros(num_nodes + 1, dtype='int64')
+        numpy.cumsum(numpy.bincount(node_ids, minlength=num_nodes),
+                     out=offsets[1:])
+        return link_ids, offsets
@@ -6,9 +6,12 @@
 from collections import namedtuple
 import logging
 
+import numpy
+
 from theanolm.backend import InputError
 from theanolm.backend.probfunctions import logprob_type
 from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.columnarlattice import ColumnarLattice
 
 def read_kaldi_vocabulary(input_file):
     """Reads a word-to-ID mapping from a Kaldi vocabulary file.
@@ -38,17 +41,28 @@ class KaldiLattice(Lattice):
     A word lattice that can be read in Kaldi CompactLattice Format
     """
 
-    def __init__(self, lattice_lines, id_to_word):
+    def __init__(self, lattice_lines, id_to_word, objects=True):
         """Reads a Kaldi lattice file.
 
         If ``lattice_lines`` is ``None``, creates an empty lattice (useful for
         testing).
 
+        The lattice is first parsed into arrays, like ``SLFLattice``. The
+        number of nodes is known from the largest state ID, so the node arrays
+        are allocated at once. An extra final node is added after the states
+        of the lattice, and the final weights are stored in links that lead
+        to that node. Unless ``objects`` is ``False``, the node and link
+        objects are then created from the arrays.
+
         :type lattice_lines: list of strs
         :param lattice_lines: list of lines in Kaldi CompactLattice text format
 
         :type id_to_word: list
         :param id_to_word: mapping of word IDs to words
+
+        :type objects: bool
+        :param objects: if set to ``False``, only reads the arrays and doesn't
+                        create node and link objects
         """
 
         super().__init__()
@@ -58,9 +72,6 @@ class KaldiLattice(Lattice):
 
         self._initial_node_id = None
         self._final_node_id = None
-        final_node = self.Node(None)
-        final_node.final = True
-        self.nodes = []
 
         if lattice_lines is None:
             self._num_nodes = 0
@@ -68,70 +79,135 @@ class KaldiLattice(Lattice):
             return
 
         self.utterance_id = lattice_lines[0].strip()
-        for line in lattice_lines[1:]:
-            line = line.strip()
+        self._read_kaldi_body(lattice_lines[1:], id_to_word)
+        if objects:
+            self._create_objects()
+
+    def _read_kaldi_body(self, lines, id_to_word):
+        """Reads the arcs and final weights into arrays.
+
+        Collects the fields of each line into columns, and converts the
+        numeric columns at once using numpy.
+
+        :type lines: list of strs
+        :param lines: the lines after the utterance ID
+
+        :type id_to_word: list
+        :param id_to_word: mapping of word IDs to words
+        """
+
+        start_ids = []
+        end_ids = []
+        kaldi_word_ids = []
+        graph_values = []
+        ac_values = []
+        transitions = []
+        for line in lines:
             parts = line.split()
             if not parts:
                 continue
-            if len(parts) == 1:
-                state_to = kaldi_word_id = None
-                str_weight = ""
+            if len(parts) == 4:
+                end_ids.append(parts[1])
+                kaldi_word_ids.append(parts[2])
+                str_weight = parts[3]
             elif len(parts) == 2:
-                state_to = kaldi_word_id = None
+                end_ids.append(-1)
+                kaldi_word_ids.append(-1)
                 str_weight = parts[1]
-            elif len(parts) == 4:
-                state_to = int(parts[1])
-                kaldi_word_id = int(parts[2])
-                str_weight = parts[3]
+            elif len(parts) == 1:
+                end_ids.append(-1)
+                kaldi_word_ids.append(-1)
+                str_weight = ""
             else:
                 raise InputError("Invalid number of fields in lattice `{}´ "
-                                 "line `{}´.".format(self.utterance_id, line))
-            state_from = int(parts[0])
+                                 "line `{}´.".format(self.utterance_id,
+                                                     line.strip()))
+            start_ids.append(parts[0])
 
             weight_parts = str_weight.split(',')
-            graph_logprob = logprob_type(weight_parts[0]) \
-                            if len(weight_parts) > 0 and weight_parts[0] \
-                            else logprob_type(0.0)
-            graph_logprob = -graph_logprob * self._log_scale
-            ac_logprob = logprob_type(weight_parts[1]) \
-                         if len(weight_parts) > 1 and weight_parts[1] \
-                         else logprob_type(0.0)
-            ac_logprob = -ac_logprob * self._log_scale
-            transitions = weight_parts[2] if len(weight_parts) > 2 else ""
-
-            if self._initial_node_id is None:
-                self._initial_node_id = state_from
-
-            for id in range(len(self.nodes), state_from + 1):
-                self.nodes.append(self.Node(id))
-            if state_to is not None:
-                for id in range(len(self.nodes), state_to + 1):
-                    self.nodes.append(self.Node(id))
-                link = self._add_link(self.nodes[state_from], self.nodes[state_to])
-                link.word = id_to_word[kaldi_word_id]
-                if link.word == "<eps>":
-                    link.word = None
-                elif link.word == "#0":
-                    raise InputError("Lattice `{}´ contains backoff transitions. "
-                                     "Fix with Kaldi commands."
+            graph_values.append(weight_parts[0] or 0)
+            ac_values.append(weight_parts[1]
+                             if len(weight_parts) > 1 and weight_parts[1]
+                             else 0)
+            transitions.append(weight_parts[2] if len(weight_parts) > 2
+                               else "")
+
+        if not start_ids:
+            raise InputError("No links in lattice `{}´."
+                             .format(self.utterance_id))
+
+        self.link_start_ids = numpy.array(start_ids).astype('int64')
+        self.link_end_ids = numpy.array(end_ids).astype('int64')
+        kaldi_word_ids = numpy.array(kaldi_word_ids).astype('int64')
+        self._initial_node_id = int(self.link_start_ids[0])
+
+        # The final node follows the largest state ID.
+        self._final_node_id = int(max(self.link_start_ids.max(),
+                                      self.link_end_ids.max())) + 1
+        self._num_nodes = self._final_node_id + 1
+        self._num_links = self.link_start_ids.size
+        self.link_end_ids[self.link_end_ids < 0] = self._final_node_id
+        self.node_times = numpy.full(self._num_nodes, numpy.nan)
+
+        graph_logprobs = numpy.array(graph_values).astype(logprob_type)
+        self.link_lm_logprobs = -graph_logprobs * self._log_scale
+        ac_logprobs = numpy.array(ac_values).astype(logprob_type)
+        self.link_ac_logprobs = -ac_logprobs * self._log_scale
+        self.link_transitions = transitions
+
+        # Each Kaldi word ID is mapped to a word only once. Links to the final
+        # node have word ID -1.
+        unique_ids, link_unique_ids = numpy.unique(kaldi_word_ids,
+                                                   return_inverse=True)
+        self.words = []
+        unique_word_ids = numpy.full(unique_ids.size, -1, dtype='int64')
+        for index, kaldi_word_id in enumerate(unique_ids.tolist()):
+            if kaldi_word_id < 0:
+                word = "!SENT_END"
+            else:
+                word = id_to_word[kaldi_word_id]
+                if word == "<eps>":
+                    continue
+                elif word == "#0":
+                    raise InputError("Lattice `{}´ contains backoff "
+                                     "transitions. Fix with Kaldi commands."
                                      .format(self.utterance_id))
-                elif (link.word == "<s>") or (link.word == "</s>"):
+                elif (word == "<s>") or (word == "</s>"):
                     raise InputError("Lattice `{}´ contains traditional start "
                                      "and end of sentence symbols."
                                      .format(self.utterance_id))
-            else:
-                link = self._add_link(self.nodes[state_from], final_node)
-                link.word = "!SENT_END"
-                #assert transitions == ""
+            unique_word_ids[index] = len(self.words)
+            self.words.append(word)
+        self.link_word_ids = unique_word_ids[link_unique_ids]
 
-            link.ac_logprob = ac_logprob
-            link.lm_logprob = graph_logprob
-            link.transitions = transitions
+    def to_columnar(self):
+        """Creates a columnar lattice from the arrays that were read from the
+        file, without going through the node and link objects.
 
-        if self._initial_node_id is None:
-            raise InputError("No links in lattice `{}´."
-                             .format(self.utterance_id))
-        self.initial_node = self.nodes[self._initial_node_id]
+        :rtype: ColumnarLattice
+        :returns: a lattice with the same topology and scores, stored in arrays
+        """
+
+        result = ColumnarLattice(self.node_times,
+                                 self.link_start_ids,
+                                 self.link_end_ids,
+                                 self.link_word_ids,
+                                 self.link_ac_logprobs,
+                                 self.link_lm_logprobs,
+                                 self._initial_node_id,
+                                 [self._final_node_id],
+                                 self.link_transitions,
+                                 words=self.words)
+        result.utterance_id = self.utterance_id
+        result.lm_scale = self.lm_scale
+        result.wi_penalty = self.wi_penalty
+        return result
+
+    def _create_objects(self):
+        """Creates the node and link objects from the arrays.
+        """
 
-        final_node.id = len(self.nodes)
-        self.nodes.append(final_node)
+        columnar = self.to_columnar()
+        self.nodes = columnar.nodes
+        self.links = columnar.links
+        self.initial_node = columnar.initial_node
@@ -3,8 +3,11 @@
 """A module that implements the Lattice class used by word lattice decoders.
 """
 
+import heapq
 import logging
 
+import numpy
+
 from theanolm.backend import InputError
 
 class NodeNotFoundError(Exception):
@@ -90,52 +93,60 @@ class Lattice(object):
         self.lm_scale = None
         self.wi_penalty = None
 
+    def to_columnar(self):
+        """Converts the lattice into arrays.
+
+        :rtype: ColumnarLattice
+        :returns: a lattice with the same topology and scores, stored in arrays
+        """
+
+        from theanolm.scoring.columnarlattice import ColumnarLattice
+        return ColumnarLattice.from_lattice(self)
+
+    def pruned(self, lm_scale, wi_penalty, beam=None, threshold=None):
+        """Removes the links that are unlikely to be on the best path.
+
+        The lattice is converted into arrays and pruned by
+        ``ColumnarLattice.pruned()``.
+
+        :type lm_scale: float
+        :param lm_scale: scale for the LM log probabilities of the lattice
+
+        :type wi_penalty: float
+        :param wi_penalty: penalty added to the log probability of each word
+
+        :type beam: float
+        :param beam: if not ``None``, removes links whose best path is at least
+                     this much worse than the best path through the lattice
+
+        :type threshold: float
+        :param threshold: if not ``None``, removes links whose posterior
+                          probability is lower than this
+
+        :rtype: ColumnarLattice
+        :returns: a pruned copy of the lattice
+        """
+
+        return self.to_columnar().pruned(lm_scale, wi_penalty, beam, threshold)
+
     def write_slf(self, output_file):
         """Writes the lattice in SLF format.
 
+        The node and link objects are first converted into arrays, and the
+        output is formatted from the arrays by ``ColumnarLattice``.
+
         :type output_file: file object
         :param output_file: a file where to write the output
         """
 
-        output_file.write("# Header (generated by TheanoLM)\n")
-        output_file.write("VERSION=1.1\n")
-        output_file.write('UTTERANCE="{}"\n'.format(self.utterance_id))
-        fields = []
-        if self.lm_scale is not None:
-            fields.append("lmscale={}".format(self.lm_scale))
-        if self.wi_penalty is not None:
-            fields.append("wdpenalty={}".format(self.wi_penalty))
-        if fields:
-            output_file.write("\t".join(fields) + "\n")
-        output_file.write("start={}\n".format(self.initial_node.id))
-        output_file.write("N={}\tL={}\n"
-                          .format(len(self.nodes), len(self.links)))
-
-        output_file.write("# Nodes\n")
-        for node in self.nodes:
-            fields = ["I={}".format(node.id)]
-            if node.time is not None:
-                fields.append("t={}".format(node.time))
-            output_file.write("\t".join(fields) + "\n")
-
-        output_file.write("# Links\n")
-        for link_id, link in enumerate(self.links):
-            fields = ["J={}".format(link_id),
-                      "S={}".format(link.start_node.id),
-                      "E={}".format(link.end_node.id)]
-            if link.word is None:
-                fields.append("W=!NULL")
-            else:
-                fields.append("W={}".format(link.word))
-            if link.ac_logprob is not None:
-                fields.append("a={}".format(link.ac_logprob + 0.0))
-            if link.lm_logprob is not None:
-                fields.append("l={}".format(link.lm_logprob + 0.0))
-            output_file.write("\t".join(fields) + "\n")
+        self._to_columns().write_slf(output_file)
 
     def write_kaldi(self, output_file, word_to_id):
         """Writes the lattice in Kaldi CompactLattice format.
 
+        The node and link objects are first converted into arrays, and the
+        output is formatted from the arrays by ``ColumnarLattice``.
+
         :type output_file: file object
         :param output_file: a file where to write the output
 
@@ -143,62 +154,55 @@ class Lattice(object):
         :param word_to_id: mapping of words to Kaldi IDs
         """
 
-        def write_normal_link(link):
-            word = link.word
-            if word is None:
-                word = "<eps>"
-            elif word == "</s>":
-                word = "!SENT_END"
-            output_file.write("{} {} {} {},{},{}\n".format(
-                link.start_node.id,
-                link.end_node.id,
-                word_to_id[word],
-                -link.lm_logprob + 0.0,
-                -link.ac_logprob + 0.0,
-                link.transitions))
-
-        def write_final_link(link):
-            output_file.write("{} {},{},{}\n".format(
-                link.start_node.id,
-                -link.lm_logprob + 0.0,
-                -link.ac_logprob + 0.0,
-                link.transitions))
-
-        word_to_id['!SENT_END'] = 0
-
-        output_file.write("{}\n".format(self.utterance_id))
-        for node in self.nodes:
-            for link in node.out_links:
-                if link.end_node.final:
-                    write_final_link(link)
-                else:
-                    write_normal_link(link)
-        output_file.write("\n")
+        self._to_columns().write_kaldi(output_file, word_to_id)
 
-    def sorted_nodes(self):
+    def sorted_nodes(self, return_index=False):
         """Sorts nodes topologically, then by time.
 
         Returns a list which contains the nodes in sorted order. Uses the Kahn's
         algorithm to sort the nodes topologically, but always picks the node
         from the queue that has the lowest time stamp, if the nodes contain time
-        stamps.
+        stamps. The queue is a binary heap. Nodes without time stamp are picked
+        last, and of the nodes with equal time, the one that was added to the
+        queue last is picked first.
+
+        :type return_index: bool
+        :param return_index: if set to ``True``, returns also the position of
+                             each node and the time of the node at each
+                             position
+
+        :rtype: list of Lattice.Nodes, or a tuple of a list and two
+                numpy.ndarrays
+        :returns: the nodes in sorted order; if ``return_index`` is ``True``,
+                  also a vector that maps node IDs to positions in the sorted
+                  list (-1 for unreachable nodes), and a vector that contains
+                  the time of the node at each position (NaN for nodes without
+                  time stamp)
         """
 
+        def heap_key(node, counter):
+            if node.time is None:
+                return (1, 0.0, -counter)
+            return (0, node.time, -counter)
+
         result = []
         # A queue of nodes to be visited next:
-        node_queue = [self.initial_node]
+        counter = 0
+        node_queue = [(heap_key(self.initial_node, counter),
+                       self.initial_node.id)]
         # The number of incoming links not traversed yet:
         in_degrees = [len(node.in_links) for node in self.nodes]
         while node_queue:
-            node = node_queue.pop()
+            _, node_id = heapq.heappop(node_queue)
+            node = self.nodes[node_id]
             result.append(node)
             for link in node.out_links:
                 next_node = link.end_node
                 in_degrees[next_node.id] -= 1
                 if in_degrees[next_node.id] == 0:
-                    node_queue.append(next_node)
-                    node_queue.sort(key=lambda x: (x.time is None, x.time),
-                                    reverse=True)
+                    counter += 1
+                    heapq.heappush(node_queue,
+                                   (heap_key(next_node, counter), next_node.id))
                 elif in_degrees[next_node.id] < 0:
                     raise InputError("Word lattice contains a cycle.")
 
@@ -207,7 +211,29 @@ class Lattice(object):
         else:
             assert len(result) == len(self.nodes)
 
-        return result
+        if not return_index:
+            return result
+
+        positions = numpy.full(len(self.nodes), -1, dtype='int64')
+        positions[[node.id for node in result]] = numpy.arange(len(result))
+        times = numpy.array([numpy.nan if node.time is None else node.time
+                             for node in result],
+                            dtype='float64')
+        return result, positions, times
+
+    def _to_columns(self):
+        """Creates a columnar copy of the current node and link objects.
+
+        Unlike ``to_columnar()``, which may return arrays that were created
+        when reading the lattice, the result always reflects the objects.
+
+        :rtype: ColumnarLattice
+        :returns: a lattice that stores the same nodes and links in arrays
+        """
+
+        # Imported here to avoid a circular import.
+        from theanolm.scoring.columnarlattice import ColumnarLattice
+        return ColumnarLattice.from_lattice(self)
 
     def _add_link(self, start_node, end_node):
         """Adds a link between two nodes.
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the LatticeArchive class for storing a collection
+of word lattices in a binary file.
+"""
+
+import h5py
+import numpy
+
+from theanolm.backend import InputError
+from theanolm.backend import logprob_type
+from theanolm.scoring.columnarlattice import ColumnarLattice
+
+def _read_strings(dataset):
+    """Reads a string dataset from an HDF5 file.
+
+    Depending on the h5py version, variable-length strings are read as ``str``
+    or ``bytes`` objects.
+
+    :type dataset: h5py.Dataset
+    :param dataset: a dataset of variable-length strings
+
+    :rtype: list of strs
+    :returns: the strings in the dataset
+    """
+
+    return [value.decode('utf-8') if isinstance(value, bytes) else value
+            for value in dataset[()]]
+
+class LatticeArchive(object):
+    """Binary Lattice Archive
+
+    Stores the arrays of a collection of columnar lattices in an HDF5 file.
+    The node and link arrays of all the lattices are concatenated, and an index
+    contains the offset where the nodes and links of each utterance begin. The
+    word labels are stored in a single word table that is shared by all the
+    lattices.
+
+    The numeric arrays are stored contiguously without compression, so that
+    they can be memory-mapped. Reading a lattice takes only a slice of each
+    array, without parsing anything, and any lattice can be read by its
+    utterance ID.
+    """
+
+    FORMAT_VERSION = 1
+
+    # Arrays that contain one element per node or link of every lattice.
+    _NODE_ARRAYS = ['node_times', 'node_final']
+    _LINK_ARRAYS = ['link_start_ids', 'link_end_ids', 'link_word_ids',
+                    'link_ac_logprobs', 'link_lm_logprobs']
+
+    def __init__(self, path):
+        """Opens a lattice archive and memory-maps its arrays.
+
+        The strings (utterance IDs, word table, and transitions) are read into
+        memory and the HDF5 file is closed, so that the archive object can be
+        used in forked processes.
+
+        :type path: str
+        :param path: path to a lattice archive created by ``write()``
+        """
+
+        self.path = path
+        with h5py.File(path, 'r') as h5_file:
+            if 'lattices' not in h5_file:
+                raise InputError("`{}´ is not a lattice archive.".format(path))
+            h5_lattices = h5_file['lattices']
+            version = h5_lattices.attrs.get('format_version')
+            if version != self.FORMAT_VERSION:
+                raise InputError("Unsupported lattice archive version in `{}´."
+                                 .format(path))
+
+            self.utterance_ids = \
+                _read_strings(h5_lattices['utterance_ids'])
+            self._words = _read_strings(h5_lattices['words'])
+            if 'link_transitions' in h5_lattices:
+                self._transitions = \
+                    _read_strings(h5_lattices['link_transitions'])
+            else:
+                self._transitions = None
+
+            self._node_offsets = h5_lattices['node_offsets'][()]
+            self._link_offsets = h5_lattices['link_offsets'][()]
+            self._initial_node_ids = h5_lattices['initial_node_ids'][()]
+            self._lm_scales = h5_lattices['lm_scales'][()]
+            self._wi_penalties = h5_lattices['wi_penalties'][()]
+            self._arrays = dict()
+            for name in self._NODE_ARRAYS + self._LINK_ARRAYS:
+                self._arrays[name] = self._map_dataset(h5_lattices[name])
+
+        self._utterance_indices = {utterance_id: index
+                                   for index, utterance_id
+                                   in enumerate(self.utterance_ids)}
+
+    def __len__(self):
+        """Returns the number of lattices in the archive.
+
+        :rtype: int
+        :returns: the number of lattices
+        """
+
+        return len(self.utterance_ids)
+
+    def __getitem__(self, key):
+        """Reads a lattice from the archive.
+
+        :type key: int or str
+        :param key: index of the lattice in the archive, or its utterance ID
+
+        :rtype: ColumnarLattice
+        :returns: the lattice
+        """
+
+        if isinstance(key, str):
+            try:
+                key = self._utterance_indices[key]
+            except KeyError:
+                raise KeyError("Utterance `{}´ not found from lattice archive "
+                               "`{}´.".format(key, self.path))
+        return self.read_lattice(key)
+
+    def index(self, utterance_id):
+        """Finds the index of a lattice from its utterance ID.
+
+        :type utterance_id: str
+        :param utterance_id: the utterance ID of a lattice
+
+        :rtype: int
+        :returns: index of the lattice in the archive
+        """
+
+        return self._utterance_indices[utterance_id]
+
+    def lattice_sizes(self):
+        """Returns the size of each lattice in bytes.
+
+        The sizes can be used for splitting the archive into parts that take
+        approximately equally long to read.
+
+        :rtype: numpy.ndarray
+        :returns: a vector containing the number of bytes used by each lattice
+        """
+
+        node_bytes = sum(self._arrays[name].dtype.itemsize
+                         for name in self._NODE_ARRAYS)
+        link_bytes = sum(self._arrays[name].dtype.itemsize
+                         for name in self._LINK_ARRAYS)
+        return numpy.diff(self._node_offsets) * node_bytes + \
+               numpy.diff(self._link_offsets) * link_bytes
+
+    def read_lattice(self, index):
+        """Reads a lattice from the archive.
+
+        :type index: int
+        :param index: index of the lattice in the archive
+
+        :rtype: ColumnarLattice
+        :returns: the lattice
+        """
+
+        node_begin, node_end = self._node_offsets[index:index + 2]
+        link_begin, link_end = self._link_offsets[index:index + 2]
+        arrays = self._arrays
+
+        # The lattice gets its own word table that contains only the words
+        # that are used in the lattice.
+        link_word_ids = numpy.array(arrays['link_word_ids'][link_begin:link_end])
+        is_word = link_word_ids >= 0
+        word_ids, link_word_ids[is_word] = \
+            numpy.unique(link_word_ids[is_word], return_inverse=True)
+        words = [self._words[word_id] for word_id in word_ids.tolist()]
+
+        if self._transitions is None:
+            transitions = None
+        else:
+            transitions = self._transitions[link_begin:link_end]
+
+        node_final = arrays['node_final'][node_begin:node_end]
+        result = ColumnarLattice(
+            arrays['node_times'][node_begin:node_end],
+            arrays['link_start_ids'][link_begin:link_end],
+            arrays['link_end_ids'][link_begin:link_end],
+            link_word_ids,
+            arrays['link_ac_logprobs'][link_begin:link_end],
+            arrays['link_lm_logprobs'][link_begin:link_end],
+            self._initial_node_ids[index],
+            numpy.flatnonzero(node_final),
+            transitions,
+            words=words)
+        result.utterance_id = self.utterance_ids[index]
+        lm_scale = self._lm_scales[index]
+        if not numpy.isnan(lm_scale):
+            result.lm_scale = logprob_type(lm_scale)
+        wi_penalty = self._wi_penalties[index]
+        if not numpy.isnan(wi_penalty):
+            result.wi_penalty = logprob_type(wi_penalty)
+        return result
+
+    @classmethod
+    def write(cls, path, lattices):
+        """Writes a collection of lattices into an archive.
+
+        :type path: str
+        :param path: path to the archive file to be created
+
+        :type lattices: iterable of Lattices
+        :param lattices: the lattices to be written; they will be converted to
+                         columnar lattices
+        """
+
+        def to_nan(value):
+            return numpy.nan if value is None else value
+
+        columns = {name: [] for name in cls._NODE_ARRAYS + cls._LINK_ARRAYS}
+        utterance_ids = []
+        node_offsets = [0]
+        link_offsets = [0]
+        initial_node_ids = []
+        lm_scales = []
+        wi_penalties = []
+        transitions = []
+        has_transitions = False
+        word_ids = dict()
+        for lattice in lattices:
+            lattice = lattice.to_columnar()
+            if lattice.utterance_id is None:
+                utterance_id = str(len(utterance_ids))
+            else:
+                utterance_id = lattice.utterance_id
+            utterance_ids.append(utterance_id)
+            node_offsets.append(node_offsets[-1] + lattice.num_nodes)
+            link_offsets.append(link_offsets[-1] + lattice.num_links)
+            initial_node_ids.append(lattice.initial_node_id)
+            lm_scales.append(to_nan(lattice.lm_scale))
+            wi_penalties.append(to_nan(lattice.wi_penalty))
+
+            # Map the word table of the lattice to the archive word table.
+            table = numpy.array([word_ids.setdefault(word, len(word_ids))
+                                 for word in lattice.words] + [-1],
+                                dtype='int64')
+            columns['link_word_ids'].append(table[lattice.link_word_ids])
+            columns['node_times'].append(lattice.node_times)
+            columns['node_final'].append(lattice.node_final.astype('int8'))
+            columns['link_start_ids'].append(lattice.link_start_ids)
+            columns['link_end_ids'].append(lattice.link_end_ids)
+            columns['link_ac_logprobs'].append(lattice.link_ac_logprobs)
+            columns['link_lm_logprobs'].append(lattice.link_lm_logprobs)
+            if lattice.link_transitions is None:
+                transitions.extend([""] * lattice.num_links)
+            else:
+                transitions.extend(lattice.link_transitions)
+                has_transitions = True
+
+        dtypes = {'node_times': 'float64',
+                  'node_final': 'int8',
+                  'link_start_ids': 'int64',
+                  'link_end_ids': 'int64',
+                  'link_word_ids': 'int64',
+                  'link_ac_logprobs': 'float64',
+                  'link_lm_logprobs': 'float64'}
+        str_dtype = h5py.special_dtype(vlen=str)
+        words = [None] * len(word_ids)
+        for word, word_id in word_ids.items():
+            words[word_id] = word
+
+        with h5py.File(path, 'w') as h5_file:
+            h5_lattices = h5_file.create_group('lattices')
+            h5_lattices.attrs['format_version'] = cls.FORMAT_VERSION
+            h5_lattices.create_dataset('utterance_ids', data=utterance_ids,
+                                       dtype=str_dtype)
+            h5_lattices.create_dataset('words', data=words, dtype=str_dtype)
+            if has_transitions:
+                h5_lattices.create_dataset('link_transitions',
+                                           data=transitions, dtype=str_dtype)
+            h5_lattices.create_dataset(
+                'node_offsets', data=numpy.array(node_offsets, dtype='int64'))
+            h5_lattices.create_dataset(
+                'link_offsets', data=numpy.array(link_offsets, dtype='int64'))
+            h5_lattices.create_dataset(
+                'initial_node_ids',
+                data=numpy.array(initial_node_ids, dtype='int64'))
+            h5_lattices.create_dataset(
+                'lm_scales', data=numpy.array(lm_scales, dtype='float64'))
+            h5_lattices.create_dataset(
+                'wi_penalties', data=numpy.array(wi_penalties, dtype='float64'))
+            for name, dtype in dtypes.items():
+                if columns[name]:
+                    data = numpy.concatenate(columns[name]).astype(dtype)
+                else:
+                    data = numpy.zeros(0, dtype=dtype)
+                h5_lattices.create_dataset(name, data=data)
+
+    def _map_dataset(self, dataset):
+        """Memory-maps an HDF5 dataset, if it's stored contiguously.
+
+        :type dataset: h5py.Dataset
+        :param dataset: a numeric dataset in the archive
+
+        :rtype: numpy.ndarray
+        :returns: a memory-mapped array, or the contents of the dataset read
+                  into memory if it cannot be memory-mapped
+        """
+
+        offset = dataset.id.get_offset()
+        if (offset is None) or (dataset.size == 0):
+            return dataset[()]
+        return numpy.memmap(self.path, dtype=dataset.dtype, mode='r',
+                            offset=offset, shape=dataset.shape)
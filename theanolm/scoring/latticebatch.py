@@ -3,22 +3,196 @@
 """A module that implements the "theanolm decode" command.
 """
 
+import codecs
 import logging
+import os
+import queue
+import re
+import threading
 
-from theanolm.backend import TextFileType
+import numpy
+
+from theanolm.backend import TextFileType, InputError
+from theanolm.backend.filetypes import BinaryFileType
+from theanolm.scoring.latticearchive import LatticeArchive
 from theanolm.scoring.slflattice import SLFLattice
 from theanolm.scoring.kaldilattice import KaldiLattice, read_kaldi_vocabulary
 
+def _read_kaldi_utterances(lattice_file, chunk_size=4194304):
+    """A generator for iterating through the lattices of a Kaldi text archive.
+
+    Reads the file in large chunks and finds the empty lines that separate the
+    lattices using a regular expression, instead of processing the file line
+    by line.
+
+    :type lattice_file: file object
+    :param lattice_file: a Kaldi lattice archive in text format
+
+    :type chunk_size: int
+    :param chunk_size: number of characters to read at a time
+
+    :rtype: generator for lists of strs
+    :returns: generates the non-empty lines of each lattice, stripped of
+              whitespace
+    """
+
+    separator = re.compile(r'\n\s*\n')
+    remainder = ""
+    while True:
+        chunk = lattice_file.read(chunk_size)
+        if not chunk:
+            break
+        # The text after the last separator may be an incomplete lattice.
+        blocks = separator.split(remainder + chunk)
+        remainder = blocks.pop()
+        for block in blocks:
+            lattice_lines = [line.strip() for line in block.splitlines()]
+            lattice_lines = [line for line in lattice_lines if line]
+            if lattice_lines:
+                yield lattice_lines
+    lattice_lines = [line.strip() for line in remainder.splitlines()]
+    lattice_lines = [line for line in lattice_lines if line]
+    if lattice_lines:
+        yield lattice_lines
+
+def _parse_rspecifier(rspecifier):
+    """Parses a Kaldi-style read specifier.
+
+    A specifier such as ``scp:lattices.scp`` or ``ark,t:lattices.ark`` gives
+    the type of the file explicitly. Otherwise files whose name ends in
+    ``.scp`` are considered script files and other files archives.
+
+    :type rspecifier: str
+    :param rspecifier: a file path, possibly preceded by ``ark:`` or ``scp:``
+                       and options
+
+    :rtype: tuple of two strs
+    :returns: ``ark`` or ``scp``, and the file path
+    """
+
+    match = re.match(r'^(ark|scp)(,[a-z]+)*:(.*)$', rspecifier)
+    if match:
+        return match.group(1), match.group(3)
+    if rspecifier.endswith('.scp'):
+        return 'scp', rspecifier
+    return 'ark', rspecifier
+
+def _read_kaldi_scp(scp_file):
+    """Reads the utterance IDs and archive locations from a Kaldi script file.
+
+    Each line contains an utterance ID and the path to an archive, followed by
+    a colon and the byte offset where the lattice begins.
+
+    :type scp_file: file object
+    :param scp_file: a Kaldi script file
+
+    :rtype: list of tuples
+    :returns: the utterance ID, archive path, and offset of each lattice
+    """
+
+    result = []
+    for line in scp_file:
+        parts = line.split(maxsplit=1)
+        if not parts:
+            continue
+        if len(parts) != 2:
+            raise InputError("Invalid line in Kaldi script file: `{}´"
+                             .format(line.strip()))
+        utterance_id, location = parts
+        location = location.strip()
+        path, _, offset = location.rpartition(':')
+        if path and offset.isdigit():
+            result.append((utterance_id, path, int(offset)))
+        else:
+            result.append((utterance_id, location, 0))
+    return result
+
+class _BackgroundDecompressor(object):
+    """Decompresses a gzip or bzip2 file in a background thread.
+
+    The thread reads and decompresses the file in large chunks and passes them
+    to the reader through a bounded queue. The decompression libraries release
+    the global interpreter lock, so decompression runs in parallel with the
+    main thread.
+    """
+
+    def __init__(self, path, chunk_size=4194304, max_chunks=4):
+        """Starts the decompression thread.
+
+        :type path: str
+        :param path: path to a file whose name ends in ".gz" or ".bz2"
+
+        :type chunk_size: int
+        :param chunk_size: number of bytes to decompress at a time
+
+        :type max_chunks: int
+        :param max_chunks: maximum number of decompressed chunks waiting in the
+                           queue
+        """
+
+        self._input_file = BinaryFileType('r')(path)
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(max_chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._finished = False
+        thread = threading.Thread(target=self._decompress, daemon=True)
+        thread.start()
+
+    def read(self, size=-1):
+        """Returns the next decompressed chunk of text.
+
+        The size of the returned text is not necessarily ``size``.
+
+        :type size: int
+        :param size: ignored
+
+        :rtype: str
+        :returns: the next chunk of text, or an empty string at the end of the
+                  file
+        """
+
+        while not self._finished:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._finished = True
+                return self._decoder.decode(b'', final=True)
+            if isinstance(chunk, Exception):
+                self._finished = True
+                raise chunk
+            text = self._decoder.decode(chunk)
+            if text:
+                return text
+        return ""
+
+    def _decompress(self):
+        """Reads the file and puts the decompressed chunks in the queue.
+        ``None`` is put in the queue at the end of the file, or an exception
+        if reading fails.
+        """
+
+        try:
+            with self._input_file:
+                while True:
+                    chunk = self._input_file.read(self._chunk_size)
+                    if not chunk:
+                        break
+                    self._queue.put(chunk)
+        except Exception as exception:
+            self._queue.put(exception)
+            return
+        self._queue.put(None)
+
 class LatticeBatch(object):
     def __init__(self, lattices, lattice_list_file, lattice_format,
-                 kaldi_vocabulary=None, num_jobs=1, job_id=0):
+                 kaldi_vocabulary=None, num_jobs=1, job_id=0, prefetch=0):
         """Reads the Kaldi word ID mapping, if given, and slices the lattices
         corresponding to the given job ID.
 
         If there's nothing else in the lattice list, adds the standard input.
 
         :type lattices: list of strs
-        :param lattices: a list of lattice file paths
+        :param lattices: a list of lattice file paths; Kaldi lattices can also
+                         be given as ``ark:`` and ``scp:`` read specifiers
 
         :type lattice_list_file: file object
         :param lattice_list_file: a file containing paths to lattice files that
@@ -26,18 +200,28 @@ class LatticeBatch(object):
 
         :type lattice_format: str
         :param lattice_format: format in which the lattices are saved; either
-                               ``slf`` or ``kaldi``
+                               ``slf``, ``kaldi``, or ``archive`` (a binary
+                               lattice archive created with ``theanolm
+                               archive``)
 
         :type kaldi_vocabulary: file object
         :param kaldi_vocabulary: if not ``None``, the word to ID mapping for
                                  Kaldi lattices will be read from this file
 
         :type num_jobs: int
-        :param num_jobs: split the lattice files to this many jobs
+        :param num_jobs: split the lattice files to this many jobs; lattice
+                         archives are split into parts of equal size in bytes,
+                         and the utterances listed in Kaldi script files are
+                         split into contiguous ranges
 
         :type job_id: int
         :param job_id: a number between ``0`` and ``num_jobs - 1``; select the
                        lattices corresponding to this job
+
+        :type prefetch: int
+        :param prefetch: if greater than zero, the lattices are parsed in a
+                         background thread, at most this many lattices ahead
+                         of the caller
         """
 
         # Read Kaldi word ID mapping.
@@ -49,7 +233,7 @@ class LatticeBatch(object):
         elif lattice_format == 'kaldi':
             raise ValueError("Kaldi lattice vocabulary is not given.")
 
-        if (lattice_format != 'slf') and (lattice_format != 'kaldi'):
+        if lattice_format not in ('slf', 'kaldi', 'archive'):
             raise ValueError("Invalid lattice format specified ({})."
                              .format(lattice_format))
         self._lattice_format = lattice_format
@@ -70,35 +254,286 @@ class LatticeBatch(object):
         if (job_id < 0) or (job_id > num_jobs - 1):
             raise ValueError("Invalid job selected ({})."
                              .format(job_id))
-        self._lattices = lattices[job_id::num_jobs]
+        if lattice_format == 'archive':
+            if "-" in lattices:
+                raise ValueError("Lattice archives cannot be read from "
+                                 "standard input.")
+            self._archives = [LatticeArchive(path) for path in lattices]
+            self._lattices = self._split_archives(num_jobs, job_id)
+        elif lattice_format == 'kaldi':
+            self._lattices = self._split_kaldi(lattices, num_jobs, job_id)
+        else:
+            self._lattices = lattices[job_id::num_jobs]
+        self._prefetch = prefetch
+        self._ark_fds = dict()
 
     def __iter__(self):
         """A generator for iterating through the lattices of this job.
+
+        If prefetching is enabled, the lattices are parsed in a background
+        thread and passed through a bounded queue, so that parsing the next
+        lattices overlaps with processing the current one.
+        """
+
+        if self._prefetch < 1:
+            try:
+                for source in self.sources():
+                    yield self.read_lattice(source)
+            finally:
+                self.close()
+            return
+
+        lattice_queue = queue.Queue(self._prefetch)
+        thread = threading.Thread(target=self._read_lattices,
+                                  args=(lattice_queue,),
+                                  daemon=True)
+        thread.start()
+        while True:
+            lattice = lattice_queue.get()
+            if lattice is None:
+                break
+            if isinstance(lattice, Exception):
+                raise lattice
+            yield lattice
+        thread.join()
+
+    def close(self):
+        """Closes the archives that have been opened for reading lattices
+        listed in Kaldi script files.
+
+        Called when the iteration ends. If the lattices are read using
+        ``read_lattice()``, this should be called after the last lattice.
+        """
+
+        for fd in self._ark_fds.values():
+            os.close(fd)
+        self._ark_fds.clear()
+
+    def sources(self):
+        """A generator for iterating through the sources of the lattices of
+        this job, without parsing the lattices.
+
+        A source is the path of an SLF lattice file, the lines of a lattice
+        in a Kaldi archive, the utterance ID, archive path, and offset of a
+        lattice listed in a Kaldi script file, or the index of a binary lattice
+        archive and the index of a lattice within the archive. The sources are
+        small picklable objects that can be passed to another process, which
+        then parses the lattice using ``read_lattice()``.
         """
 
         file_type = TextFileType('r')
 
+        if self._lattice_format == 'archive':
+            yield from self._lattices
+            return
+
         for path in self._lattices:
-            logging.info("Reading lattice file `%s´.", path)
-            lattice_file = file_type(path)
             if self._lattice_format == 'slf':
-                yield SLFLattice(lattice_file)
+                yield path
+            elif isinstance(path, tuple):
+                # The location of a lattice from a script file.
+                yield path
             else:
                 assert self._lattice_format == 'kaldi'
-                lattice_lines = []
-                id_to_word = self.kaldi_id_to_word
-                while True:
-                    line = lattice_file.readline()
-                    if not line:
-                        # end of file
-                        if lattice_lines:
-                            yield KaldiLattice(lattice_lines, id_to_word)
-                        break
-                    line = line.strip()
-                    if not line:
-                        # empty line
-                        if lattice_lines:
-                            yield KaldiLattice(lattice_lines, id_to_word)
-                        lattice_lines = []
-                        continue
-                    lattice_lines.append(line)
+                logging.info("Reading lattice file `%s´.", path)
+                if path.endswith('.gz') or path.endswith('.bz2'):
+                    lattice_file = _BackgroundDecompressor(path)
+                else:
+                    lattice_file = file_type(path)
+                yield from _read_kaldi_utterances(lattice_file)
+
+    def read_lattice(self, source):
+        """Parses a lattice from a source generated by ``sources()``.
+
+        :type source: str, list of strs, or tuple
+        :param source: path to an SLF lattice file, the lines of a Kaldi
+                       lattice, the location of a Kaldi lattice from a script
+                       file, or the archive index and lattice index of a
+                       lattice in a binary archive
+
+        The lattices are read directly into arrays. The node and link objects
+        are created only if they are needed, e.g. for writing a rescored
+        lattice.
+
+        :rtype: Lattice
+        :returns: the parsed lattice
+        """
+
+        if self._lattice_format == 'slf':
+            logging.info("Reading lattice file `%s´.", source)
+            lattice_file = TextFileType('r')(source)
+            return SLFLattice(lattice_file, objects=False).to_columnar()
+        elif self._lattice_format == 'archive':
+            archive_index, lattice_index = source
+            return self._archives[archive_index].read_lattice(lattice_index)
+        else:
+            assert self._lattice_format == 'kaldi'
+            if isinstance(source, tuple):
+                source = self._read_kaldi_entry(*source)
+            lattice = KaldiLattice(source, self.kaldi_id_to_word,
+                                   objects=False)
+            return lattice.to_columnar()
+
+    def _read_kaldi_entry(self, utterance_id, path, offset):
+        """Reads the lines of a lattice from a given position in a Kaldi
+        archive.
+
+        The archive is read using ``os.pread()``, which doesn't change the
+        file position, so the file descriptor can be shared by forked worker
+        processes.
+
+        :type utterance_id: str
+        :param utterance_id: utterance ID from the script file
+
+        :type path: str
+        :param path: path to a Kaldi lattice archive in text format
+
+        :type offset: int
+        :param offset: byte offset where the lattice begins, after the
+                       utterance ID
+
+        :rtype: list of strs
+        :returns: the utterance ID, followed by the non-empty lines of the
+                  lattice
+        """
+
+        separator = re.compile(rb'\n[ \t\r]*\n')
+        chunk_size = 65536
+        fd = self._ark_fds.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self._ark_fds[path] = fd
+        read_chunk = lambda position: os.pread(fd, chunk_size,
+                                               offset + position)
+
+        # Read until an empty line that follows the lattice. The lattice may
+        # begin with a newline. A separator that continues from the previous
+        # chunk has to start from its last newline, so only the text after
+        # that newline needs to be searched again.
+        chunks = []
+        position = 0
+        tail = b''
+        excess = 0
+        while True:
+            chunk = read_chunk(position)
+            if not chunk:
+                break
+            position += len(chunk)
+            if not chunks:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+            chunks.append(chunk)
+            window = tail + chunk
+            match = separator.search(window)
+            if match:
+                excess = len(window) - match.start()
+                break
+            newline = window.rfind(b'\n')
+            tail = window[newline:] if newline >= 0 else b''
+            if tail[1:].strip(b' \t\r'):
+                tail = b''
+        data = b''.join(chunks)
+        data = data[:len(data) - excess]
+
+        lines = [line.strip() for line in data.decode('utf-8').splitlines()]
+        return [utterance_id] + [line for line in lines if line]
+
+    def _split_kaldi(self, paths, num_jobs, job_id):
+        """Selects the Kaldi lattices that belong to a job.
+
+        Every ``num_jobs``th archive is selected, as with other lattice
+        formats. The lattices listed in script files are split into contiguous
+        ranges, so that each job can seek directly to its lattices. Like in
+        Kaldi, script files cannot refer to compressed archives, because they
+        don't support random access.
+
+        :type paths: list of strs
+        :param paths: paths to Kaldi lattice archives, possibly with ``ark:``
+                      or ``scp:`` prefix
+
+        :type num_jobs: int
+        :param num_jobs: split the lattices to this many jobs
+
+        :type job_id: int
+        :param job_id: select the lattices corresponding to this job
+
+        :rtype: list
+        :returns: archive paths and lattice locations that are read by this
+                  job
+        """
+
+        ark_paths = []
+        entries = []
+        for path in paths:
+            file_type, path = _parse_rspecifier(path)
+            if file_type == 'ark':
+                ark_paths.append(path)
+            else:
+                with TextFileType('r')(path) as scp_file:
+                    scp_entries = _read_kaldi_scp(scp_file)
+                for _, ark_path, _ in scp_entries:
+                    if ark_path.endswith('.gz') or ark_path.endswith('.bz2'):
+                        raise InputError(
+                            "Kaldi script file `{}´ refers to a compressed "
+                            "archive `{}´. Random access to compressed "
+                            "archives is not supported.".format(path, ark_path))
+                entries.extend(scp_entries)
+
+        begin = len(entries) * job_id // num_jobs
+        end = len(entries) * (job_id + 1) // num_jobs
+        return ark_paths[job_id::num_jobs] + entries[begin:end]
+
+    def _read_lattices(self, lattice_queue):
+        """Parses the lattices of this job and puts them in a queue.
+
+        Executed in a background thread when prefetching is enabled. ``None``
+        is put in the queue after the last lattice. If parsing fails, the
+        exception is put in the queue, so that it can be raised in the main
+        thread.
+
+        :type lattice_queue: queue.Queue
+        :param lattice_queue: a queue where to put the lattices
+        """
+
+        try:
+            for source in self.sources():
+                lattice_queue.put(self.read_lattice(source))
+        except Exception as exception:
+            lattice_queue.put(exception)
+            return
+        finally:
+            self.close()
+        lattice_queue.put(None)
+
+    def _split_archives(self, num_jobs, job_id):
+        """Selects a contiguous range of lattices from the archives, so that
+        each job reads approximately the same number of bytes.
+
+        :type num_jobs: int
+        :param num_jobs: split the lattices to this many jobs
+
+        :type job_id: int
+        :param job_id: select the lattices corresponding to this job
+
+        :rtype: list of tuples
+        :returns: the archive index and lattice index of each selected lattice
+        """
+
+        sources = []
+        sizes = []
+        for archive_index, archive in enumerate(self._archives):
+            sources.extend((archive_index, lattice_index)
+                           for lattice_index in range(len(archive)))
+            sizes.append(archive.lattice_sizes())
+        if not sources:
+            return []
+
+        # A lattice belongs to the job whose byte range contains the beginning
+        # of the lattice.
+        sizes = numpy.concatenate(sizes)
+        begins = numpy.cumsum(sizes) - sizes
+        total_size = max(1, int(sizes.sum()))
+        jobs = begins * num_jobs // total_size
+        return [sources[index]
+                for index in numpy.flatnonzero(jobs == job_id).tolist()]
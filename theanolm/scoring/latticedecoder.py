@@ -3,6 +3,7 @@
 """A module that implements the LatticeDecoder class.
 """
 
+import heapq
 import logging
 import math
 
@@ -14,11 +15,143 @@ from theanolm.backend import InputError
 from theanolm.backend import interpolate_linear, interpolate_loglinear
 from theanolm.backend import logprob_type
 from theanolm.network import RecurrentState
+from theanolm.scoring.statecache import StateCache
+from theanolm.scoring.statepool import StatePool
 
 class LatticeDecoder(object):
     """Word Lattice Decoding Using a Neural Network Language Model
     """
 
+    class History:
+        """Word History of a Decoding Token
+
+        The histories of the tokens form a prefix tree. A history is a node in
+        the tree that stores the last word and a pointer to the history of the
+        previous words, so that appending a word to a history takes constant
+        time and memory, and tokens that have been propagated from the same
+        token share the common part of their histories. The hash of the full
+        history is computed incrementally from the hash of the parent.
+
+        The class implements the sequence protocol, so that a history can be
+        used like a tuple of words. Accessing the last words is fast, but
+        accessing the beginning of the history requires following the parent
+        pointers. A history is equal only to other histories, because its hash
+        is different from the hash of the corresponding tuple.
+        """
+
+        __slots__ = ("word", "parent", "_length", "_hash")
+
+        def __init__(self, word=None, parent=None):
+            """Constructs a history that extends ``parent`` with ``word``.
+
+            If ``parent`` is ``None``, constructs an empty history.
+
+            :type word: int or str
+            :param word: word ID or an OOV word to be appended to ``parent``
+
+            :type parent: LatticeDecoder.History
+            :param parent: the history of the previous words
+            """
+
+            self.word = word
+            self.parent = parent
+            if parent is None:
+                self._length = 0
+                self._hash = hash(())
+            else:
+                self._length = parent._length + 1
+                self._hash = hash((parent._hash, word))
+
+        @classmethod
+        def from_sequence(cls, words):
+            """Constructs a history from a sequence of words.
+
+            :type words: sequence of ints and strs
+            :param words: word IDs or OOV words, or a ``History`` that will be
+                          returned as is
+
+            :rtype: LatticeDecoder.History
+            :returns: a history that contains ``words``
+            """
+
+            if isinstance(words, cls):
+                return words
+            result = cls()
+            for word in words:
+                result = cls(word, result)
+            return result
+
+        def suffix(self, length):
+            """Returns the last words of the history.
+
+            :type length: int
+            :param length: number of words to return
+
+            :rtype: tuple
+            :returns: the last ``length`` words, or the entire history if it's
+                      shorter
+            """
+
+            words = []
+            history = self
+            while (len(words) < length) and (history._length > 0):
+                words.append(history.word)
+                history = history.parent
+            words.reverse()
+            return tuple(words)
+
+        def __len__(self):
+            return self._length
+
+        def __iter__(self):
+            return iter(self.suffix(self._length))
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                if (index.start is not None) and (index.start < 0) and \
+                   (index.stop is None) and (index.step is None):
+                    return self.suffix(-index.start)
+                return self.suffix(self._length)[index]
+
+            if index < 0:
+                index += self._length
+            if (index < 0) or (index >= self._length):
+                raise IndexError("History index out of range.")
+            history = self
+            for _ in range(self._length - 1 - index):
+                history = history.parent
+            return history.word
+
+        def __add__(self, words):
+            result = self
+            for word in words:
+                result = type(self)(word, result)
+            return result
+
+        def __hash__(self):
+            return self._hash
+
+        def __eq__(self, other):
+            if self is other:
+                return True
+            if isinstance(other, LatticeDecoder.History):
+                if (self._hash != other._hash) or \
+                   (self._length != other._length):
+                    return False
+                # Compare the words until the histories meet.
+                history1 = self
+                history2 = other
+                while history1 is not history2:
+                    if history1.word != history2.word:
+                        return False
+                    history1 = history1.parent
+                    history2 = history2.parent
+                return True
+            return NotImplemented
+
+        def __repr__(self):
+            return 'History({})'.format(self.suffix(self._length))
+
     class Token:
         """Decoding Token
 
@@ -43,12 +176,12 @@ class LatticeDecoder(object):
             New tokens will not have recombination hash and total log
             probability set.
 
-            :type history: list of ints
+            :type history: LatticeDecoder.History or a sequence of ints
             :param history: word IDs that the token has passed
 
-            :type state: RecurrentState
-            :param state: the state of the recurrent layers for a single
-                          sequence
+            :type state: int
+            :param state: index of the row in the decoder's state pool that
+                          contains the state of the recurrent layers
 
             :type ac_logprob: logprob_type
             :param ac_logprob: sum of the acoustic log probabilities of the
@@ -63,8 +196,8 @@ class LatticeDecoder(object):
                                   lattice links
             """
 
-            self.history = history
-            self.state = [] if state is None else state
+            self.history = LatticeDecoder.History.from_sequence(history)
+            self.state = state
             self.ac_logprob = ac_logprob
             self.lat_lm_logprob = lat_lm_logprob
             self.nn_lm_logprob = nn_lm_logprob
@@ -75,9 +208,10 @@ class LatticeDecoder(object):
         def copy(cls, token):
             """Creates a copy of a token.
 
-            The recurrent layer states will not be copied - a pointer will be
-            copied instead. There's no need to copy the structure, since we
-            never modify the state of a token, but replace it if necessary.
+            The recurrent layer states will not be copied - the index to the
+            state pool will be copied instead. There's no need to copy the
+            state, since we never modify the state of a token, but replace it if
+            necessary.
 
             Recombination hash and total log probability will not be copied.
 
@@ -104,10 +238,10 @@ class LatticeDecoder(object):
             """
 
             if recombination_order is None:
-                limited_history = self.history
+                self.recombination_hash = hash(self.history)
             else:
-                limited_history = self.history[-recombination_order:]
-            self.recombination_hash = hash(limited_history)
+                limited_history = self.history.suffix(recombination_order)
+                self.recombination_hash = hash(limited_history)
 
         def recompute_total(self, nn_lm_weight, lm_scale, wi_penalty,
                             linear=False):
@@ -197,14 +331,196 @@ class LatticeDecoder(object):
                            self.nn_lm_logprob,
                            self.total_logprob)
 
+    class BestLogprobIndex:
+        """Best Log Probabilities at the Same or Later Time
+
+        Beam pruning compares the tokens of a node to the best token at the
+        same or later time. This structure finds the best log probability at
+        the nodes that follow a given node in logarithmic time. The first
+        position in the sorted node list that has the same or later time is
+        precomputed for each node, and the best log probabilities are stored in
+        a Fenwick tree that gives the maximum over the suffix of the node list
+        starting from any position.
+        """
+
+        def __init__(self, positions, times):
+            """Precomputes the position where the beam threshold search starts
+            for each node.
+
+            :type positions: numpy.ndarray
+            :param positions: position of each node ID in the sorted node list
+                              (-1 for unreachable nodes), as returned by
+                              ``ColumnarLattice.sorted_node_ids()``
+
+            :type times: numpy.ndarray
+            :param times: time of the node at each position, NaN if not
+                          available, as returned by
+                          ``ColumnarLattice.sorted_node_ids()``
+            """
+
+            times = numpy.asarray(times, dtype='float64')
+            num_nodes = times.size
+
+            # The first position whose time is the same or later than the time
+            # of the node. This is where the maximum of the node times up to
+            # that position exceeds the time of the node. Nodes without time
+            # stamp start the search from their own position.
+            has_time = ~numpy.isnan(times)
+            max_times = numpy.where(has_time, times, -numpy.inf)
+            if num_nodes > 0:
+                max_times = numpy.maximum.accumulate(max_times)
+            begin_positions = numpy.searchsorted(max_times, times,
+                                                 side='left')
+            begin_positions = numpy.where(has_time, begin_positions,
+                                          numpy.arange(num_nodes))
+            positions = numpy.asarray(positions, dtype='int64')
+            reachable = positions >= 0
+            node_begin_positions = numpy.full(positions.size, -1,
+                                              dtype='int64')
+            node_begin_positions[reachable] = \
+                begin_positions[positions[reachable]]
+            self._positions = positions.tolist()
+            self._begin_positions = node_begin_positions.tolist()
+
+            self._num_nodes = num_nodes
+            self._tree = [-numpy.inf] * (num_nodes + 1)
+
+        def update(self, node_id, logprob):
+            """Updates the best log probability of a node, if ``logprob`` is
+            higher than the current value.
+
+            :type node_id: int
+            :param node_id: ID of a node in the lattice
+
+            :type logprob: float
+            :param logprob: log probability of a token in ``node``
+            """
+
+            # The tree is indexed in reverse order, so that suffixes of the node
+            # list are prefixes of the tree.
+            index = self._num_nodes - self._positions[node_id]
+            while index <= self._num_nodes:
+                if logprob > self._tree[index]:
+                    self._tree[index] = logprob
+                index += index & -index
+
+        def best_logprob(self, node_id):
+            """Returns the best log probability at the nodes whose time is the
+            same or later than the time of the given node.
+
+            If the node has no time stamp, returns the best log probability at
+            the node or any node after it in the topological order.
+
+            :type node_id: int
+            :param node_id: ID of a node in the lattice
+
+            :rtype: float
+            :returns: the best log probability at the same or later time
+            """
+
+            index = self._num_nodes - self._begin_positions[node_id]
+            result = -numpy.inf
+            while index > 0:
+                if self._tree[index] > result:
+                    result = self._tree[index]
+                index -= index & -index
+            return result
+
+    class Search:
+        """Decoding State of a Lattice
+
+        Contains the tokens and other data structures that are needed while
+        decoding one lattice. The decoder can decode several lattices in
+        lockstep, each one having its own search object.
+        """
+
+        def __init__(self, lattice, sorted_nodes, lm_scale, wi_penalty,
+                     link_words):
+            """Creates empty token lists for the nodes of a lattice, and
+            converts the link arrays into lists that are fast to index from
+            Python.
+
+            :type lattice: ColumnarLattice
+            :param lattice: the lattice to be decoded
+
+            :type sorted_nodes: list of ints
+            :param sorted_nodes: IDs of all the nodes in topological order
+
+            :type lm_scale: logprob_type
+            :param lm_scale: scale language model log probabilities by this
+                             factor
+
+            :type wi_penalty: logprob_type
+            :param wi_penalty: penalize word insertion by adding this value to
+                               the total log probability of the tokens
+
+            :type link_words: list
+            :param link_words: the word ID of each link in the NNLM vocabulary,
+                               the word itself if it's not in the vocabulary,
+                               or ``None`` for null links
+            """
+
+            def to_optional(value):
+                return None if numpy.isnan(value) else value
+
+            self.lattice = lattice
+            self.sorted_nodes = sorted_nodes
+            self.lm_scale = lm_scale
+            self.wi_penalty = wi_penalty
+            self.tokens = [list() for _ in range(lattice.num_nodes)]
+            self.recomb_tokens = []
+            self.final_tokens = []
+            self.best_logprobs = None
+            self.node_batches = None
+            self.nodes_processed = 0
+            self.node_windows = None
+            # A min-heap of the best total log probabilities of the tokens that
+            # have been propagated from each time window.
+            self.window_logprobs = dict()
+
+            self.node_final = lattice.node_final.tolist()
+            self.out_link_ids = lattice.out_link_ids.tolist()
+            self.out_offsets = lattice.out_offsets.tolist()
+            self.link_end_ids = lattice.link_end_ids.tolist()
+            self.link_args = [
+                (word, to_optional(ac_logprob), to_optional(lm_logprob))
+                for word, ac_logprob, lm_logprob
+                in zip(link_words,
+                       lattice.link_ac_logprobs,
+                       lattice.link_lm_logprobs)]
+
+            # The nodes that are processed on the current iteration, their
+            # pruning statistics, and the tokens propagated to their links.
+            self.nodes = None
+            self.stats = None
+            self.link_tokens = None
+            self.links = None
+            self.new_tokens = None
+
+        def out_links(self, node_id):
+            """Returns the outgoing links of a node.
+
+            :type node_id: int
+            :param node_id: ID of a node in the lattice
+
+            :rtype: list of ints
+            :returns: IDs of the outgoing links
+            """
+
+            return self.out_link_ids[self.out_offsets[node_id]:
+                                     self.out_offsets[node_id + 1]]
+
     def __init__(self, network, decoding_options, profile=False):
         """Creates a Theano function that computes the output probabilities for
         a single time step.
 
         Creates the function self._step_function that takes as input a set of
         word sequences and the current recurrent states. It uses the previous
-        states and word IDs to compute the output distributions, and computes
-        the probabilities of the target words.
+        states and word IDs to advance the recurrent states and compute the
+        output distributions. Then it computes the probabilities of a list of
+        target words, each of which refers to one of the sequences. This way the
+        state of each sequence is advanced only once, even if it is followed by
+        several different words in the lattice.
 
         All invocations of ``decode()`` will use the given NNLM weight and LM
         scale when computing the total probability. If LM scale is not given,
@@ -252,6 +568,29 @@ class LatticeDecoder(object):
           number of words to consider when deciding whether two tokens should be
           recombined, or ``None`` for the entire word history
 
+        max_tokens_per_window : int
+          if set to other than None, a token is propagated only if it's among
+          this many best tokens seen so far in the same time window (at least
+          the best token of every node is propagated)
+
+        time_window : float
+          length of the time windows used by ``max_tokens_per_window``, in the
+          same units as the node times (default 0.01)
+
+        lattice_beam : float
+          if set to other than None, the lattice is pruned before decoding by
+          removing links whose best path according to the acoustic and lattice
+          LM scores is further than this from the best path
+
+        lattice_posterior_threshold : float
+          if set to other than None, the lattice is pruned before decoding by
+          removing links whose posterior probability according to the acoustic
+          and lattice LM scores is lower than this
+
+        remove_null_links : bool
+          if set to True, null links are removed from the lattice before
+          decoding, and parallel links with the same word are merged
+
         prune_extra_limit : float
           if set, adjust the beam and max_tokens_per_node pruning relative to
           the number of tokens; the limits are divided by the number of tokens
@@ -265,6 +604,18 @@ class LatticeDecoder(object):
           when using prune_extra_limit, this is the minimum that the maximum
           number of tokens will be adjusted to
 
+        nnlm_cache_size : float
+          if set to other than None, the recurrent states and NNLM log
+          probabilities computed after each word history are cached, using at
+          most this many megabytes of memory
+
+        link_batching : str
+          how many links are propagated with a single call to the step
+          function; "none" calls the function separately for each link, "node"
+          (default) combines all the outgoing links of a node, and "frontier"
+          combines the outgoing links of consecutive nodes that don't link to
+          each other
+
         :type network: Network
         :param network: the neural network object
 
@@ -288,11 +639,30 @@ class LatticeDecoder(object):
         if self._beam is not None:
             self._beam = logprob_type(self._beam)
         self._recombination_order = decoding_options['recombination_order']
+        self._max_tokens_per_window = \
+            decoding_options.get('max_tokens_per_window', None)
+        self._time_window = decoding_options.get('time_window', 0.01)
+        self._lattice_beam = decoding_options.get('lattice_beam', None)
+        self._lattice_posterior_threshold = \
+            decoding_options.get('lattice_posterior_threshold', None)
+        self._remove_null_links = \
+            decoding_options.get('remove_null_links', False)
         self._prune_extra_limit = decoding_options.get('prune_extra_limit', None)
         self._abs_min_beam = decoding_options.get('abs_min_beam', 0)
         self._abs_min_max_tokens = decoding_options.get('abs_min_max_tokens', 0)
         if self._prune_extra_limit is None:
             self._abs_min_beam = self._abs_min_max_tokens = 0
+        cache_size = decoding_options.get('nnlm_cache_size', None)
+        if cache_size is None:
+            self._cache = None
+        else:
+            self._cache = StateCache(int(cache_size * 1024 * 1024))
+        self._best_logprobs = None
+        self._state_pool = StatePool(network.recurrent_state_size)
+        self._link_batching = decoding_options.get('link_batching', 'node')
+        if self._link_batching not in ('none', 'node', 'frontier'):
+            raise ValueError("Invalid link batching mode requested: `{}´"
+                             .format(self._link_batching))
 
         if decoding_options['use_shortlist'] and \
            self._vocabulary.has_unigram_probs():
@@ -305,12 +675,24 @@ class LatticeDecoder(object):
         self._eos_id = self._vocabulary.word_to_id['</s>']
         self._unk_id = self._vocabulary.word_to_id['<unk>']
 
+        # The target words are given as (sequence index, class ID) pairs, so
+        # that the probabilities of several words can be read from the output
+        # distribution of one sequence.
+        target_sequence_ids = tensor.vector('decoder/target_sequence_ids',
+                                            dtype='int64')
+        target_class_ids = tensor.vector('decoder/target_class_ids',
+                                         dtype='int64')
+
         inputs = [network.input_word_ids,
                   network.input_class_ids,
-                  network.target_class_ids]
+                  target_sequence_ids,
+                  target_class_ids]
         inputs.extend(network.recurrent_state_input)
 
-        outputs = [tensor.log(network.target_probs())]
+        # The output distribution contains only one time step.
+        output_probs = network.output_probs()[0]
+        target_probs = output_probs[(target_sequence_ids, target_class_ids)]
+        outputs = [tensor.log(target_probs)]
         outputs.extend(network.recurrent_state_output)
 
         # Ignore unused input, because is_training is only used by dropout
@@ -345,6 +727,124 @@ class LatticeDecoder(object):
                   during recombination
         """
 
+        return self.decode_batch([lattice])[0]
+
+    def decode_batch(self, lattices):
+        """Decodes several lattices in lockstep.
+
+        On each iteration, the next batch of nodes is taken from every lattice
+        that has not been finished yet, and the tokens of all those nodes are
+        propagated to their outgoing links using a single call to the neural
+        network. This keeps the mini-batches large when the lattices are small.
+
+        :type lattices: list of Lattices
+        :param lattices: word lattices to be decoded
+
+        :rtype: list of tuples of two lists of LatticeDecoder.Tokens
+        :returns: for each lattice, a list of the final tokens sorted by
+                  probability (most likely token first), and a list of the
+                  tokens that were dropped during recombination
+        """
+
+        self._state_pool.clear()
+        searches = [self._start_search(lattice) for lattice in lattices]
+        active_searches = list(searches)
+        while active_searches:
+            if self._state_pool.is_full():
+                self._compact_states(active_searches)
+
+            # Take the next batch of nodes from each lattice, prune them, and
+            # collect the tokens and the links where they will be propagated.
+            # A link of None means propagating to the end of sentence.
+            batch_searches = []
+            for search in active_searches:
+                nodes = next(search.node_batches, None)
+                if nodes is None:
+                    continue
+                self._best_logprobs = search.best_logprobs
+                search.nodes = nodes
+                search.stats = [self._prune(node_id, search.sorted_nodes,
+                                            search.tokens, search.recomb_tokens)
+                                for node_id in nodes]
+                if self._max_tokens_per_window is not None:
+                    for node_id, stats in zip(nodes, search.stats):
+                        self._prune_window(node_id, search, stats)
+                search.link_tokens = []
+                search.links = []
+                for node_id in nodes:
+                    node_tokens = search.tokens[node_id]
+                    assert node_tokens
+                    if search.node_final[node_id]:
+                        search.link_tokens.append(node_tokens)
+                        search.links.append(None)
+                    for link_id in search.out_links(node_id):
+                        search.link_tokens.append(node_tokens)
+                        search.links.append(link_id)
+                batch_searches.append(search)
+            active_searches = batch_searches
+
+            if self._link_batching == 'none':
+                for search in active_searches:
+                    self._best_logprobs = search.best_logprobs
+                    search.new_tokens = []
+                    for node_tokens, link_id in zip(search.link_tokens,
+                                                    search.links):
+                        link = None if link_id is None \
+                               else search.link_args[link_id]
+                        search.new_tokens.append(self._propagate(
+                            node_tokens, link, search.lm_scale,
+                            search.wi_penalty))
+                        self._collect_tokens(search.new_tokens[-1:],
+                                             [link_id], search)
+            else:
+                link_tokens = []
+                links = []
+                lm_scales = []
+                wi_penalties = []
+                for search in active_searches:
+                    num_links = len(search.links)
+                    link_tokens.extend(search.link_tokens)
+                    links.extend(None if link_id is None
+                                 else search.link_args[link_id]
+                                 for link_id in search.links)
+                    lm_scales.extend([search.lm_scale] * num_links)
+                    wi_penalties.extend([search.wi_penalty] * num_links)
+                new_tokens = self._propagate_batch(link_tokens, links,
+                                                   lm_scales, wi_penalties)
+                link_index = 0
+                for search in active_searches:
+                    num_links = len(search.links)
+                    search.new_tokens = \
+                        new_tokens[link_index:link_index + num_links]
+                    link_index += num_links
+                    self._best_logprobs = search.best_logprobs
+                    self._collect_tokens(search.new_tokens, search.links,
+                                         search)
+
+            for search in active_searches:
+                self._finish_nodes(search)
+
+        return [self._finish_search(search) for search in searches]
+
+    def _start_search(self, lattice):
+        """Creates the initial token of a lattice and the data structures for
+        decoding it.
+
+        The decoder reads the lattice arrays directly. Lattices that are not
+        stored in arrays are converted into a ``ColumnarLattice`` first. If
+        lattice pruning is enabled, the links that are unlikely according to
+        the scores in the lattice are removed before decoding. Then the null
+        links are removed, if requested.
+
+        :type lattice: Lattice
+        :param lattice: a word lattice to be decoded
+
+        :rtype: LatticeDecoder.Search
+        :returns: the decoding state of the lattice
+        """
+
+        lattice = lattice.to_columnar()
+
         if self._lm_scale is not None:
             lm_scale = logprob_type(self._lm_scale)
         elif lattice.lm_scale is not None:
@@ -359,51 +859,200 @@ class LatticeDecoder(object):
         else:
             wi_penalty = logprob_type(0.0)
 
-        tokens = [list() for _ in lattice.nodes]
-        recomb_tokens = []
+        if (self._lattice_beam is not None) or \
+           (self._lattice_posterior_threshold is not None):
+            lattice = lattice.pruned(lm_scale, wi_penalty, self._lattice_beam,
+                                     self._lattice_posterior_threshold)
+        if self._remove_null_links:
+            lattice = lattice.without_null_links(lm_scale)
+
         initial_state = RecurrentState(self._network.recurrent_state_size)
+        initial_state = self._state_pool.add(initial_state)[0]
         initial_token = self.Token(history=(self._sos_id,), state=initial_state)
         initial_token.recompute_hash(self._recombination_order)
         initial_token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
                                       self._linear_interpolation)
-        tokens[lattice.initial_node.id].append(initial_token)
-        lattice.initial_node.best_logprob = initial_token.total_logprob
-
-        sorted_nodes = lattice.sorted_nodes()
-        self._nodes_processed = 0
-        final_tokens = []
-        for node in sorted_nodes:
-            stats = self._prune(node, sorted_nodes, tokens, recomb_tokens)
-
-            num_new_tokens = 0
-            node_tokens = tokens[node.id]
-            assert node_tokens
-            if node.final:
-                new_tokens = self._propagate(
-                    node_tokens, None, lm_scale, wi_penalty)
-                final_tokens.extend(new_tokens)
-                num_new_tokens += len(new_tokens)
-            for link in node.out_links:
-                new_tokens = self._propagate(
-                    node_tokens, link, lm_scale, wi_penalty)
-                tokens[link.end_node.id].extend(new_tokens)
-                # If there are lots of tokens in the end node, prune already to
-                # conserve memory.
-                if self._max_tokens_per_node is not None and \
-                   len(tokens[link.end_node.id]) > self._max_tokens_per_node * 2:
-                    self._prune(link.end_node, sorted_nodes, tokens, recomb_tokens)
-                num_new_tokens += len(new_tokens)
-            stats['new'] = num_new_tokens
-
-            self._nodes_processed += 1
-            self._log_stats(stats, node.id, len(sorted_nodes))
-
-        if len(final_tokens) == 0:
+        # Map the words of the lattice to NNLM vocabulary IDs only once.
+        word_to_id = self._vocabulary.word_to_id
+        word_ids = [word_to_id.get(word, word) for word in lattice.words]
+        link_words = [None if word_id < 0 else word_ids[word_id]
+                      for word_id in lattice.link_word_ids.tolist()]
+
+        sorted_nodes, positions, times = \
+            lattice.sorted_node_ids(return_index=True)
+        search = self.Search(lattice, sorted_nodes, lm_scale, wi_penalty,
+                             link_words)
+        search.tokens[lattice.initial_node_id].append(initial_token)
+        search.best_logprobs = self.BestLogprobIndex(positions, times)
+        search.best_logprobs.update(lattice.initial_node_id,
+                                    initial_token.total_logprob)
+        search.node_batches = self._node_batches(lattice, sorted_nodes)
+        if self._max_tokens_per_window is not None:
+            windows = numpy.floor(lattice.node_times / self._time_window)
+            search.node_windows = [None if window != window else int(window)
+                                   for window in windows.tolist()]
+        return search
+
+    def _finish_nodes(self, search):
+        """Writes statistics of the nodes that were processed on this iteration
+        and releases their tokens.
+
+        :type search: LatticeDecoder.Search
+        :param search: the decoding state of a lattice
+        """
+
+        num_nodes = len(search.sorted_nodes)
+        link_index = 0
+        for node_id, stats in zip(search.nodes, search.stats):
+            num_links = search.out_offsets[node_id + 1] - \
+                        search.out_offsets[node_id]
+            if search.node_final[node_id]:
+                num_links += 1
+            node_new_tokens = \
+                search.new_tokens[link_index:link_index + num_links]
+            stats['new'] = sum(len(x) for x in node_new_tokens)
+            link_index += num_links
+
+            search.nodes_processed += 1
+            self._log_stats(stats, node_id, search.nodes_processed, num_nodes)
+
+        # The tokens have been propagated to the following nodes and are not
+        # needed anymore.
+        for node_id in search.nodes:
+            search.tokens[node_id] = []
+        search.nodes = search.stats = None
+        search.link_tokens = search.links = search.new_tokens = None
+
+    def _finish_search(self, search):
+        """Returns the final tokens of a lattice that has been decoded.
+
+        :type search: LatticeDecoder.Search
+        :param search: the decoding state of a lattice
+
+        :rtype: a tuple of two lists of LatticeDecoder.Tokens
+        :returns: a list of the final tokens sorted by probability (most likely
+                  token first), and a list of the tokens that were dropped
+                  during recombination
+        """
+
+        if len(search.final_tokens) == 0:
             raise InputError("Could not reach a final node of word lattice.")
 
-        final_tokens = self._sorted_recombined_tokens(final_tokens,
-                                                      recomb_tokens)
-        return final_tokens, recomb_tokens
+        final_tokens = self._sorted_recombined_tokens(search.final_tokens,
+                                                      search.recomb_tokens)
+        return final_tokens, search.recomb_tokens
+
+    def _compact_states(self, searches):
+        """Releases the state pool rows that are not used by any token that
+        may still be propagated, and updates the state indices of the tokens.
+
+        Called between propagations, when every active token is either in a
+        node that has not been processed yet or in the final tokens. The state
+        of tokens that were dropped during recombination will not be valid
+        after this.
+
+        :type searches: list of LatticeDecoder.Searches
+        :param searches: the decoding states of the lattices that share the
+                         state pool
+        """
+
+        active_tokens = []
+        for search in searches:
+            active_tokens.extend(search.final_tokens)
+            for node_id in search.sorted_nodes[search.nodes_processed:]:
+                active_tokens.extend(search.tokens[node_id])
+        if not active_tokens:
+            self._state_pool.clear()
+            return
+
+        rows = numpy.array([token.state for token in active_tokens],
+                           dtype='int64')
+        mapping = self._state_pool.compact(rows)
+        for token, row in zip(active_tokens, mapping[rows]):
+            token.state = int(row)
+
+    def _node_batches(self, lattice, sorted_nodes):
+        """A generator for iterating through the nodes in batches whose
+        outgoing links can be propagated at the same time.
+
+        Unless frontier batching is used, each batch contains a single node.
+        Otherwise a batch contains consecutive nodes from ``sorted_nodes``, up
+        to a node that can be reached directly from one of the nodes in the
+        batch. The nodes in a batch can be pruned before propagating any of
+        them, since none of them receives tokens from the others.
+
+        :type lattice: ColumnarLattice
+        :param lattice: the lattice to be decoded
+
+        :type sorted_nodes: list of ints
+        :param sorted_nodes: IDs of all the nodes in topological order
+
+        :rtype: generator for lists of ints
+        :returns: generates the IDs of the next batch of nodes
+        """
+
+        if self._link_batching != 'frontier':
+            for node_id in sorted_nodes:
+                yield [node_id]
+            return
+
+        in_offsets = lattice.in_offsets.tolist()
+        predecessors = lattice.link_start_ids[lattice.in_link_ids].tolist()
+        batch = []
+        batch_node_ids = set()
+        for node_id in sorted_nodes:
+            if any(start_id in batch_node_ids
+                   for start_id in predecessors[in_offsets[node_id]:
+                                                in_offsets[node_id + 1]]):
+                yield batch
+                batch = []
+                batch_node_ids = set()
+            batch.append(node_id)
+            batch_node_ids.add(node_id)
+        if batch:
+            yield batch
+
+    def _collect_tokens(self, new_tokens, links, search):
+        """Adds propagated tokens to the end nodes of the links, or to the list
+        of final tokens.
+
+        Updates the best log probabilities of the end nodes, so that beam
+        pruning threshold can be obtained efficiently. If there are lots of
+        tokens in an end node, prunes the node already to conserve memory.
+
+        :type new_tokens: list of lists of LatticeDecoder.Tokens
+        :param new_tokens: the propagated tokens of each link
+
+        :type links: list of ints
+        :param links: IDs of the links where the tokens were propagated;
+                      ``None`` indicates propagation to the end of sentence
+
+        :type search: LatticeDecoder.Search
+        :param search: the decoding state of the lattice
+        """
+
+        link_end_ids = search.link_end_ids
+        for link_new_tokens, link_id in zip(new_tokens, links):
+            if (not link_new_tokens) or (link_id is None):
+                continue
+            best_logprob = max(token.total_logprob
+                               for token in link_new_tokens)
+            search.best_logprobs.update(link_end_ids[link_id], best_logprob)
+
+        tokens = search.tokens
+        for link_new_tokens, link_id in zip(new_tokens, links):
+            if link_id is None:
+                search.final_tokens.extend(link_new_tokens)
+                continue
+            end_id = link_end_ids[link_id]
+            if self._max_tokens_per_window is not None:
+                link_new_tokens = self._window_filter(end_id, link_new_tokens,
+                                                      search)
+            tokens[end_id].extend(link_new_tokens)
+            if self._max_tokens_per_node is not None and \
+               len(tokens[end_id]) > self._max_tokens_per_node * 2:
+                self._prune(end_id, search.sorted_nodes, tokens,
+                            search.recomb_tokens)
 
     def _propagate(self, tokens, link, lm_scale, wi_penalty):
         """Propagates tokens to given link or to end of sentence.
@@ -414,15 +1063,15 @@ class LatticeDecoder(object):
         language model scores. Then the function will update the acoustic and
         lattice LM score, but will not compute anything with the neural network.
 
-        Also updates ``best_logprob`` of the end node, so that beam pruning
-        threshold can be obtained efficiently.
-
         :type tokens: list of LatticeDecoder.Tokens
         :param tokens: input tokens
 
-        :type link: Lattice.Link
-        :param link: if other than ``None``, propagates the tokens to this link;
-                     if ``None``, just updates the LM logprobs as if the tokens
+        :type link: tuple
+        :param link: if other than ``None``, propagates the tokens to a link
+                     with this word, acoustic log probability, and language
+                     model log probability (the word is an NNLM word ID, or
+                     the word itself if it's not in the vocabulary); if
+                     ``None``, just updates the LM logprobs as if the tokens
                      were propagated to an end of sentence
 
         :type lm_scale: logprob_type
@@ -436,53 +1085,95 @@ class LatticeDecoder(object):
         :returns: the propagated tokens
         """
 
-        new_tokens = [self.Token.copy(token) for token in tokens]
+        return self._propagate_batch([tokens], [link], [lm_scale],
+                                     [wi_penalty])[0]
 
-        if link is None:
-            self._append_word(new_tokens, self._eos_id)
-        else:
-            for token in new_tokens:
-                if link.ac_logprob is not None:
-                    token.ac_logprob += link.ac_logprob
-                if link.lm_logprob is not None:
-                    token.lat_lm_logprob += link.lm_logprob
-
-            if link.word is not None:
-                try:
-                    word = self._vocabulary.word_to_id[link.word]
-                except KeyError:
-                    word = link.word
+    def _propagate_batch(self, link_tokens, links, lm_scales, wi_penalties):
+        """Propagates a set of tokens to each of the given links, computing the
+        NNLM probabilities of all the links with a single call to the step
+        function.
+
+        Works like ``_propagate()``, but the (token, word) pairs of every link
+        are stacked into one mini-batch, so that the overhead of calling the
+        Theano function is shared by all the links. The links may be from
+        different lattices.
+
+        :type link_tokens: list of lists of LatticeDecoder.Tokens
+        :param link_tokens: input tokens for each link
+
+        :type links: list of tuples
+        :param links: the word, acoustic log probability, and language model
+                      log probability of each link where the tokens will be
+                      propagated, as in ``_propagate()``; ``None`` means
+                      propagating to the end of sentence
+
+        :type lm_scales: list of logprob_types
+        :param lm_scales: scale language model log probabilities of each link
+                          by this factor
+
+        :type wi_penalties: list of logprob_types
+        :param wi_penalties: penalize word insertion by adding this value to
+                             the total log probability of the tokens of each
+                             link
+
+        :rtype: list of lists of LatticeDecoder.Tokens
+        :returns: the propagated tokens for each link
+        """
+
+        result = []
+        step_tokens = []
+        step_words = []
+        step_oov_logprobs = []
+        for tokens, link in zip(link_tokens, links):
+            new_tokens = [self.Token.copy(token) for token in tokens]
+            result.append(new_tokens)
+
+            if link is None:
+                word = self._eos_id
+                oov_logprob = None
+            else:
+                word, ac_logprob, lm_logprob = link
+                for token in new_tokens:
+                    if ac_logprob is not None:
+                        token.ac_logprob += ac_logprob
+                    if lm_logprob is not None:
+                        token.lat_lm_logprob += lm_logprob
+                if word is None:
+                    continue
                 if self._unk_from_lattice:
-                    self._append_word(new_tokens, word, link.lm_logprob)
-                elif self._unk_penalty is not None:
-                    self._append_word(new_tokens, word, self._unk_penalty)
+                    oov_logprob = lm_logprob
                 else:
-                    self._append_word(new_tokens, word)
+                    oov_logprob = self._unk_penalty
 
-        for token in new_tokens:
-            token.recompute_hash(self._recombination_order)
-            token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
-                                  self._linear_interpolation)
-            if link is not None and link.end_node is not None:
-                if (link.end_node.best_logprob is None) or \
-                   (token.total_logprob > link.end_node.best_logprob):
-                    link.end_node.best_logprob = token.total_logprob
+            step_tokens.extend(new_tokens)
+            step_words.extend([word] * len(new_tokens))
+            step_oov_logprobs.extend([oov_logprob] * len(new_tokens))
 
-        return new_tokens
+        if step_tokens:
+            self._append_words(step_tokens, step_words, step_oov_logprobs)
 
-    def _prune(self, node, sorted_nodes, tokens, recomb_tokens):
+        for new_tokens, lm_scale, wi_penalty in zip(result, lm_scales,
+                                                    wi_penalties):
+            for token in new_tokens:
+                token.recompute_hash(self._recombination_order)
+                token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
+                                      self._linear_interpolation)
+
+        return result
+
+    def _prune(self, node_id, sorted_nodes, tokens, recomb_tokens):
         """Prunes tokens from a node according to beam and the maximum number of
         tokens, and recombines tokens whose N previous words are identical
         (where N is the recombination order).
 
-        :type node: Lattice.Node
-        :param node: perform pruning on this node
+        :type node_id: int
+        :param node_id: perform pruning on the node with this ID
 
-        :type sorted_nodes: list of Lattice.Nodes
-        :param sorted_nodes: all nodes in topological order
+        :type sorted_nodes: list of ints
+        :param sorted_nodes: IDs of all the nodes in topological order
 
-        :type tokens: list of LatticeDecoder.Tokens
-        :param tokens: all tokens
+        :type tokens: list of lists of LatticeDecoder.Tokens
+        :param tokens: the tokens of each node
 
         :type recomb_tokens: list of tuples
         :param recomb_tokens: for all tokens that were dropped during
@@ -494,7 +1185,7 @@ class LatticeDecoder(object):
         :returns: a dictionary of statistics collected during pruning
         """
 
-        node_tokens = tokens[node.id]
+        node_tokens = tokens[node_id]
         assert node_tokens
         stats = dict()
         stats['before'] = len(node_tokens)
@@ -504,46 +1195,36 @@ class LatticeDecoder(object):
             limit_divider = len(sorted_nodes) // self._prune_extra_limit + 1
             limit_divider = max(1, limit_divider)
 
-        new_tokens = self._sorted_recombined_tokens(node_tokens,
-                                                    recomb_tokens)
+        new_tokens, logprobs = self._recombine_tokens(node_tokens,
+                                                      recomb_tokens)
         stats['after-recomb'] = len(new_tokens)
 
         # Compare to the best probability at the same or later time.
         if self._beam is not None:
-            if node.time is None:
-                node_ids = [iter_node.id for iter_node in sorted_nodes]
-                time_begin = node_ids.index(node.id)
-            else:
-                for time_begin, iter_node in enumerate(sorted_nodes):
-                    if (iter_node.time is not None) and \
-                       (iter_node.time >= node.time):
-                        break
-            assert time_begin < len(sorted_nodes)
-            best_logprob = max(iter_node.best_logprob
-                               for iter_node in sorted_nodes[time_begin:]
-                               if iter_node.best_logprob is not None)
+            best_logprob = self._best_logprobs.best_logprob(node_id)
 
             beam = self._beam / limit_divider
             beam = max(beam, self._abs_min_beam)
             threshold = best_logprob - beam
 
             stats['best'] = best_logprob
-            stats['node-best'] = new_tokens[0].total_logprob
-            stats['node-worst'] = new_tokens[-1].total_logprob
+            stats['node-best'] = logprobs[0]
+            stats['node-worst'] = logprobs[-1]
             stats['threshold'] = threshold
-            stats['average'] = sum(t.total_logprob for t in new_tokens) / len(new_tokens)
+            stats['average'] = logprobs.mean()
             if len(new_tokens) >= 10:
-                stats['pos10'] = new_tokens[9].total_logprob
+                stats['pos10'] = logprobs[9]
             if len(new_tokens) >= 50:
-                stats['pos50'] = new_tokens[49].total_logprob
+                stats['pos50'] = logprobs[49]
             if len(new_tokens) >= 100:
-                stats['pos100'] = new_tokens[99].total_logprob
-
-            keep_tokens = len(new_tokens)
-            while (keep_tokens > 1) and \
-                  (new_tokens[keep_tokens - 1].total_logprob <= threshold):
-                keep_tokens -= 1
-            new_tokens = new_tokens[:keep_tokens]
+                stats['pos100'] = logprobs[99]
+
+            # The log probabilities are in descending order, so the tokens
+            # above the threshold can be found using binary search. At least
+            # one token is always kept.
+            keep_tokens = numpy.searchsorted(-logprobs, -threshold,
+                                             side='left')
+            new_tokens = new_tokens[:max(1, keep_tokens)]
         stats['after-beam'] = len(new_tokens)
 
         # Enforce limit on number of tokens at each node.
@@ -553,9 +1234,93 @@ class LatticeDecoder(object):
             new_tokens = new_tokens[:max_tokens]
         stats['after-max'] = len(new_tokens)
 
-        tokens[node.id] = new_tokens
+        tokens[node_id] = new_tokens
         return stats
 
+    def _prune_window(self, node_id, search, stats):
+        """Limits the number of tokens that are propagated from the nodes
+        within a time window, according to their total log probability.
+
+        The nodes are processed in topological order, so the tokens of a node
+        have to be pruned before the tokens of the following nodes in the same
+        window are known. The best ``max_tokens_per_window`` log probabilities
+        of the tokens propagated from each window are kept in a heap. A token
+        is propagated only if it's among the best ``max_tokens_per_window``
+        tokens seen so far in the window, so a node with good tokens can
+        propagate them even if the nodes processed earlier have used up the
+        count. The best token of each node is always kept. Nodes without time
+        stamp are not limited.
+
+        :type node_id: int
+        :param node_id: ID of a node whose tokens have been sorted and pruned
+                        by ``_prune()``
+
+        :type search: LatticeDecoder.Search
+        :param search: the decoding state of the lattice
+
+        :type stats: dict
+        :param stats: a dictionary of pruning statistics, where the number of
+                      remaining tokens will be added
+        """
+
+        window = search.node_windows[node_id]
+        if window is None:
+            return
+
+        best_logprobs = search.window_logprobs.setdefault(window, [])
+        node_tokens = search.tokens[node_id]
+        # The tokens are in descending order of total log probability.
+        keep_tokens = 0
+        for token in node_tokens:
+            logprob = token.total_logprob
+            if len(best_logprobs) < self._max_tokens_per_window:
+                heapq.heappush(best_logprobs, logprob)
+            elif logprob > best_logprobs[0]:
+                heapq.heapreplace(best_logprobs, logprob)
+            elif keep_tokens > 0:
+                break
+            keep_tokens += 1
+        search.tokens[node_id] = node_tokens[:keep_tokens]
+        stats['after-window'] = keep_tokens
+
+    def _window_filter(self, node_id, new_tokens, search):
+        """Drops tokens that arrive at a node and would be pruned from the
+        node by ``_prune_window()``.
+
+        The threshold of a window is the worst of the best
+        ``max_tokens_per_window`` log probabilities of the tokens propagated
+        from the window so far. The threshold only increases, so a token below
+        the threshold will not be propagated. The best token is kept, in case
+        it will be the best token of the node.
+
+        :type node_id: int
+        :param node_id: ID of the node where the tokens arrive
+
+        :type new_tokens: list of LatticeDecoder.Tokens
+        :param new_tokens: tokens that have been propagated to the node through
+                           one link
+
+        :type search: LatticeDecoder.Search
+        :param search: the decoding state of the lattice
+
+        :rtype: list of LatticeDecoder.Tokens
+        :returns: the tokens that may be propagated from the node
+        """
+
+        window = search.node_windows[node_id]
+        if window is None:
+            return new_tokens
+        best_logprobs = search.window_logprobs.get(window)
+        if (best_logprobs is None) or \
+           (len(best_logprobs) < self._max_tokens_per_window) or \
+           (len(new_tokens) < 2):
+            return new_tokens
+
+        threshold = best_logprobs[0]
+        best_token = max(new_tokens, key=lambda token: token.total_logprob)
+        return [token for token in new_tokens
+                if (token.total_logprob > threshold) or (token is best_token)]
+
     def _sorted_recombined_tokens(self, tokens, recomb_tokens):
         """Sorts tokens by descending probability and recombines tokens with
         identical hash.
@@ -579,39 +1344,95 @@ class LatticeDecoder(object):
                   those with identical recombination hash
         """
 
-        sorted_tokens = sorted(tokens,
-                               key=lambda token: token.total_logprob,
-                               reverse=True)
+        return self._recombine_tokens(tokens, recomb_tokens)[0]
 
-        token_map = dict()
-        result = []
-        for token in sorted_tokens:
-            key = token.recombination_hash
-            if key not in token_map:
-                result.append(token)
-                token_map[key] = token
-            else:
-                kept_token = token_map[key]
-                recomb_tokens.append((token,
-                                      kept_token.history,
-                                      kept_token.nn_lm_logprob))
-        return result
+    def _recombine_tokens(self, tokens, recomb_tokens):
+        """Sorts and recombines tokens like ``_sorted_recombined_tokens()``,
+        and returns also the total log probabilities of the resulting tokens.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens
+
+        :type recomb_tokens: list of tuples
+        :param recomb_tokens: tokens that are dropped during recombination will
+                              be added to this list
 
-    def _append_word(self, tokens, target_word, oov_logprob=None):
+        :rtype: tuple of a list and a numpy.ndarray
+        :returns: the tokens in sorted order and with only the best token of
+                  those with identical recombination hash, and a vector of
+                  their total log probabilities
+        """
+
+        logprobs = numpy.array([token.total_logprob for token in tokens])
+        hashes = numpy.array([token.recombination_hash for token in tokens],
+                             dtype='int64')
+        kept, dropped, dropped_to_kept = \
+            self._recombination_indices(logprobs, hashes)
+        for token_index, kept_index in zip(dropped, dropped_to_kept):
+            kept_token = tokens[kept_index]
+            recomb_tokens.append((tokens[token_index],
+                                  kept_token.history,
+                                  kept_token.nn_lm_logprob))
+        return [tokens[index] for index in kept], logprobs[kept]
+
+    @staticmethod
+    def _recombination_indices(logprobs, hashes):
+        """Finds the best token of each group of tokens with identical
+        recombination hash.
+
+        Sorts the tokens by descending log probability using a stable sort, so
+        that tokens with equal probability retain their order. Then the first
+        token of each recombination hash in the sorted order is kept.
+
+        :type logprobs: numpy.ndarray
+        :param logprobs: a vector of total log probabilities of the tokens
+
+        :type hashes: numpy.ndarray
+        :param hashes: a vector of recombination hashes of the tokens
+
+        :rtype: tuple of three numpy.ndarrays
+        :returns: indices of the kept tokens in descending order of log
+                  probability; indices of the dropped tokens in descending
+                  order of log probability; and for each dropped token, the
+                  index of the kept token that has the same hash
+        """
+
+        num_tokens = logprobs.size
+        if num_tokens < 2:
+            empty = numpy.zeros(0, dtype='int64')
+            return numpy.arange(num_tokens), empty, empty
+
+        order = numpy.argsort(-logprobs, kind='stable')
+        _, first, inverse = numpy.unique(hashes[order],
+                                         return_index=True,
+                                         return_inverse=True)
+        is_kept = numpy.zeros(num_tokens, dtype=bool)
+        is_kept[first] = True
+        kept = order[is_kept]
+        dropped = order[~is_kept]
+        dropped_to_kept = order[first[inverse[~is_kept]]]
+        return kept, dropped, dropped_to_kept
+
+    def _append_words(self, tokens, target_words, oov_logprobs):
         """Appends a word to each of the given tokens, and updates their scores.
+        Each token may be given a different word.
+
+        The tokens are processed with a single call to the step function.
 
         :type tokens: list of LatticeDecoder.Tokens
         :param tokens: input tokens
 
-        :type target_word: int or str
-        :param target_word: word ID or word to be appended to the existing
-                            history of each input token; if not an integer, the
-                            word will be considered ``<unk>`` and this variable
-                            will be taken literally as the word that will be
-                            used in the resulting transcript
-
-        :type oov_logprob: float
-        :param oov_logprob: log probability to be assigned to OOV words
+        :type target_words: list of ints or strs
+        :param target_words: word ID or word to be appended to the existing
+                             history of each input token; if not an integer,
+                             the word will be considered ``<unk>`` and taken
+                             literally as the word that will be used in the
+                             resulting transcript
+
+        :type oov_logprobs: list of floats
+        :param oov_logprobs: log probability to be assigned to each target word,
+                             if it's an OOV word, or ``None`` to use the value
+                             predicted by the network
         """
 
         def limit_to_shortlist(self, word):
@@ -623,35 +1444,145 @@ class LatticeDecoder(object):
             else:
                 return self._unk_id
 
-        input_word_ids = [[limit_to_shortlist(self, token.history[-1])
-                           for token in tokens]]
-        input_word_ids = numpy.asarray(input_word_ids).astype('int64')
-        input_class_ids, membership_probs = \
-            self._vocabulary.get_class_memberships(input_word_ids)
-        recurrent_state = [token.state for token in tokens]
-        recurrent_state = RecurrentState.combine_sequences(recurrent_state)
-        target_word_id = limit_to_shortlist(self, target_word)
-        target_class_ids = numpy.ones(shape=(1, len(tokens))).astype('int64')
-        target_class_ids *= self._vocabulary.word_id_to_class_id[target_word_id]
-        step_result = self._step_function(input_word_ids,
-                                          input_class_ids,
-                                          target_class_ids,
-                                          *recurrent_state.get())
-        logprobs = step_result[0]
+        # Tokens that have been copied from the same token share the recurrent
+        # state and the last word, so their state needs to be advanced only
+        # once. Each such group of tokens is represented by one sequence in the
+        # mini-batch.
+        sequence_indices = dict()
+        sequence_tokens = []
+        target_sequence_ids = []
+        for token in tokens:
+            key = (token.state, token.history.word)
+            index = sequence_indices.get(key)
+            if index is None:
+                index = len(sequence_tokens)
+                sequence_indices[key] = index
+                sequence_tokens.append(token)
+            target_sequence_ids.append(index)
+        target_sequence_ids = numpy.asarray(target_sequence_ids).astype('int64')
+        num_sequences = len(sequence_tokens)
+
+        target_word_ids = [limit_to_shortlist(self, word)
+                           for word in target_words]
+        target_word_ids = numpy.asarray(target_word_ids).astype('int64')
+        target_class_ids, membership_probs = \
+            self._vocabulary.get_class_memberships(target_word_ids)
+        logprobs = numpy.zeros(len(tokens), dtype=theano.config.floatX)
+        sequence_states = [None] * num_sequences
+
+        # Read the log probabilities from the cache when possible. A sequence
+        # needs to be computed only if some of its target words are missing.
+        is_cached = numpy.zeros(len(tokens), dtype=bool)
+        if self._cache is not None:
+            cache_keys = [self._cache_key(token.history)
+                          for token in sequence_tokens]
+            cache_entries = [self._cache.get(key) for key in cache_keys]
+            for index, sequence_id in enumerate(target_sequence_ids):
+                entry = cache_entries[sequence_id]
+                if entry is None:
+                    continue
+                logprob = entry.logprobs.get(int(target_class_ids[index]))
+                if logprob is not None:
+                    logprobs[index] = logprob
+                    is_cached[index] = True
+            num_hits = numpy.count_nonzero(is_cached)
+            self._cache.num_hits += num_hits
+            self._cache.num_misses += len(tokens) - num_hits
+
+        target_indices = numpy.flatnonzero(~is_cached)
+        computed_sequence_ids = numpy.unique(target_sequence_ids[target_indices])
+        if computed_sequence_ids.size > 0:
+            # Map the sequences that will be computed to mini-batch indices.
+            batch_sequence_ids = numpy.zeros(num_sequences, dtype='int64')
+            batch_sequence_ids[computed_sequence_ids] = \
+                numpy.arange(computed_sequence_ids.size)
+            computed_tokens = [sequence_tokens[sequence_id]
+                               for sequence_id in computed_sequence_ids]
+
+            input_word_ids = [[limit_to_shortlist(self, token.history.word)
+                               for token in computed_tokens]]
+            input_word_ids = numpy.asarray(input_word_ids).astype('int64')
+            input_class_ids, _ = \
+                self._vocabulary.get_class_memberships(input_word_ids)
+            recurrent_state = self._state_pool.get(
+                [token.state for token in computed_tokens])
+            step_result = self._step_function(
+                input_word_ids,
+                input_class_ids,
+                batch_sequence_ids[target_sequence_ids[target_indices]],
+                target_class_ids[target_indices],
+                *recurrent_state.get())
+            logprobs[target_indices] = step_result[0]
+            output_state = step_result[1:]
+
+            # Store the output state in the pool. Tokens that were advanced
+            # from the same sequence will share the same row.
+            output_state = RecurrentState(self._network.recurrent_state_size,
+                                          computed_sequence_ids.size,
+                                          output_state)
+            rows = self._state_pool.add(output_state)
+            for batch_id, sequence_id in enumerate(computed_sequence_ids):
+                sequence_states[sequence_id] = rows[batch_id]
+
+            if self._cache is not None:
+                for batch_id, sequence_id in enumerate(computed_sequence_ids):
+                    indices = target_indices[
+                        target_sequence_ids[target_indices] == sequence_id]
+                    state = RecurrentState(
+                        self._network.recurrent_state_size,
+                        1,
+                        [layer_state[:, batch_id:batch_id + 1]
+                         for layer_state in output_state.get()])
+                    self._cache.add(cache_keys[sequence_id],
+                                    state,
+                                    [int(x) for x in target_class_ids[indices]],
+                                    logprobs[indices])
+
+        # The states of the sequences whose every target was found from the
+        # cache are copied from the cache to the pool.
+        cached_sequence_ids = [sequence_id
+                               for sequence_id in range(num_sequences)
+                               if sequence_states[sequence_id] is None]
+        if cached_sequence_ids:
+            cached_state = RecurrentState.combine_sequences(
+                [cache_entries[sequence_id].state
+                 for sequence_id in cached_sequence_ids])
+            rows = self._state_pool.add(cached_state)
+            for row, sequence_id in zip(rows, cached_sequence_ids):
+                sequence_states[sequence_id] = row
+
         # Add logprobs from the class membership of the predicted words.
         logprobs += numpy.log(membership_probs)
-        output_state = step_result[1:]
 
         for index, token in enumerate(tokens):
-            token.history = token.history + (target_word,)
-            token.state = RecurrentState(self._network.recurrent_state_size)
-            # Slice the sequence that corresponds to this token.
-            token.state.set([layer_state[:, index:index + 1]
-                             for layer_state in output_state])
-            # logprobs matrix contains only one time step.
+            target_word = target_words[index]
+            token.history = self.History(target_word, token.history)
+            token.state = int(sequence_states[target_sequence_ids[index]])
             token.nn_lm_logprob += self._handle_unk_logprob(target_word,
-                                                            logprobs[0, index],
-                                                            oov_logprob)
+                                                            logprobs[index],
+                                                            oov_logprobs[index])
+
+    def _cache_key(self, history):
+        """Returns the key that is used to find the recurrent state and log
+        probabilities after ``history`` from the cache.
+
+        The key is the part of the history that is also considered when
+        recombining tokens. Thus the cache makes the same assumption as
+        recombination, that the probabilities are not affected by the words
+        older than the recombination order. The key is always a tuple, so that
+        the cache doesn't keep the token histories and their parents alive.
+
+        :type history: LatticeDecoder.History
+        :param history: word IDs that a token has passed
+
+        :rtype: tuple
+        :returns: the entire history, or the last words of the history
+        """
+
+        if self._recombination_order is None:
+            return tuple(history)
+        else:
+            return history.suffix(self._recombination_order)
 
     def _handle_unk_logprob(self, word, network_logprob, oov_logprob):
         """Returns the log probability after applying <unk> processing.
@@ -696,24 +1627,34 @@ class LatticeDecoder(object):
 
         return network_logprob
 
-    def _log_stats(self, stats, node_id, num_nodes):
-        """Writes pruning statistics to debug log.
+    def _log_stats(self, stats, node_id, nodes_processed, num_nodes):
+        """Writes pruning statistics and NNLM cache statistics to debug log.
 
         :type stats: dict
         :param stats: a dictionary of statistics on the number of tokens and
                       their log probabilities
+
+        :type node_id: int
+        :param node_id: ID of the node that was processed
+
+        :type nodes_processed: int
+        :param nodes_processed: number of nodes processed in the lattice
+
+        :type num_nodes: int
+        :param num_nodes: number of nodes in the lattice
         """
 
-        if self._nodes_processed % math.ceil(num_nodes / 20) != 0:
+        if nodes_processed % math.ceil(num_nodes / 20) != 0:
             return
 
         optional = ''
-        for name in ('after-recomb', 'after-beam', 'after-max', 'new'):
+        for name in ('after-recomb', 'after-beam', 'after-max', 'after-window',
+                     'new'):
             if name in stats:
                 optional += ' {}={}'.format(name, stats[name])
         logging.debug('[%d] (%.2f %%) node=%d -- tokens before=%d%s',
-                      self._nodes_processed,
-                      self._nodes_processed / num_nodes * 100,
+                      nodes_processed,
+                      nodes_processed / num_nodes * 100,
                       node_id,
                       stats['before'],
                       optional)
@@ -727,3 +1668,11 @@ class LatticeDecoder(object):
             logging.debug('logprob best=%.1f%s',
                           stats['best'],
                           optional)
+
+        if self._cache is not None:
+            logging.debug('NNLM cache hits=%d misses=%d histories=%d '
+                          'size=%.1f MB',
+                          self._cache.num_hits,
+                          self._cache.num_misses,
+                          len(self._cache),
+                          self._cache.size / (1024 * 1024))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the NBestScorer class.
+"""
+
+import numpy
+import theano
+from theano import tensor
+
+from theanolm.backend import NumberError
+
+class NBestScorer(object):
+    """N-best List Scoring Using a Neural Network Language Model
+
+    The hypotheses of an n-best list typically share long prefixes. The scorer
+    stores the hypotheses in a prefix tree, and advances the recurrent state
+    only once for each unique prefix. The tree is processed one level at a
+    time, so that all the prefixes of the same length are computed with a
+    single call to the step function.
+    """
+
+    def __init__(self, network, use_shortlist=True, exclude_unk=False,
+                 max_batch_size=None, profile=False):
+        """Creates a Theano function that computes the output probabilities for
+        a single time step.
+
+        ``self._step_function`` takes as input the last words of a set of
+        prefixes and their recurrent states. It advances the recurrent states
+        and computes the probabilities of a list of target words, each of which
+        refers to one of the prefixes. The function is identical to the one used
+        by the lattice decoder.
+
+        :type network: Network
+        :param network: the neural network object, created with
+                        ``Network.Mode(minibatch=False)``
+
+        :type use_shortlist: bool
+        :param use_shortlist: if ``True``, the ``<unk>`` probability is
+                              distributed among the out-of-shortlist words
+
+        :type exclude_unk: bool
+        :param exclude_unk: if set to ``True``, ``<unk>`` tokens are excluded
+                            from probability computation
+
+        :type max_batch_size: int
+        :param max_batch_size: if set to other than ``None``, at most this many
+                               prefixes are advanced with one call to the step
+                               function
+
+        :type profile: bool
+        :param profile: if set to True, creates a Theano profile object
+        """
+
+        self._network = network
+        self._vocabulary = network.vocabulary
+        self._unk_id = self._vocabulary.word_to_id['<unk>']
+        self._exclude_unk = exclude_unk
+        self._max_batch_size = max_batch_size
+
+        if use_shortlist and network.oos_logprobs is not None:
+            oos_logprobs = numpy.log(self._vocabulary.get_oos_probs())
+            self._oos_logprobs = oos_logprobs.astype(theano.config.floatX)
+        else:
+            self._oos_logprobs = None
+
+        # The target words are given as (sequence index, class ID) pairs, so
+        # that the probabilities of several words can be read from the output
+        # distribution of one sequence.
+        target_sequence_ids = tensor.vector('nbestscorer/target_sequence_ids',
+                                            dtype='int64')
+        target_class_ids = tensor.vector('nbestscorer/target_class_ids',
+                                         dtype='int64')
+
+        inputs = [network.input_word_ids,
+                  network.input_class_ids,
+                  target_sequence_ids,
+                  target_class_ids]
+        inputs.extend(network.recurrent_state_input)
+
+        # The output distribution contains only one time step.
+        output_probs = network.output_probs()[0]
+        target_probs = output_probs[(target_sequence_ids, target_class_ids)]
+        outputs = [tensor.log(target_probs)]
+        outputs.extend(network.recurrent_state_output)
+
+        # Ignore unused input, because is_training is only used by dropout
+        # layer.
+        self._step_function = theano.function(
+            inputs,
+            outputs,
+            givens=[(network.is_training, numpy.int8(0))],
+            name='nbest_step_predictor',
+            profile=profile,
+            on_unused_input='ignore')
+
+        # These are updated by score_nbest().
+        self.num_words = 0
+        self.num_unks = 0
+        self.num_predictions = 0
+        self.num_computed = 0
+
+    def score_nbest(self, hypotheses):
+        """Computes the log probabilities of the hypotheses of an n-best list.
+
+        Each hypothesis should start with the start-of-sentence tag, as returned
+        by ``utterance_from_line()``. The first word of every hypothesis is not
+        predicted. The probabilities are excluded from the score in the same
+        cases as in ``TextScorer.score_sequence()``.
+
+        :type hypotheses: list of lists of strs
+        :param hypotheses: the word sequence of each hypothesis
+
+        :rtype: list of floats
+        :returns: log probability of each hypothesis
+        """
+
+        if not hypotheses:
+            return []
+
+        # Node 0 is the root of the tree. Each hypothesis ends in a node that
+        # represents its whole word sequence.
+        node_words = [-1]
+        node_parents = [-1]
+        node_depths = [0]
+        node_children = [dict()]
+        end_nodes = []
+        for words in hypotheses:
+            word_ids = self._vocabulary.words_to_ids(words)
+            self.num_words += word_ids.size
+            self.num_unks += numpy.count_nonzero(word_ids == self._unk_id)
+            self.num_predictions += max(word_ids.size - 1, 0)
+            node_id = 0
+            for word_id in word_ids:
+                word_id = int(word_id)
+                child_id = node_children[node_id].get(word_id)
+                if child_id is None:
+                    child_id = len(node_words)
+                    node_children[node_id][word_id] = child_id
+                    node_words.append(word_id)
+                    node_parents.append(node_id)
+                    node_depths.append(node_depths[node_id] + 1)
+                    node_children.append(dict())
+                node_id = child_id
+            end_nodes.append(node_id)
+
+        node_words = numpy.array(node_words, dtype='int64')
+        node_parents = numpy.array(node_parents, dtype='int64')
+        node_depths = numpy.array(node_depths, dtype='int64')
+        num_children = numpy.array([len(x) for x in node_children])
+        node_logprobs, is_included = self._target_logprobs(node_words)
+
+        # Advance the prefixes one level at a time. The recurrent state of a
+        # node is the state after its parent has been processed.
+        state = [numpy.zeros((1, 1, size)).astype(theano.config.floatX)
+                 for size in self._network.recurrent_state_size]
+        state_rows = numpy.zeros(len(node_words), dtype='int64')
+        max_depth = node_depths.max()
+        for depth in range(1, max_depth):
+            frontier = numpy.flatnonzero((node_depths == depth) &
+                                         (num_children > 0))
+            batch_size = self._max_batch_size or frontier.size
+            output_states = []
+            for start in range(0, frontier.size, batch_size):
+                batch = frontier[start:start + batch_size]
+                output_states.append(
+                    self._advance(batch, node_words, node_children,
+                                  node_logprobs, state, state_rows))
+            state = [numpy.concatenate(layer_states, axis=1)
+                     for layer_states in zip(*output_states)]
+            for frontier_index, node_id in enumerate(frontier):
+                for child_id in node_children[node_id].values():
+                    state_rows[child_id] = frontier_index
+
+        # Accumulate the log probabilities from the root to the leaves.
+        node_totals = numpy.zeros(len(node_words))
+        for depth in range(2, max_depth + 1):
+            level = numpy.flatnonzero(node_depths == depth)
+            node_totals[level] = node_totals[node_parents[level]] + \
+                numpy.where(is_included[level], node_logprobs[level], 0.0)
+        self.num_computed += len(node_words) - \
+                             numpy.count_nonzero(node_depths <= 1)
+
+        result = []
+        for end_node in end_nodes:
+            logprob = node_totals[end_node]
+            if numpy.isnan(logprob):
+                raise NumberError("Log probability of a hypothesis is NaN.")
+            result.append(logprob)
+        return result
+
+    def _advance(self, batch, node_words, node_children, node_logprobs, state,
+                 state_rows):
+        """Advances the recurrent state of a batch of prefixes and computes the
+        log probabilities of their children.
+
+        :type batch: numpy.ndarray
+        :param batch: IDs of the nodes whose state will be advanced
+
+        :type node_words: numpy.ndarray
+        :param node_words: word ID of each node
+
+        :type node_children: list of dicts
+        :param node_children: a mapping from word IDs to child node IDs for
+                              each node
+
+        :type node_logprobs: numpy.ndarray
+        :param node_logprobs: the log probability of each node, without the
+                              network output; the network log probabilities of
+                              the children will be added to this
+
+        :type state: list of numpy.ndarrays
+        :param state: the recurrent states of the current level
+
+        :type state_rows: numpy.ndarray
+        :param state_rows: the sequence index of each node within ``state``
+
+        :rtype: list of numpy.ndarrays
+        :returns: the recurrent states after the nodes in ``batch``
+        """
+
+        shortlist_size = self._vocabulary.num_shortlist_words()
+        input_word_ids = node_words[batch]
+        input_word_ids[input_word_ids >= shortlist_size] = self._unk_id
+        input_word_ids = input_word_ids[numpy.newaxis]
+        input_class_ids, _ = \
+            self._vocabulary.get_class_memberships(input_word_ids)
+
+        target_sequence_ids = []
+        target_node_ids = []
+        for sequence_id, node_id in enumerate(batch):
+            children = list(node_children[node_id].values())
+            target_sequence_ids.extend([sequence_id] * len(children))
+            target_node_ids.extend(children)
+        target_sequence_ids = numpy.array(target_sequence_ids, dtype='int64')
+        target_node_ids = numpy.array(target_node_ids, dtype='int64')
+        target_class_ids, _ = \
+            self._vocabulary.get_class_memberships(node_words[target_node_ids])
+
+        rows = state_rows[batch]
+        step_result = self._step_function(
+            input_word_ids,
+            input_class_ids,
+            target_sequence_ids,
+            target_class_ids,
+            *[layer_state[:, rows] for layer_state in state])
+        node_logprobs[target_node_ids] += step_result[0]
+        return step_result[1:]
+
+    def _target_logprobs(self, word_ids):
+        """Computes the part of the log probabilities of target words that does
+        not depend on the network output, and decides which words are excluded
+        from the scores.
+
+        The class membership log probability is added to every word. When using
+        a shortlist, the unigram log probability within the out-of-shortlist
+        words is also added, and OOV words are excluded. Otherwise, if
+        ``exclude_unk`` was given, OOV and OOS words are excluded. Words with
+        zero class membership probability are always excluded.
+
+        :type word_ids: numpy.ndarray
+        :param word_ids: a vector of word IDs
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: a vector of log probabilities and a boolean vector that is
+                  ``False`` for the excluded words
+        """
+
+        _, membership_probs = self._vocabulary.get_class_memberships(
+            numpy.maximum(word_ids, 0))
+        is_included = membership_probs != 0.0
+        with numpy.errstate(divide='ignore'):
+            result = numpy.log(membership_probs)
+        if self._oos_logprobs is not None:
+            result += self._oos_logprobs[numpy.maximum(word_ids, 0)]
+            is_included &= word_ids != self._unk_id
+        elif self._exclude_unk:
+            is_included &= word_ids != self._unk_id
+            is_included &= word_ids < self._vocabulary.num_shortlist_words()
+        return result, is_included
@@ -7,6 +7,7 @@ import logging
 
 from theanolm.backend import InputError
 from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.latticedecoder import LatticeDecoder
 
 class NodeNotFoundError(Exception):
     pass
@@ -87,11 +88,24 @@ class RescoredLattice(Lattice):
         :returns: the created lattice
         """
 
-        def follow_word_ids(word_ids, create=True):
-            """Follows a path from the initial node with given word IDs.
+        # Maps each history that has been followed to the corresponding nodes
+        # in this and the original lattice. Histories that contain the same
+        # words are equal, so they map to the same path.
+        history_nodes = dict()
 
-            :type word_ids: list of ints
-            :param word_ids: IDs of the words to be found on the path
+        def follow_history(history, create=True):
+            """Follows a path from the initial node with the words of a token
+            history.
+
+            Tokens that have been propagated from the same token share the
+            history objects of the common prefix, so the path of a history is
+            found by following the parent pointers until a history that has
+            already been visited, and only the remaining words are followed.
+            Each history is visited only once, so constructing the lattice takes
+            linear time in the number of tokens.
+
+            :type history: LatticeDecoder.History or a sequence of ints
+            :param history: IDs of the words to be found on the path
 
             :type create: bool
             :param create: if ``True``, creates new nodes if necessary
@@ -100,9 +114,28 @@ class RescoredLattice(Lattice):
             :returns: the last node of the path
             """
 
-            words = [vocabulary.id_to_word[id] if isinstance(id, int) else id
-                     for id in word_ids[1:]]
-            return self._follow_words(words, original_lattice, create)
+            history = LatticeDecoder.History.from_sequence(history)
+            unvisited = []
+            while history not in history_nodes:
+                # The first word is the sentence start, which corresponds to the
+                # initial node.
+                if len(history) <= 1:
+                    node = self.initial_node
+                    orig_node = original_lattice.initial_node
+                    break
+                unvisited.append(history)
+                history = history.parent
+            else:
+                node, orig_node = history_nodes[history]
+
+            for history in reversed(unvisited):
+                word_id = history.word
+                word = vocabulary.id_to_word[word_id] \
+                       if isinstance(word_id, int) else word_id
+                node, orig_node = self._follow_word(node, orig_node, word,
+                                                    create)
+                history_nodes[history] = (node, orig_node)
+            return node
 
         super().__init__()
 
@@ -119,7 +152,7 @@ class RescoredLattice(Lattice):
 
         # Create all the paths that correspond to the final tokens.
         for token in final_tokens:
-            node = follow_word_ids(token.history)
+            node = follow_history(token.history)
             # If the lattice is not determinized, it may happen that we have two
             # tokens with the same word sequence.
             if any(link.end_node.final for link in node.out_links):
@@ -148,7 +181,8 @@ class RescoredLattice(Lattice):
             # Find the incoming link that corresponds to the token that was kept
             # during recombination.
             try:
-                recomb_from_node = follow_word_ids(new_history[:-1], False)
+                new_history = LatticeDecoder.History.from_sequence(new_history)
+                recomb_from_node = follow_history(new_history.parent, False)
             except NodeNotFoundError:
                 continue
             # Our new lattice doesn't contain null links, so word_to_link maps
@@ -161,7 +195,7 @@ class RescoredLattice(Lattice):
             # that was kept during recombination. The difference in LM log
             # probability can be computed from the token (path) NNLM log
             # probabilities.
-            from_node = follow_word_ids(token.history[:-1])
+            from_node = follow_history(token.history.parent)
             lm_logprob_diff = token.nn_lm_logprob - nn_lm_logprob
             new_link = self.Link(from_node, recomb_link.end_node, word,
                                  recomb_link.ac_logprob,
@@ -216,59 +250,56 @@ class RescoredLattice(Lattice):
                 "word label, or the lattice contains null links (epsilon "
                 "arcs). Lattice rescoring may not work properly.")
 
-    def _follow_words(self, words, original_lattice, create=True):
-        """Ensures that a path exists, creating new nodes if necessary, and
-        returns the last node of the path.
+    def _follow_word(self, node, orig_node, word, create=True):
+        """Follows a word from a node, creating a new node if necessary.
 
-        The new lattice will be created by repeatedly calling this function. It
-        starts from the beginning of the lattice and follows the nodes that
-        correspond to the given words. When a word is not found from the
-        outgoing links of the node, the tail will be created. Thus the created
-        lattice is always a tree.
+        The new lattice will be created by repeatedly calling this function,
+        following the words of the token histories from the beginning of the
+        lattice. When a word is not found from the outgoing links of the node,
+        a new link and node will be created. Thus the created lattice is always
+        a tree.
 
-        :type words: list of strs
-        :param words: words of the path
+        :type node: Lattice.Node
+        :param node: the node in this lattice where to start
 
-        :type original_lattice: Lattice
-        :param original_lattice: the original lattice where the probabilities of
-            the links will be read from
+        :type orig_node: Lattice.Node
+        :param orig_node: the corresponding node in the original lattice, where
+            the probabilities of the links will be read from
+
+        :type word: str
+        :param word: the word to follow
 
         :type create: bool
         :param create: if set to ``False``, won't create any nodes but raises a
             ``NodeNotFoundError`` if the path doesn't exist
 
-        :rtype: Lattice.Node
-        :returns: the last node of the path
+        :rtype: tuple of two Lattice.Nodes
+        :returns: the end node of the word in this lattice and in the original
+            lattice; the same nodes if the word is not found from the original
+            lattice
         """
 
-        node = self.initial_node
-        orig_node = original_lattice.initial_node
-
-        for word in words:
-            # The original lattice may contain null links that we have to skip.
-            orig_end_node, ac_logprob, lm_logprob, transitions = \
-                _follow_word_from_node(orig_node, word)
-            if orig_end_node is None:
-                continue
+        # The original lattice may contain null links that we have to skip.
+        orig_end_node, ac_logprob, lm_logprob, transitions = \
+            _follow_word_from_node(orig_node, word)
+        if orig_end_node is None:
+            return node, orig_node
+
+        # Our new lattice doesn't contain null links, so word_to_link maps
+        # never skip nodes.
+        if word in node.word_to_link:
+            link = node.word_to_link[word]
+        else:
+            if not create:
+                raise NodeNotFoundError
+            end_node_id = len(self.nodes)
+            end_node = self.Node(end_node_id)
+            end_node.word_to_link = dict()
+            self.nodes.append(end_node)
+            link = self.Link(node, end_node, word,
+                             ac_logprob, lm_logprob, transitions)
+            node.out_links.append(link)
+            node.word_to_link[word] = link
+            self.links.append(link)
 
-            # Our new lattice doesn't contain null links, so word_to_link maps
-            # never skip nodes.
-            if word in node.word_to_link:
-                link = node.word_to_link[word]
-            else:
-                if not create:
-                    raise NodeNotFoundError
-                end_node_id = len(self.nodes)
-                end_node = self.Node(end_node_id)
-                end_node.word_to_link = dict()
-                self.nodes.append(end_node)
-                link = self.Link(node, end_node, word,
-                                 ac_logprob, lm_logprob, transitions)
-                node.out_links.append(link)
-                node.word_to_link[word] = link
-                self.links.append(link)
-
-            node = link.end_node
-            orig_node = orig_end_node
-
-        return node
+        return link.end_node, orig_end_node
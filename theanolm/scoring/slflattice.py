@@ -11,6 +11,7 @@ import numpy
 from theanolm.backend import InputError
 from theanolm.backend import logprob_type
 from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.columnarlattice import ColumnarLattice
 
 def _split_slf_line(line):
     """Parses a list of field    s from an SLF lattice line.
@@ -18,7 +19,10 @@ def _split_slf_line(line):
     Each field contains a name, followed by =, followed by a possible quoted
     value. Only double quotes can be used for quotation, and for the literal
     " the double quote must be escaped (\"). I'm not surprise if other
-    implementations or the standard doesn't agree.
+    implementations or the standard doesn't agree. A field that starts with
+    ``#`` outside quotes begins a comment that extends to the end of the line,
+    but ``#`` inside a field is part of the value, as in
+    ``_split_slf_line_fast()``.
 
     :type line: str
     :param line: a line from an SLF file
@@ -28,9 +32,25 @@ def _split_slf_line(line):
               marks removed
     """
 
+    in_quotes = False
+    escaped = False
+    previous = ' '
+    for index, char in enumerate(line):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            in_quotes = not in_quotes
+        elif (char == '#') and (not in_quotes) and previous.isspace():
+            line = line[:index]
+            break
+        previous = char
+
     lex = shlex(line, posix=True)
     lex.quotes = '"'
     lex.wordchars += "'"
+    lex.commenters = ''
     lex.whitespace_split = True
     return list(lex)
 
@@ -52,6 +72,57 @@ def _split_slf_field(field):
     value = name_value[1]
     return name, value
 
+def _split_slf_line_fast(line):
+    """Parses a list of fields from an SLF lattice line that doesn't contain
+    quotation marks or escape characters.
+
+    Splits the line at whitespace, which is much faster than using ``shlex``.
+    Lines that contain ``"`` or ``\\`` are parsed using ``_split_slf_line()``.
+    A field that starts with ``#`` begins a comment that extends to the end of
+    the line.
+
+    :type line: str
+    :param line: a line from an SLF file
+
+    :rtype: list of strs
+    :returns: list of fields found from the line
+    """
+
+    if ('"' in line) or ('\\' in line):
+        return _split_slf_line(line)
+    fields = line.split()
+    for index, field in enumerate(fields):
+        if field.startswith('#'):
+            return fields[:index]
+    return fields
+
+def _to_logprobs(values, log_scale):
+    """Converts a column of scores read from an SLF lattice to natural
+    logarithm.
+
+    :type values: list of strs
+    :param values: scores as they appear in the lattice file, or ``None`` for
+                   missing scores
+
+    :type log_scale: logprob_type
+    :param log_scale: the natural logarithm of the log base used in the
+                      lattice, or ``None`` if the lattice contains linear
+                      probabilities
+
+    :rtype: numpy.ndarray
+    :returns: a vector of log probabilities, NaN for missing scores
+    """
+
+    values = numpy.array([numpy.nan if value is None else value
+                          for value in values],
+                         dtype='float64')
+    if log_scale is None:
+        with numpy.errstate(divide='ignore'):
+            values = numpy.log(values)
+    else:
+        values = values * log_scale
+    return values.astype(logprob_type)
+
 class SLFLattice(Lattice):
     """SLF Format Word Lattice
 
@@ -59,14 +130,27 @@ class SLFLattice(Lattice):
     the HTK speech recognizer.
     """
 
-    def __init__(self, lattice_file):
+    def __init__(self, lattice_file, objects=True):
         """Reads an SLF lattice file.
 
         If ``lattice_file`` is ``None``, creates an empty lattice (useful for
         testing).
 
+        The lattice is first parsed into arrays: ``node_times`` contains the
+        time of each node (NaN if not given), ``link_start_ids`` and
+        ``link_end_ids`` the node IDs at both ends of each link,
+        ``link_words`` the word label of each link (``None`` for null links),
+        and ``link_ac_logprobs`` and ``link_lm_logprobs`` the acoustic and
+        language model log probabilities (NaN if not given). Unless
+        ``objects`` is ``False``, the node and link objects are then created
+        from the arrays.
+
         :type lattice_file: file object
-        :param lattice_file: a file in SLF lattice format
+        :param lattice_file: a file in SLF lattice format, or a list of lines
+
+        :type objects: bool
+        :param objects: if set to ``False``, only reads the arrays and doesn't
+                        create node and link objects
         """
 
         super().__init__()
@@ -83,10 +167,17 @@ class SLFLattice(Lattice):
             self._num_links = 0
             return
 
+        if hasattr(lattice_file, 'read'):
+            lines = lattice_file.read().splitlines()
+        else:
+            lines = list(lattice_file)
+
         self._num_nodes = None
         self._num_links = None
-        for line in lattice_file:
-            fields = _split_slf_line(line)
+        line_index = 0
+        while line_index < len(lines):
+            fields = _split_slf_line(lines[line_index])
+            line_index += 1
             self._read_slf_header(fields)
             if (self._num_nodes is not None) and (self._num_links is not None):
                 break
@@ -97,50 +188,172 @@ class SLFLattice(Lattice):
             else:
                 self.wi_penalty *= self._log_scale
 
-        self.nodes = [self.Node(node_id) for node_id in range(self._num_nodes)]
+        self._read_slf_body(lines[line_index:])
+        if objects:
+            self._create_objects()
+
+    def _read_slf_body(self, lines):
+        """Reads the node and link definitions into arrays.
+
+        Collects the field values of each line into columns, and converts the
+        numeric columns at once using numpy.
+
+        :type lines: list of strs
+        :param lines: the lines after the SLF header
+        """
 
-        for line in lattice_file:
-            fields = _split_slf_line(line)
+        node_times = [None] * self._num_nodes
+        node_words = [None] * self._num_nodes
+        link_ids = []
+        start_ids = []
+        end_ids = []
+        words = []
+        ac_values = []
+        lm_values = []
+
+        for line in lines:
+            fields = _split_slf_line_fast(line)
             if not fields:
                 continue
             name, value = _split_slf_field(fields[0])
             if name == 'I':
-                self._read_slf_node(int(value), fields[1:])
+                node_id = int(value)
+                for field in fields[1:]:
+                    name, value = _split_slf_field(field)
+                    if (name == 'time') or (name == 't'):
+                        node_times[node_id] = value
+                    elif (name == 'WORD') or (name == 'W'):
+                        node_words[node_id] = value
             elif name == 'J':
-                self._read_slf_link(int(value), fields[1:])
-
-        if len(self.links) != self._num_links:
+                link_ids.append(value)
+                start_id = end_id = word = ac_value = lm_value = None
+                for field in fields[1:]:
+                    name, value = _split_slf_field(field)
+                    if (name == 'START') or (name == 'S'):
+                        start_id = value
+                    elif (name == 'END') or (name == 'E'):
+                        end_id = value
+                    elif (name == 'WORD') or (name == 'W'):
+                        word = value
+                    elif (name == 'acoustic') or (name == 'a'):
+                        ac_value = value
+                    elif (name == 'language') or (name == 'l'):
+                        lm_value = value
+                start_ids.append(start_id)
+                end_ids.append(end_id)
+                words.append(word)
+                ac_values.append(ac_value)
+                lm_values.append(lm_value)
+
+        if len(link_ids) != self._num_links:
             raise InputError("Number of links in SLF lattice doesn't match the "
                              "LINKS field.")
-
+        for link_id, start_id, end_id in zip(link_ids, start_ids, end_ids):
+            if start_id is None:
+                raise InputError("Start node is not specified for link {}."
+                                 .format(link_id))
+            if end_id is None:
+                raise InputError("End node is not specified for link {}."
+                                 .format(link_id))
+
+        self.node_times = numpy.array(
+            [numpy.nan if time is None else time for time in node_times],
+            dtype='float64')
+        self.link_start_ids = numpy.array(start_ids, dtype='int64')
+        self.link_end_ids = numpy.array(end_ids, dtype='int64')
+        self.link_ac_logprobs = _to_logprobs(ac_values, self._log_scale)
+        self.link_lm_logprobs = _to_logprobs(lm_values, self._log_scale)
+
+        # Null words are marked with ! or # in SLF lattices.
+        def is_null(word):
+            return (word is None) or word.startswith('!') or \
+                   word.startswith('#')
+        words = [None if is_null(word) else word for word in words]
+        node_words = [None if is_null(word) else word for word in node_words]
+
+        # If word identity information is not present in link definitions, it
+        # is taken from the end node. Words in the initial node are discarded.
         if self._initial_node_id is not None:
-            self.initial_node = self.nodes[self._initial_node_id]
-        else:
-            # Find the node with no incoming links.
-            self.initial_node = None
-            for node in self.nodes:
-                if len(node.in_links) == 0:
-                    self.initial_node = node
-                    break
-            if self.initial_node is None:
+            node_words[self._initial_node_id] = None
+        for link_index, end_id in enumerate(self.link_end_ids):
+            node_word = node_words[end_id]
+            if node_word is not None:
+                if words[link_index] is not None:
+                    raise InputError("SLF lattice contains words both in nodes "
+                                     "and links.")
+                words[link_index] = node_word
+        self.link_words = words
+
+        # Find the initial node. If not specified, it's the node with no
+        # incoming links.
+        num_in_links = numpy.bincount(self.link_end_ids,
+                                      minlength=self._num_nodes)
+        num_out_links = numpy.bincount(self.link_start_ids,
+                                       minlength=self._num_nodes)
+        if self._initial_node_id is None:
+            initial_ids = numpy.flatnonzero(num_in_links == 0)
+            if initial_ids.size == 0:
                 raise InputError("Could not find initial node in SLF lattice.")
+            self._initial_node_id = int(initial_ids[0])
 
-        final_nodes_found = 0
-        for node in self.nodes:
-            if node.id in self._final_node_ids or len(node.out_links) == 0:
-                node.final = True
-                final_nodes_found += 1
-
-        if final_nodes_found == 0:
+        is_final = num_out_links == 0
+        is_final[self._final_node_ids] = True
+        final_ids = numpy.flatnonzero(is_final)
+        if final_ids.size == 0:
             raise InputError("Could not find final node in SLF lattice.")
-        elif final_nodes_found > 1:
+        elif final_ids.size > 1:
             # Peter: Not sure if multiple final nodes are allowed, but for now raise an input error. The
             # decoder supports multiple final nodes no problem
             raise InputError("More then one final node in SLF lattice.")
+        self._final_node_ids = [int(x) for x in final_ids]
+
+    def to_columnar(self):
+        """Creates a columnar lattice from the arrays that were read from the
+        file, without going through the node and link objects.
+
+        :rtype: ColumnarLattice
+        :returns: a lattice with the same topology and scores, stored in arrays
+        """
+
+        result = ColumnarLattice(self.node_times,
+                                 self.link_start_ids,
+                                 self.link_end_ids,
+                                 self.link_words,
+                                 self.link_ac_logprobs,
+                                 self.link_lm_logprobs,
+                                 self._initial_node_id,
+                                 self._final_node_ids)
+        result.utterance_id = self.utterance_id
+        result.lm_scale = self.lm_scale
+        result.wi_penalty = self.wi_penalty
+        return result
+
+    def _create_objects(self):
+        """Creates the node and link objects from the arrays.
+        """
 
-        # If word identity information is not present in node definitions then
-        # it must appear in link definitions.
-        self._move_words_to_links()
+        self.nodes = [self.Node(node_id) for node_id in range(self._num_nodes)]
+        for node, time in zip(self.nodes, self.node_times.tolist()):
+            if not numpy.isnan(time):
+                node.time = time
+
+        def to_optional(value):
+            return None if numpy.isnan(value) else logprob_type(value)
+
+        for start_id, end_id, word, ac_logprob, lm_logprob in zip(
+                self.link_start_ids.tolist(),
+                self.link_end_ids.tolist(),
+                self.link_words,
+                self.link_ac_logprobs,
+                self.link_lm_logprobs):
+            link = self._add_link(self.nodes[start_id], self.nodes[end_id])
+            link.word = word
+            link.ac_logprob = to_optional(ac_logprob)
+            link.lm_logprob = to_optional(lm_logprob)
+
+        self.initial_node = self.nodes[self._initial_node_id]
+        for node_id in self._final_node_ids:
+            self.nodes[node_id].final = True
 
     def _read_slf_header(self, fields):
         """Reads SLF lattice header fields and saves them in member variables.
@@ -173,114 +386,3 @@ class SLFLattice(Lattice):
                 self._num_nodes = int(value)
             elif (name == 'LINKS') or (name == 'L'):
                 self._num_links = int(value)
-
-    def _read_slf_node(self, node_id, fields):
-        """Reads SLF lattice node fields and saves the information in the given
-        node.
-
-        Some SLF lattices contain word identities in the nodes. They will be
-        saved into the node, but later moved to the links leading to the node.
-
-        :type node_id: int
-        :param node_id: ID of the node
-
-        :type fields: list of strs
-        :param fields: the rest of the node fields after ID
-        """
-
-        node = self.nodes[node_id]
-        for field in fields:
-            name, value = _split_slf_field(field)
-            if (name == 'time') or (name == 't'):
-                node.time = float(value)
-            elif (name == 'WORD') or (name == 'W'):
-                node.word = value
-
-        if hasattr(node, 'word') and \
-           (node.word.startswith('!') or node.word.startswith('#')):
-            node.word = None
-
-    def _read_slf_link(self, link_id, fields):
-        """Reads SLF lattice link fields and creates such link.
-
-        :type link_id: int
-        :param link_id: ID of the link
-
-        :type fields: list of strs
-        :param fields: the rest of the link fields after ID
-        """
-
-        start_node = None
-        end_node = None
-        word = None
-        ac_logprob = None
-        lm_logprob = None
-
-        for field in fields:
-            name, value = _split_slf_field(field)
-            if (name == 'START') or (name == 'S'):
-                start_node = self.nodes[int(value)]
-            elif (name == 'END') or (name == 'E'):
-                end_node = self.nodes[int(value)]
-            elif (name == 'WORD') or (name == 'W'):
-                word = value
-            elif (name == 'acoustic') or (name == 'a'):
-                if self._log_scale is None:
-                    ac_logprob = logprob_type(numpy.log(numpy.float64(value)))
-                else:
-                    ac_logprob = logprob_type(value) * self._log_scale
-            elif (name == 'language') or (name == 'l'):
-                if self._log_scale is None:
-                    lm_logprob = logprob_type(numpy.log(numpy.float64(value)))
-                else:
-                    lm_logprob = logprob_type(value) * self._log_scale
-
-        if start_node is None:
-            raise InputError("Start node is not specified for link {}."
-                             .format(link_id))
-        if end_node is None:
-            raise InputError("End node is not specified for link {}."
-                             .format(link_id))
-        link = self._add_link(start_node, end_node)
-        link.word = word
-        link.ac_logprob = ac_logprob
-        link.lm_logprob = lm_logprob
-
-        if link.word is not None and \
-           (link.word.startswith('!') or link.word.startswith('#')):
-            link.word = None
-
-    def _move_words_to_links(self):
-        """Move word identities from nodes to the links leading to the node.
-
-        SLF lattices may contain words either in the nodes or in the links. If
-        they are in the nodes, move them to the link leading to the node. Note
-        that if there's a word in the initial node, it will be discarded. This
-        is what SRILM does as well, and the SLF format says that the words are
-        in the end nodes in forward lattices.
-        """
-
-        visited = {self.initial_node.id}
-
-        def visit_link(link):
-            """A function that is called recursively to move a word from the
-            link end node to the link.
-            """
-            end_node = link.end_node
-            if hasattr(end_node, 'word'):
-                if link.word is None:
-                    link.word = end_node.word
-                else:
-                    raise InputError("SLF lattice contains words both in nodes "
-                                     "and links.")
-            if end_node.id not in visited:
-                visited.add(end_node.id)
-                for next_link in end_node.out_links:
-                    visit_link(next_link)
-
-        for link in self.initial_node.out_links:
-            visit_link(link)
-
-        for node in self.nodes:
-            if hasattr(node, 'word'):
-                del node.word
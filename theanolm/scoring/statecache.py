@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the StateCache class, a cache for the recurrent
+states and word probabilities computed by the lattice decoder.
+"""
+
+from collections import OrderedDict
+
+import numpy
+
+from theanolm.network import RecurrentState
+
+class StateCache(object):
+    """Least Recently Used Cache of Recurrent States and Log Probabilities
+
+    Maps a word history to the recurrent state after the history has been
+    processed by the network, and the log probabilities of the words that have
+    been predicted after that history. The size of the cache is limited by an
+    estimate of the memory used by the entries. When the limit is exceeded, the
+    least recently used entries are dropped.
+    """
+
+    # Estimated memory consumption of one log probability, including the
+    # dictionary overhead.
+    LOGPROB_SIZE = 100
+
+    # Estimated memory consumption of an entry, excluding the key, the state,
+    # and the log probabilities.
+    ENTRY_SIZE = 500
+
+    # Estimated memory consumption of one word in the key.
+    WORD_SIZE = 8
+
+    class Entry(object):
+        """A cache entry that contains the recurrent state and a mapping from
+        target class IDs to log probabilities.
+        """
+
+        __slots__ = ("state", "logprobs", "size")
+
+        def __init__(self, state, key_length):
+            """Constructs an entry with given state and no log probabilities.
+
+            :type state: RecurrentState
+            :param state: the recurrent state of a single sequence
+
+            :type key_length: int
+            :param key_length: number of words in the history that is used as
+                               the key
+            """
+
+            self.state = state
+            self.logprobs = dict()
+            self.size = StateCache.ENTRY_SIZE + \
+                        StateCache.WORD_SIZE * key_length + \
+                        sum(x.nbytes for x in state.get())
+
+    def __init__(self, max_size):
+        """Constructs an empty cache.
+
+        :type max_size: int
+        :param max_size: maximum estimated memory consumption in bytes
+        """
+
+        self.max_size = max_size
+        self.size = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """Returns the number of entries in the cache.
+
+        :rtype: int
+        :returns: the number of word histories stored in the cache
+        """
+
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the entry stored with given key and marks it as the most
+        recently used one.
+
+        :type key: tuple
+        :param key: the word history
+
+        :rtype: StateCache.Entry
+        :returns: the entry stored with ``key``, or ``None`` if the history is
+                  not in the cache
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def add(self, key, state, class_ids, logprobs):
+        """Adds log probabilities after a history to the cache.
+
+        If the history is already in the cache, replaces the state and adds the
+        log probabilities to the existing ones. The state arrays are copied, so
+        that the cache doesn't keep the whole mini-batch alive.
+
+        :type key: tuple
+        :param key: the word history
+
+        :type state: RecurrentState
+        :param state: the recurrent state of a single sequence after processing
+                      the history
+
+        :type class_ids: list of ints
+        :param class_ids: IDs of the predicted classes
+
+        :type logprobs: list of floats
+        :param logprobs: log probabilities predicted by the network for
+                         ``class_ids``
+        """
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            state = RecurrentState(state.sizes, 1,
+                                   [numpy.copy(x) for x in state.get()])
+            entry = self.Entry(state, len(key))
+        else:
+            self.size -= entry.size
+        for class_id, logprob in zip(class_ids, logprobs):
+            if class_id not in entry.logprobs:
+                entry.size += self.LOGPROB_SIZE
+            entry.logprobs[class_id] = logprob
+        self._entries[key] = entry
+        self.size += entry.size
+
+        while (self.size > self.max_size) and self._entries:
+            _, old_entry = self._entries.popitem(last=False)
+            self.size -= old_entry.size
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the StatePool class, a storage for the recurrent
+states of the lattice decoder tokens.
+"""
+
+import numpy
+import theano
+
+from theanolm.network import RecurrentState
+
+class StatePool(object):
+    """Pool of Recurrent States
+
+    Stores the recurrent states of a large number of sequences in preallocated
+    matrices, one for each recurrent state variable. Each row contains the
+    state of one sequence, so that a sequence is identified by a row index. The
+    states of several sequences can be read and written with a single numpy
+    indexing operation, without allocating small arrays for every sequence.
+
+    Rows are allocated sequentially and never freed individually. When the
+    caller knows which rows are still in use, ``compact()`` moves them to the
+    beginning of the matrices. The matrices are enlarged when needed.
+    """
+
+    def __init__(self, sizes, capacity=1024):
+        """Allocates the state matrices.
+
+        :type sizes: list of ints
+        :param sizes: size of each recurrent state variable
+
+        :type capacity: int
+        :param capacity: initial number of rows to allocate
+        """
+
+        self.sizes = sizes
+        self.size = 0
+        self._capacity = max(1, capacity)
+        self._state_variables = [
+            numpy.zeros((self._capacity, size)).astype(theano.config.floatX)
+            for size in sizes]
+
+    def __len__(self):
+        """Returns the number of rows in use.
+
+        :rtype: int
+        :returns: the number of states stored in the pool
+        """
+
+        return self.size
+
+    @property
+    def capacity(self):
+        """Returns the number of allocated rows.
+
+        :rtype: int
+        :returns: the number of states that can be stored without reallocating
+                  the matrices
+        """
+
+        return self._capacity
+
+    def is_full(self):
+        """Checks whether more than three quarters of the rows are in use, in
+        which case it's time to compact the pool.
+
+        :rtype: bool
+        :returns: ``True`` if the pool should be compacted, ``False`` otherwise
+        """
+
+        return self.size * 4 > self._capacity * 3
+
+    def clear(self):
+        """Releases all the rows, but keeps the matrices allocated.
+        """
+
+        self.size = 0
+
+    def add(self, state):
+        """Stores the states of all the sequences in a ``RecurrentState``.
+
+        :type state: RecurrentState
+        :param state: recurrent state of N sequences
+
+        :rtype: numpy.ndarray
+        :returns: a vector of N row indices where the sequences were stored
+        """
+
+        num_sequences = state.num_sequences
+        self._reserve(self.size + num_sequences)
+        rows = numpy.arange(self.size, self.size + num_sequences)
+        for pool_variable, state_variable in zip(self._state_variables,
+                                                 state.get()):
+            pool_variable[rows] = state_variable[0]
+        self.size += num_sequences
+        return rows
+
+    def get(self, rows):
+        """Reads the states of the sequences at given rows.
+
+        :type rows: list or numpy.ndarray of ints
+        :param rows: row indices of N sequences
+
+        :rtype: RecurrentState
+        :returns: recurrent state of the N sequences, in the same order as in
+                  ``rows``
+        """
+
+        rows = numpy.asarray(rows, dtype='int64')
+        state_variables = [pool_variable[rows][numpy.newaxis]
+                           for pool_variable in self._state_variables]
+        return RecurrentState(self.sizes, len(rows), state_variables)
+
+    def compact(self, rows):
+        """Moves the given rows to the beginning of the pool and releases the
+        rest.
+
+        If more than half of the pool is still in use after compaction, the
+        matrices are enlarged, so that the pool won't have to be compacted too
+        often.
+
+        :type rows: list or numpy.ndarray of ints
+        :param rows: row indices that are still in use; may contain duplicates
+
+        :rtype: numpy.ndarray
+        :returns: a vector that maps the old row indices to new ones; released
+                  rows are mapped to -1
+        """
+
+        rows = numpy.unique(numpy.asarray(rows, dtype='int64'))
+        mapping = numpy.full(self.size, -1, dtype='int64')
+        mapping[rows] = numpy.arange(rows.size)
+        for pool_variable in self._state_variables:
+            pool_variable[:rows.size] = pool_variable[rows]
+        self.size = rows.size
+        if self.size * 2 > self._capacity:
+            self._reserve(self._capacity * 2)
+        return mapping
+
+    def _reserve(self, capacity):
+        """Makes sure that the matrices have space for at least ``capacity``
+        rows, doubling the size of the matrices as many times as necessary.
+
+        :type capacity: int
+        :param capacity: the number of rows needed
+        """
+
+        if capacity <= self._capacity:
+            return
+
+        new_capacity = self._capacity
+        while new_capacity < capacity:
+            new_capacity *= 2
+        for index, pool_variable in enumerate(self._state_variables):
+            new_variable = numpy.zeros((new_capacity, pool_variable.shape[1]),
+                                       dtype=pool_variable.dtype)
+            new_variable[:self.size] = pool_variable[:self.size]
+            self._state_variables[index] = new_variable
+        self._capacity = new_capacity
@@ -11,6 +11,7 @@ import theano.tensor as tensor
 
 from theanolm.backend import NumberError
 from theanolm.backend import test_value
+from theanolm.backend import top_k
 from theanolm.parsing import utterance_from_line
 
 class TextScorer(object):
@@ -81,15 +82,16 @@ class TextScorer(object):
         membership_probs.tag.test_value = test_value(
             size=(20, 4), high=1.0)
    
-        membership_probs_output_vec = tensor.tensor3('textscorer/membership_probs_output_vec',
-                                         dtype=theano.config.floatX)
-        membership_probs_output_vec.tag.test_value = test_value(
-            size=(20, 4, 5), high=1.0)
-
-        k = tensor.scalar('textscorer/k',
-                                         dtype='int64')
+        # Class membership probabilities of every word in the vocabulary. These
+        # are broadcast to every time step and sequence.
+        all_membership_probs = tensor.vector('textscorer/all_membership_probs',
+                                             dtype=theano.config.floatX)
+        all_membership_probs.tag.test_value = test_value(
+            size=(21,), high=1.0)
+
+        k = tensor.scalar('textscorer/k', dtype='int64')
         k.tag.test_value = 4
-        
+
 
         # Convert out-of-shortlist words to <unk> in input.
         shortlist_size = self._vocabulary.num_shortlist_words()
@@ -106,14 +108,13 @@ class TextScorer(object):
         target_word_ids = batch_word_ids[1:]
 
         logprobs = tensor.log(network.target_probs())
+        # Expand the class distribution into a word distribution.
         logprobs_output_vec = tensor.log(network.output_probs())
-        if (logprobs_output_vec.shape[2] != membership_probs_output_vec.shape[2]):
-            logprobs_output_vec = logprobs_output_vec[:, :, all_class_ids]
-        
+        logprobs_output_vec = logprobs_output_vec[:, :, all_class_ids]
+
         # Add logprobs from the class membership of the predicted word.
-        
         logprobs += tensor.log(membership_probs)
-        logprobs_output_vec += tensor.log(membership_probs_output_vec)
+        logprobs_output_vec += tensor.log(all_membership_probs)
 
         mask = network.mask
         if use_shortlist and network.oos_logprobs is not None:
@@ -121,8 +122,8 @@ class TextScorer(object):
             # probability) is multiplied by the fraction of the actual word
             # within the set of OOS words.
             logprobs += network.oos_logprobs[target_word_ids]
-            logprobs_output_vec += tensor.tile(network.oos_logprobs, (logprobs_output_vec.shape[0], logprobs_output_vec.shape[1], 1))
-            
+            logprobs_output_vec += network.oos_logprobs
+
             # Always exclude OOV words when using a shortlist - No probability
             # mass is left for them.
             mask *= tensor.neq(target_word_ids, self._unk_id)
@@ -147,11 +148,10 @@ class TextScorer(object):
 
         # Ignore unused input variables, because is_training is only used by
         # dropout layer.
-        #mask_output_vec = tensor.tile(mask.reshape([membership_probs.shape[0],membership_probs.shape[1],1]),(1,1,self._vocabulary.num_classes()))
-        mask_output_vec = mask.reshape([mask.shape[0],mask.shape[1],1])
+        mask_output_vec = mask.dimshuffle(0, 1, 'x')
         masked_logprobs_output_vec = logprobs_output_vec * tensor.cast(mask_output_vec, theano.config.floatX)
         self._output_vec_logprobs_function = theano.function(
-            [batch_word_ids, batch_class_ids, all_class_ids, membership_probs_output_vec, network.mask],
+            [batch_word_ids, batch_class_ids, all_class_ids, all_membership_probs, network.mask],
             [masked_logprobs_output_vec, mask],
             givens=[(network.input_word_ids, input_word_ids),
                     (network.input_class_ids, input_class_ids),
@@ -161,10 +161,22 @@ class TextScorer(object):
             on_unused_input='ignore',
             profile=profile)
 
-        top_k = tensor.argsort(masked_logprobs_output_vec, axis=2)[:, : , -k:]
+        # Only the log probabilities of the top-k words and the target words
+        # are returned, instead of the whole distribution. The top-k words are
+        # found using partial selection, and the target word log probabilities
+        # are read from the flattened distribution.
+        top_k_logprobs, top_k_ids = top_k(masked_logprobs_output_vec, k)
+        num_positions = target_word_ids.shape[0] * target_word_ids.shape[1]
+        vocabulary_size = masked_logprobs_output_vec.shape[2]
+        flat_logprobs = masked_logprobs_output_vec.flatten()
+        target_indices = tensor.arange(num_positions) * vocabulary_size + \
+                         target_word_ids.flatten()
+        target_logprobs = flat_logprobs[target_indices]
+        target_logprobs = target_logprobs.reshape(target_word_ids.shape,
+                                                  ndim=2)
         self._output_top_k_indices_funciton = theano.function(
-            [batch_word_ids, batch_class_ids, all_class_ids, membership_probs_output_vec, network.mask, k],
-            [masked_logprobs_output_vec, top_k, mask],
+            [batch_word_ids, batch_class_ids, all_class_ids, all_membership_probs, network.mask, k],
+            [target_logprobs, top_k_ids, top_k_logprobs, mask],
             givens=[(network.input_word_ids, input_word_ids),
                     (network.input_class_ids, input_class_ids),
                     (network.target_class_ids, target_class_ids),
@@ -188,8 +200,19 @@ class TextScorer(object):
             name='total_logprob',
             on_unused_input='ignore',
             profile=profile)
-        
-        # These are updated by score_line().
+
+        self._sequence_logprobs_function = theano.function(
+            [batch_word_ids, batch_class_ids, membership_probs, network.mask],
+            masked_logprobs.sum(axis=0),
+            givens=[(network.input_word_ids, input_word_ids),
+                    (network.input_class_ids, input_class_ids),
+                    (network.target_class_ids, target_class_ids),
+                    (network.is_training, numpy.int8(0))],
+            name='sequence_logprobs',
+            on_unused_input='ignore',
+            profile=profile)
+
+        # These are updated by score_line() and score_sequences().
         self.num_words = 0
         self.num_unks = 0
 
@@ -248,7 +271,7 @@ class TextScorer(object):
 
         return result
 
-    def score_batch_output(self, word_ids, class_ids, all_class_ids, membership_probs_output_vec, mask):
+    def score_batch_output(self, word_ids, class_ids, all_class_ids, all_membership_probs, mask):
         """Computes the log probability vectors predicted by the neural network for
         the words in a mini-batch.
 
@@ -266,13 +289,17 @@ class TextScorer(object):
                          sequence, that contains the word IDs
 
         :type class_ids: numpy.ndarray of an integer type
-        :param class_ids: a 1-dimensional matrix, that contains the class IDs
-                          of the words in the vocabulary
+        :param class_ids: a 2-dimensional matrix, indexed by time step and
+                          sequence, that contains the class IDs
 
-        :type membership_probs: numpy.ndarray of a floating point type
-        :param membership_probs: a 1-dimensional array, that contains the class
-                                 membership probabilities of all the words in
-                                 the vocabulary
+        :type all_class_ids: numpy.ndarray of an integer type
+        :param all_class_ids: a 1-dimensional array, that contains the class IDs
+                              of all the words in the vocabulary
+
+        :type all_membership_probs: numpy.ndarray of a floating point type
+        :param all_membership_probs: a 1-dimensional array, that contains the
+                                     class membership probabilities of all the
+                                     words in the vocabulary
 
         :type mask: numpy.ndarray of a floating point type
         :param mask: a 2-dimensional matrix, indexed by time step and sequence,
@@ -284,15 +311,15 @@ class TextScorer(object):
         """
 
         result = []
-        membership_probs_output_vec = membership_probs_output_vec.astype(theano.config.floatX)
+        all_membership_probs = all_membership_probs.astype(theano.config.floatX)
 
-        # target_logprobs_function() uses the word and class IDs of the entire
-        # mini-batch, but membership probs and mask are only for the output.
+        # output_vec_logprobs_function() uses the word and class IDs of the
+        # entire mini-batch, but mask is only for the output.
         logprobs, new_mask = self._output_vec_logprobs_function(word_ids,
-                                                            class_ids,
-                                                            all_class_ids,
-                                                            membership_probs_output_vec[1:],
-                                                            mask[1:])
+                                                                class_ids,
+                                                                all_class_ids,
+                                                                all_membership_probs,
+                                                                mask[1:])
         for seq_index in range(logprobs.shape[1]):
             seq_mask = mask[1:, seq_index]
             seq_logprobs = logprobs[seq_mask == 1, seq_index, :]
@@ -304,9 +331,10 @@ class TextScorer(object):
 
         return result
 
-    def score_top_k(self, word_ids, class_ids, all_class_ids, membership_probs_output_vec, k, mask):
-        """Computes the log probability vectors predicted by the neural network for
-        the words in a mini-batch and the topk indices for this output vector.
+    def score_top_k(self, word_ids, class_ids, all_class_ids, all_membership_probs, k, mask):
+        """Computes the log probabilities predicted by the neural network for
+        the words in a mini-batch, and the indices and log probabilities of the
+        top-k words at each position.
 
         The result will be returned in a list of lists. The indices will be a
         transpose of those of the input matrices, so that the first index is the
@@ -322,51 +350,64 @@ class TextScorer(object):
                          sequence, that contains the word IDs
 
         :type class_ids: numpy.ndarray of an integer type
-        :param class_ids: a 1-dimensional matrix, that contains the class IDs
-                          of the words in the vocabulary
+        :param class_ids: a 2-dimensional matrix, indexed by time step and
+                          sequence, that contains the class IDs
 
-        :type membership_probs: numpy.ndarray of a floating point type
-        :param membership_probs: a 1-dimensional array, that contains the class
-                                 membership probabilities of all the words in
-                                 the vocabulary
+        :type all_class_ids: numpy.ndarray of an integer type
+        :param all_class_ids: a 1-dimensional array, that contains the class IDs
+                              of all the words in the vocabulary
+
+        :type all_membership_probs: numpy.ndarray of a floating point type
+        :param all_membership_probs: a 1-dimensional array, that contains the
+                                     class membership probabilities of all the
+                                     words in the vocabulary
+
+        :type k: int
+        :param k: number of words to select at each position
 
         :type mask: numpy.ndarray of a floating point type
         :param mask: a 2-dimensional matrix, indexed by time step and sequence,
                      that masks out elements past the sequence ends
 
-        :rtype: list of list of lists
-        :returns: topk indices and  logprob vectors of each word in each sequence,
-                   ``None`` values indicating excluded <unk> tokens
+        :rtype: tuple of three lists of lists
+        :returns: logprob of each word, top-k word IDs, and the logprobs of the
+                  top-k words in each sequence, ``None`` values indicating
+                  excluded <unk> tokens
         """
 
         result_lp = []
         result_tk = []
-        membership_probs_output_vec = membership_probs_output_vec.astype(theano.config.floatX)
-
-        # output_topk_indices_function() uses the word and class IDs of the entire
-        # mini-batch, but membership probs and mask are only for the output.
-        logprobs, topk, new_mask = self._output_top_k_indices_funciton(word_ids,
-                                                            class_ids,
-                                                            all_class_ids,
-                                                            membership_probs_output_vec[1:], 
-                                                            mask[1:],
-                                                            k)
+        result_tklp = []
+        all_membership_probs = all_membership_probs.astype(theano.config.floatX)
+
+        # output_topk_indices_function() uses the word and class IDs of the
+        # entire mini-batch, but mask is only for the output.
+        logprobs, topk, topk_logprobs, new_mask = \
+            self._output_top_k_indices_funciton(word_ids,
+                                                class_ids,
+                                                all_class_ids,
+                                                all_membership_probs,
+                                                mask[1:],
+                                                k)
 
         for seq_index in range(logprobs.shape[1]):
             seq_mask = mask[1:, seq_index]
-            seq_logprobs = logprobs[seq_mask == 1, seq_index, :]
+            seq_logprobs = logprobs[seq_mask == 1, seq_index]
             seq_topk = topk[seq_mask == 1, seq_index, :]
+            seq_topk_logprobs = topk_logprobs[seq_mask == 1, seq_index, :]
             # The new mask also masks excluded tokens, replace those with None.
             seq_mask = new_mask[seq_mask == 1, seq_index]
             seq_logprobs = [lp if m == 1 else None
                             for lp, m in zip(seq_logprobs, seq_mask)]
             seq_topk = [tk if m == 1 else None
-                            for tk, m in zip(seq_topk, seq_mask)]
+                        for tk, m in zip(seq_topk, seq_mask)]
+            seq_topk_logprobs = [tklp if m == 1 else None
+                                 for tklp, m in zip(seq_topk_logprobs, seq_mask)]
             result_lp.append(seq_logprobs)
             result_tk.append(seq_topk)
-            
+            result_tklp.append(seq_topk_logprobs)
 
-        return result_lp, result_tk
+        return result_lp, result_tk, result_tklp
 
     def compute_perplexity(self, batch_iter):
         """Computes the perplexity of text read using the given iterator.
@@ -474,6 +515,57 @@ class TextScorer(object):
 
         return logprob
 
+    def score_sequences(self, word_ids, class_ids, membership_probs, mask):
+        """Computes the log probability of each word sequence in a mini-batch.
+
+        ``<unk>`` tokens will be excluded from the probability computation in
+        the same cases as in ``score_sequence()``.
+
+        :type word_ids: numpy.ndarray of an integer type
+        :param word_ids: a 2-dimensional matrix, indexed by time step and
+                         sequence, that contains the word IDs
+
+        :type class_ids: numpy.ndarray of an integer type
+        :param class_ids: a 2-dimensional matrix, indexed by time step and
+                          sequence, that contains the class IDs
+
+        :type membership_probs: numpy.ndarray of a floating point type
+        :param membership_probs: a 2-dimensional matrix, indexed by time step
+                                 and sequences, that contains the class
+                                 membership probabilities of the words
+
+        :type mask: numpy.ndarray of a floating point type
+        :param mask: a 2-dimensional matrix, indexed by time step and sequence,
+                     that masks out elements past the sequence ends
+
+        :rtype: numpy.ndarray
+        :returns: log probability of each sequence
+        """
+
+        unk_id = self._vocabulary.word_to_id['<unk>']
+        self.num_words += numpy.count_nonzero(mask)
+        self.num_unks += numpy.count_nonzero((word_ids == unk_id) & (mask == 1))
+
+        membership_probs = membership_probs.astype(theano.config.floatX)
+
+        # sequence_logprobs_function() uses the word and class IDs of the entire
+        # mini-batch, but membership probs and mask are only for the output.
+        logprobs = self._sequence_logprobs_function(word_ids,
+                                                    class_ids,
+                                                    membership_probs[1:],
+                                                    mask[1:])
+        if numpy.any(numpy.isnan(logprobs)):
+            self._debug_log_batch(word_ids, class_ids, membership_probs, mask)
+            raise NumberError("Log probability of a sequence is NaN.")
+        if numpy.any(numpy.isneginf(logprobs)):
+            self._debug_log_batch(word_ids, class_ids, membership_probs, mask)
+            raise NumberError("Probability of a sequence is zero.")
+        if numpy.any(logprobs > 0.0):
+            self._debug_log_batch(word_ids, class_ids, membership_probs, mask)
+            raise NumberError("Probability of a sequence is greater than one.")
+
+        return logprobs
+
     def score_line(self, line, vocabulary):
         """Scores a line of text.
 